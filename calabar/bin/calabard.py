@@ -9,6 +9,9 @@ import sys
 from ConfigParser import SafeConfigParser
 
 from calabar.tunnels import TunnelManager
+from calabar.tunnels.evented import AsyncTunnelManager
+from calabar.tunnels.rundir import private_dir
+from calabar.tunnels.shards import ShardSupervisor
 from calabar.tunnels.vpnc import VpncTunnel
 
 VPNC_CONF = '/etc/calabar/default.conf'
@@ -18,24 +21,69 @@ OPTION_LIST = (
     optparse.make_option('-c', '--configfile', action="store", dest="configfile",
                          default=CALABAR_CONF,
                          help="The vpnc configuration file to use"),
+    optparse.make_option('-p', '--poll', action="store_true", dest="poll",
+                         default=False,
+                         help="Check the tunnels every 5 seconds instead of "
+                         "reacting to tunnel exits as they happen"),
+    optparse.make_option('-w', '--workers', action="store", dest="workers",
+                         type="int", default=0,
+                         help="Split supervision of the tunnels between this "
+                         "many worker processes"),
 )
 
-def run_tunnels(configfile='/etc/calabar/calabar.conf'):
+def run_tunnels(configfile='/etc/calabar/calabar.conf', poll=False, workers=0):
     """Run the configured VPN/SSH tunnels and keep them running"""
+    # Before anything is started, so that an unsafe one stops us right away
+    private_dir()
+
+    if workers > 1:
+        ShardSupervisor(configfile, workers).run()
+        return
+
     config = SafeConfigParser()
     config.read(configfile)
 
-    tm = TunnelManager()
-    _run_tunnels(tm, config)
+    if poll:
+        tm = TunnelManager()
+    else:
+        tm = AsyncTunnelManager()
+    tm.watch_config(configfile)
+    tm.profiler.watch_signals()
+    _run_tunnels(tm, config, poll)
 
-def _run_tunnels(tm, config):
+def _run_tunnels(tm, config, poll=False):
     tm.load_tunnels(config)
 
     tm.start_tunnels()
 
+    if poll:
+        _poll_tunnels(tm)
+    else:
+        tm.serve_metrics(tm.loop)
+        tm.serve_control(tm.loop)
+        tm.run()
+
+def _poll_tunnels(tm):
+    """
+    Fallback supervision mode that checks all of the tunnels every 5 seconds.
+
+    The wait between passes runs the manager's event loop so that metrics can
+    be served, control requests answered and in-process forwards relayed in
+    the meantime.
+
+    The first pass only comes once ``start_tunnels()`` has finished, which
+    with thousands of tunnels can take up to ``ceil(tunnels /
+    startup_concurrency) * ready_timeout`` seconds. Tunnels that exit before
+    then are reaped but not restarted, and SIGHUP waits for that pass too.
+    """
+    loop = tm.event_loop()
+    tm.serve_metrics(loop)
+    tm.serve_control(loop)
     while True:
         tm.continue_tunnels()
-        time.sleep(5)
+        next_pass = time.time() + 5
+        while time.time() < next_pass:
+            loop.run_once(max(0, next_pass - time.time()))
 
 def parse_options(arguments):
     """Parse the available options to ``calabard``."""
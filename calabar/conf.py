@@ -1,4 +1,7 @@
 from calabar.tunnels.vpnc import VpncTunnel
+from calabar.tunnels.ssh import SshTunnel
+from calabar.tunnels.forward import ForwardTunnel
+from calabar.tunnels.udp import UdpForwardTunnel
 from calabar.tunnels.base import TunnelBase, ExecutableNotFound
 
-TUNNELS = [VpncTunnel, TunnelBase]
+TUNNELS = [VpncTunnel, SshTunnel, ForwardTunnel, UdpForwardTunnel, TunnelBase]
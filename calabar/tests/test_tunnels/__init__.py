@@ -0,0 +1,36 @@
+import shutil
+import tempfile
+
+import calabar.tunnels
+from calabar.tunnels.scripts import SCRIPT_STORE
+from calabar.tunnels.ssh import SSH_MASTERS
+from calabar.tunnels.vpnc import VpncTunnel
+
+_RUN_DIR = None
+
+def setup_package():
+    """
+    Keep the runtime files that the tests create out of the real runtime
+    directory, where a ``calabard`` running on the same host keeps its own.
+    """
+    global _RUN_DIR
+    _RUN_DIR = tempfile.mkdtemp(prefix='calabar-tests-')
+    VpncTunnel.READY_DIR = _RUN_DIR
+    SCRIPT_STORE.directory = _RUN_DIR
+    SSH_MASTERS.directory = _RUN_DIR
+    # Tests that save or adopt tunnels, or keep allocated ports, give their
+    # managers state files of their own, and the rest don't need them
+    calabar.tunnels.TUNNEL_STATE_FILE = ''
+    calabar.tunnels.PORT_STATE_FILE = ''
+
+def teardown_package():
+    shutil.rmtree(_RUN_DIR, ignore_errors=True)
+
+def close_tunnels(tunnels):
+    """
+    Kill every tunnel in ``tunnels`` so that a test doesn't leave processes
+    behind.
+    """
+    for t in tunnels:
+        if t.is_running():
+            t.close(force=True)
@@ -0,0 +1,235 @@
+import unittest
+import os
+import shutil
+import signal
+import stat
+import subprocess
+import tempfile
+import time
+from ConfigParser import SafeConfigParser
+
+from calabar.tunnels import TunnelManager, config_hash, get_tunnels
+from calabar.tunnels import evented
+from calabar.tunnels.adoption import (
+    AdoptedProcess,
+    TunnelStateFile,
+    UNKNOWN_RETURNCODE,
+)
+from calabar.tunnels.evented import AsyncTunnelManager
+from calabar.tunnels.procs import process_start_time
+from calabar.tunnels.states import READY
+from calabar.tests.test_tunnels import close_tunnels
+
+EXECUTABLE = 'cal_run_forever'
+
+def _config(tunnels, state_file):
+    conf = SafeConfigParser()
+    conf.add_section('calabar')
+    conf.set('calabar', 'state_file', state_file)
+    for name, arg in tunnels.items():
+        sec = 'tunnel:%s' % name
+        conf.add_section(sec)
+        conf.set(sec, 'tunnel_type', 'base')
+        conf.set(sec, 'cmd', '%s %s' % (EXECUTABLE, arg))
+        conf.set(sec, 'executable', EXECUTABLE)
+
+    return conf
+
+def _orphan(arg):
+    """
+    Start a tunnel process that isn't our child, like one left behind by a
+    calabard that has since exited. Returns its pid.
+    """
+    sh = subprocess.Popen(
+        ['sh', '-c', '%s %s >/dev/null 2>&1 & echo $!' % (EXECUTABLE, arg)],
+        stdout=subprocess.PIPE)
+    pid = int(sh.communicate()[0])
+    return pid
+
+def _kill(pid):
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+class TestAdoptedProcess(unittest.TestCase):
+
+    def test_lifecycle(self):
+        pid = _orphan(1)
+        proc = AdoptedProcess(pid, process_start_time(pid))
+        try:
+            self.assertEqual(proc.poll(), None)
+            proc.terminate()
+            self.assertEqual(proc.wait(), UNKNOWN_RETURNCODE)
+        finally:
+            _kill(pid)
+
+    def test_pid_reused(self):
+        pid = _orphan(1)
+        try:
+            proc = AdoptedProcess(pid, process_start_time(pid) - 1)
+            self.assertEqual(proc.poll(), UNKNOWN_RETURNCODE)
+        finally:
+            _kill(pid)
+
+class TestTunnelStateFile(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_round_trip(self):
+        entries = {'a': {'pid': 12, 'start_time': 34, 'config_hash': 'x',
+                         'scripts': []}}
+        TunnelStateFile(self.path).save(entries)
+
+        self.assertEqual(TunnelStateFile(self.path).load(), entries)
+
+    def test_unreadable(self):
+        open(self.path, 'w').write('{not json')
+        self.assertEqual(TunnelStateFile(self.path).load(), {})
+        self.assertEqual(TunnelStateFile('').load(), {})
+
+    def test_not_private(self):
+        entries = {'a': {'pid': 12, 'start_time': 34}}
+        TunnelStateFile(self.path).save(entries)
+
+        os.chmod(self.path, 0622)
+        self.assertEqual(TunnelStateFile(self.path).load(), {})
+
+        os.chmod(self.path, 0600)
+        if os.geteuid() == 0:
+            os.chown(self.path, 65534, 65534)
+            self.assertEqual(TunnelStateFile(self.path).load(), {})
+
+    def test_symlink(self):
+        TunnelStateFile(self.path).save({'a': {'pid': 12, 'start_time': 34}})
+        link = self.path + '.link'
+        os.symlink(self.path, link)
+        try:
+            self.assertEqual(TunnelStateFile(link).load(), {})
+        finally:
+            os.remove(link)
+
+    def test_creates_directory(self):
+        parent = tempfile.mkdtemp()
+        try:
+            path = os.path.join(parent, 'run', 'tunnels.json')
+            TunnelStateFile(path).save({})
+
+            mode = os.stat(os.path.dirname(path)).st_mode
+            self.assertEqual(stat.S_IMODE(mode), 0700)
+            self.assertEqual(TunnelStateFile(path).load(), {})
+        finally:
+            shutil.rmtree(parent)
+
+class AdoptionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.state_file = tempfile.mkstemp()
+        os.close(fd)
+        self.managers = []
+        self.orphans = []
+
+    def tearDown(self):
+        for tm in self.managers:
+            close_tunnels(tm.tunnels)
+        for pid in self.orphans:
+            _kill(pid)
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+        os.remove(self.state_file)
+
+    def manager(self, tunnels, cls=TunnelManager):
+        tm = cls()
+        self.managers.append(tm)
+        tm.load_tunnels(_config(tunnels, self.state_file))
+        return tm
+
+    def pids(self, tm):
+        return dict([(t.name, t.proc.pid) for t in tm.tunnels if t.proc])
+
+class TestAdoption(AdoptionTestCase):
+
+    def setUp(self):
+        AdoptionTestCase.setUp(self)
+        self.old = self.manager({'a': 1, 'b': 1})
+        self.old.start_tunnels()
+        self.old_pids = self.pids(self.old)
+
+    def test_adopts_running_tunnels(self):
+        tm = self.manager({'a': 1, 'b': 1})
+
+        self.assertEqual(self.pids(tm), self.old_pids)
+        for t in tm.tunnels:
+            self.assertEqual(t.state, READY)
+            self.assertTrue(isinstance(t.proc, AdoptedProcess))
+
+        # Nothing is left for startup to do
+        tm.start_tunnels()
+        self.assertEqual(self.pids(tm), self.old_pids)
+
+    def test_replaces_changed_tunnels(self):
+        tm = self.manager({'a': 1, 'b': 2, 'c': 1})
+        old_b = self.old.get_tunnel('b').proc
+
+        self.assertEqual(self.pids(tm), {'a': self.old_pids['a']})
+        # The stale process is terminated rather than left to run alongside
+        # its replacement
+        old_b.wait()
+
+        tm.start_tunnels()
+        self.assertEqual(sorted(self.pids(tm)), ['a', 'b', 'c'])
+        self.assertNotEqual(self.pids(tm)['b'], self.old_pids['b'])
+
+    def test_saves_restarts(self):
+        tm = self.manager({'a': 1, 'b': 1})
+        tm.start_tunnels()
+        os.kill(tm.get_tunnel('a').proc.pid, signal.SIGKILL)
+        for x in range(100):
+            if tm.get_tunnel('a').proc is None:
+                break
+            tm.continue_tunnels()
+            time.sleep(0.02)
+        tm.continue_tunnels()
+
+        saved = TunnelStateFile(self.state_file).load()
+        self.assertEqual(saved['a']['pid'], tm.get_tunnel('a').proc.pid)
+        self.assertNotEqual(saved['a']['pid'], self.old_pids['a'])
+        self.assertEqual(saved['b']['pid'], self.old_pids['b'])
+
+class TestAsyncAdoption(AdoptionTestCase):
+
+    def setUp(self):
+        AdoptionTestCase.setUp(self)
+        self.interval = evented.ADOPTED_POLL_INTERVAL
+        evented.ADOPTED_POLL_INTERVAL = 0.05
+
+    def tearDown(self):
+        evented.ADOPTED_POLL_INTERVAL = self.interval
+        AdoptionTestCase.tearDown(self)
+
+    def test_restarts_exited_orphan(self):
+        pid = _orphan(1)
+        self.orphans.append(pid)
+        conf_d = get_tunnels(_config({'a': 1}, self.state_file))['a']
+        TunnelStateFile(self.state_file).save({'a': {
+            'pid': pid, 'start_time': process_start_time(pid),
+            'config_hash': config_hash(conf_d), 'scripts': []}})
+
+        tm = self.manager({'a': 1}, AsyncTunnelManager)
+        t = tm.get_tunnel('a')
+        self.assertEqual(t.proc.pid, pid)
+        tm.start_tunnels()
+
+        os.kill(pid, signal.SIGKILL)
+        for x in range(100):
+            tm.loop.run_once(0.05)
+            if t.proc is not None and t.proc.pid != pid and t.is_running():
+                break
+        self.assertTrue(t.is_running())
+        self.assertNotEqual(t.proc.pid, pid)
+        self.assertEqual(tm._adopted, {})
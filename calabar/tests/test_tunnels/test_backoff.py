@@ -0,0 +1,78 @@
+import unittest
+
+from calabar.tunnels import TunnelManager
+from calabar.tunnels.backoff import Backoff
+from calabar.tunnels.base import TunnelBase
+
+class TestBackoff(unittest.TestCase):
+
+    def setUp(self):
+        self.backoff = Backoff(base=1, cap=10, jitter=0, stable_uptime=60)
+
+    def test_first_restart_immediate(self):
+        self.assertEqual(self.backoff.failed(now=100), 0)
+        self.assertTrue(self.backoff.due(now=100))
+
+    def test_exponential(self):
+        delays = [self.backoff.failed(now=100) for x in range(5)]
+
+        self.assertEqual(delays, [0, 1, 2, 4, 8])
+        self.assertFalse(self.backoff.due(now=107))
+        self.assertTrue(self.backoff.due(now=108))
+
+    def test_capped(self):
+        delays = [self.backoff.failed(now=100) for x in range(10)]
+
+        self.assertEqual(max(delays), 10)
+
+    def test_jitter(self):
+        backoff = Backoff(base=8, cap=100, jitter=0.5)
+        backoff.failed()
+        for x in range(20):
+            backoff.failures = 1
+            delay = backoff.failed()
+            self.assertTrue(4 <= delay <= 8, delay)
+
+    def test_stable_resets(self):
+        for x in range(4):
+            self.backoff.failed(now=100)
+        self.backoff.started(now=100)
+
+        self.assertEqual(self.backoff.failed(now=200), 0)
+        self.assertEqual(self.backoff.failures, 1)
+
+    def test_unstable_keeps_failures(self):
+        for x in range(4):
+            self.backoff.failed(now=100)
+        self.backoff.started(now=100)
+
+        self.assertEqual(self.backoff.failed(now=110), 8)
+
+class TestManagerBackoff(unittest.TestCase):
+
+    def setUp(self):
+        self.t = TunnelBase(['ls'], 'DOESNOTEXIST', name='bad')
+
+        self.tm = TunnelManager()
+        self.tm.backoff_jitter = 0
+        self.tm.backoff_base = 30
+        self.tm.tunnels = [self.t]
+
+    def test_backs_off(self):
+        self.tm.start_tunnels()
+        self.tm.continue_tunnels()
+        backoff = self.tm.backoffs['bad']
+        self.assertEqual(backoff.failures, 2)
+
+        # Still backing off, so no new attempt is made
+        self.tm.continue_tunnels()
+        self.assertEqual(backoff.failures, 2)
+
+    def test_status(self):
+        self.tm.start_tunnels()
+        self.tm.continue_tunnels()
+
+        status = self.tm.status()
+        self.assertEqual(len(status), 1)
+        self.assertTrue(status[0].startswith('[bad] backing off after 2 failures'))
+        self.assertTrue('Next retry at' in status[0])
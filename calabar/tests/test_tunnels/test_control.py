@@ -0,0 +1,248 @@
+import unittest
+import json
+import os
+import resource
+import signal
+import socket
+import stat
+import tempfile
+from ConfigParser import SafeConfigParser
+
+from calabar.tunnels import TunnelManager
+from calabar.tunnels.control import Controller, ControlServer, ControlError
+from calabar.tunnels.loop import EventLoop
+from calabar.tunnels.ports import PortAllocator
+from calabar.tests.test_tunnels import close_tunnels
+
+EXECUTABLE = 'cal_run_forever'
+
+def _base(arg):
+    return {'tunnel_type': 'base', 'cmd': '%s %s' % (EXECUTABLE, arg),
+            'executable': EXECUTABLE}
+
+def _config(tunnels):
+    conf = SafeConfigParser()
+    conf.add_section('calabar')
+    conf.set('calabar', 'port_ranges', '41000-41099')
+    for name, options in tunnels.items():
+        sec = 'tunnel:%s' % name
+        conf.add_section(sec)
+        for option, value in options.items():
+            conf.set(sec, option, value)
+
+    return conf
+
+class ControlTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.port_file = tempfile.mkstemp()
+        os.close(fd)
+        self.tm = TunnelManager()
+        self.tm.ports = PortAllocator([], self.port_file)
+        self.tm.port_state_file = self.port_file
+        self.tm.load_tunnels(_config({'a': _base(1), 'b': _base(1)}))
+        self.tm.start_tunnels()
+        self.controller = Controller(self.tm)
+
+    def tearDown(self):
+        close_tunnels(self.tm.tunnels)
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        os.remove(self.port_file)
+
+    def request(self, request):
+        return json.loads(self.controller.handle(json.dumps(request)))
+
+    def names(self):
+        return sorted([t.name for t in self.tm.tunnels])
+
+class TestController(ControlTestCase):
+
+    def test_batch_add(self):
+        a_pid = self.tm.get_tunnel('a').proc.pid
+        ops = [{'op': 'add', 'name': 'c%s' % i, 'tunnel': _base(i)}
+               for i in range(5)]
+
+        results = self.request(ops)
+
+        self.assertEqual([r['ok'] for r in results], [True] * 5)
+        self.assertEqual(self.names(), ['a', 'b', 'c0', 'c1', 'c2', 'c3', 'c4'])
+        self.assertTrue(self.tm.get_tunnel('c3').is_running())
+        self.assertEqual(results[3]['tunnel']['pid'],
+                         self.tm.get_tunnel('c3').proc.pid)
+        # Untouched
+        self.assertEqual(self.tm.get_tunnel('a').proc.pid, a_pid)
+
+    def test_invalid_batch_applies_nothing(self):
+        results = self.request([
+            {'op': 'add', 'name': 'c', 'tunnel': _base(1)},
+            {'op': 'remove', 'name': 'a'},
+            {'op': 'add', 'name': 'd', 'tunnel': {'tunnel_type': 'bogus'}},
+        ])
+
+        self.assertEqual([r['ok'] for r in results], [False] * 3)
+        self.assertTrue('bogus' in results[2]['error'])
+        self.assertEqual(self.names(), ['a', 'b'])
+        self.assertTrue(self.tm.get_tunnel('a').is_running())
+
+    def test_port_conflict_applies_nothing(self):
+        forward = {'tunnel_type': 'forward', 'listen': '41050',
+                   'target': '127.0.0.1:1'}
+        results = self.request([
+            {'op': 'add', 'name': 'c', 'tunnel': forward},
+            {'op': 'add', 'name': 'd', 'tunnel': forward},
+        ])
+
+        self.assertFalse(results[0]['ok'])
+        self.assertTrue('41050' in results[0]['error'])
+        self.assertEqual(self.names(), ['a', 'b'])
+
+    def test_auto_port(self):
+        result = self.request({'op': 'add', 'name': 'c', 'tunnel': {
+            'tunnel_type': 'forward', 'listen': 'auto',
+            'target': '127.0.0.1:1'}})
+
+        self.assertTrue(result['ok'])
+        port = result['tunnel']['port']
+        self.assertTrue(41000 <= port <= 41099)
+        self.assertEqual(self.tm.get_tunnel('c').forwarder.listen[1], port)
+        self.assertEqual(self.tm.ports.assignments, {'c': port})
+
+        # A reload gives it the same port rather than restarting it
+        self.tm.update_tunnels(_config({'a': _base(1), 'b': _base(1)}))
+        self.assertEqual(self.tm.ports.assignments, {'c': port})
+        self.assertTrue(self.tm.get_tunnel('c').is_running())
+
+    def test_remove_and_restart(self):
+        b_pid = self.tm.get_tunnel('b').proc.pid
+        a_proc = self.tm.get_tunnel('a').proc
+
+        results = self.request([{'op': 'remove', 'name': 'a'},
+                                {'op': 'restart', 'name': 'b'}])
+
+        self.assertEqual([r['ok'] for r in results], [True, True])
+        self.assertEqual(self.names(), ['b'])
+        self.assertNotEqual(a_proc.returncode, None)
+        b = self.tm.get_tunnel('b')
+        self.assertTrue(b.is_running())
+        self.assertNotEqual(b.proc.pid, b_pid)
+
+    def test_status(self):
+        result = self.request({'op': 'status'})
+        self.assertEqual([t['name'] for t in result['tunnels']], ['a', 'b'])
+
+        result = self.request({'op': 'status', 'name': 'a'})
+        self.assertEqual(result['tunnel']['state'], 'ready')
+        self.assertEqual(result['tunnel']['pid'],
+                         self.tm.get_tunnel('a').proc.pid)
+
+    def test_errors(self):
+        self.assertEqual(self.controller.handle('{nope'),
+                         '{"ok": false, "error": "Invalid JSON"}')
+        self.assertFalse(self.request({'op': 'explode'})['ok'])
+        self.assertFalse(self.request({'op': 'remove', 'name': 'z'})['ok'])
+        self.assertFalse(self.request({'op': 'add', 'name': 'a',
+                                       'tunnel': _base(1)})['ok'])
+
+    def test_survives_reload(self):
+        self.request({'op': 'add', 'name': 'c', 'tunnel': _base(1)})
+        c_pid = self.tm.get_tunnel('c').proc.pid
+
+        added, removed, changed = self.tm.update_tunnels(
+            _config({'a': _base(1), 'b': _base(1)}))
+
+        self.assertEqual((added, removed, changed), ([], [], []))
+        self.assertEqual(self.tm.get_tunnel('c').proc.pid, c_pid)
+
+        # Until the config file configures it itself
+        self.tm.update_tunnels(_config({'a': _base(1), 'c': _base(2)}))
+        self.assertEqual(self.names(), ['a', 'c'])
+        self.assertNotEqual(self.tm.get_tunnel('c').proc.pid, c_pid)
+        self.assertEqual(self.tm.runtime_tunnels, set())
+
+class TestControlServer(ControlTestCase):
+
+    def setUp(self):
+        ControlTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'control.sock')
+        self.loop = EventLoop()
+        self.server = ControlServer(self.controller.handle, self.path)
+        self.server.start(self.loop)
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.close()
+        os.rmdir(self.dir)
+        ControlTestCase.tearDown(self)
+
+    def connect(self):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.path)
+        client.setblocking(0)
+        return client
+
+    def receive_lines(self, client, count):
+        data = ''
+        for x in range(100):
+            self.loop.run_once(0.02)
+            try:
+                data += client.recv(65536)
+            except socket.error:
+                pass
+            if data.count('\n') >= count:
+                return [json.loads(line) for line in data.splitlines()]
+        self.fail("Timed out")
+
+    def test_requests(self):
+        client = self.connect()
+        client.sendall(json.dumps({'op': 'status', 'name': 'a'}) + '\n' +
+                       json.dumps([{'op': 'add', 'name': 'c',
+                                    'tunnel': _base(1)}]) + '\n')
+
+        status, added = self.receive_lines(client, 2)
+        client.close()
+
+        self.assertEqual(status['tunnel']['name'], 'a')
+        self.assertTrue(added[0]['ok'])
+        self.assertTrue(self.tm.get_tunnel('c').is_running())
+
+    def test_permissions(self):
+        mode = os.stat(self.path).st_mode
+        self.assertTrue(stat.S_ISSOCK(mode))
+        self.assertEqual(stat.S_IMODE(mode), 0600)
+
+    def test_stale_socket(self):
+        # Still served
+        self.assertRaises(ControlError,
+                          ControlServer(None, self.path).start, self.loop)
+
+        # Left behind by a calabard that died
+        self.loop.remove_reader(self.server.sock.fileno())
+        self.server.sock.close()
+        self.server.sock = None
+        server = ControlServer(self.controller.handle, self.path)
+        server.start(self.loop)
+        self.server = server
+
+        client = self.connect()
+        client.sendall('{"op": "status"}\n')
+        self.assertTrue(self.receive_lines(client, 1)[0]['ok'])
+        client.close()
+
+    def test_out_of_fds(self):
+        client = self.connect()
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        # Every fd from the lowest free one up is out of bounds
+        free = os.dup(0)
+        os.close(free)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (free, limits[1]))
+        try:
+            self.loop.run_once(0.5)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+
+        self.assertTrue(self.server._paused is not None)
+        # Answered once the pause is over
+        client.sendall('{"op": "status"}\n')
+        self.assertTrue(self.receive_lines(client, 1)[0]['ok'])
+        client.close()
@@ -0,0 +1,116 @@
+import unittest
+import os
+import signal
+import socket
+import time
+
+from calabar.tunnels.base import TunnelBase
+from calabar.tunnels.evented import AsyncTunnelManager
+from calabar.tunnels.loop import EventLoop
+from calabar.tests.test_tunnels import close_tunnels
+
+def _run_until(loop, cond, timeout=2):
+    start = time.time()
+    while time.time() - start < timeout:
+        if cond():
+            return True
+        loop.run_once(timeout=0.05)
+
+    return cond()
+
+class AsyncManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.executable = 'cal_run_forever'
+        self.t = TunnelBase([self.executable], self.executable, name='forever')
+
+        self.tm = AsyncTunnelManager(EventLoop())
+        self.tm.tunnels = [self.t]
+
+    def tearDown(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        close_tunnels(self.tm.tunnels)
+        self.tm.loop.close()
+
+class TestAsyncStart(AsyncManagerTestCase):
+
+    def test_start(self):
+        self.tm.start_tunnels()
+
+        self.assertTrue(_run_until(self.tm.loop, self.t.is_running))
+
+    def test_bad_exec_retried(self):
+        bad = TunnelBase(['ls'], 'DOESNOTEXIST', name='bad')
+        self.tm.tunnels.append(bad)
+        self.tm.start_tunnels()
+
+        _run_until(self.tm.loop, self.t.is_running)
+
+        self.assertFalse(bad.is_running())
+        self.assertTrue('bad' in self.tm._restart_timers)
+
+class TestAsyncRestart(AsyncManagerTestCase):
+
+    def test_restart_on_exit(self):
+        """
+        A tunnel exiting is noticed and restarted without waiting for a poll.
+        """
+        self.tm.start_tunnels()
+        _run_until(self.tm.loop, self.t.is_running)
+        old_pid = self.t.proc.pid
+
+        os.kill(old_pid, signal.SIGKILL)
+        start = time.time()
+        restarted = _run_until(
+            self.tm.loop,
+            lambda: self.t.proc and self.t.proc.pid != old_pid)
+
+        self.assertTrue(restarted)
+        self.assertTrue(self.t.is_running())
+        self.assertTrue(time.time() - start < 1)
+
+class TestAsyncClose(AsyncManagerTestCase):
+
+    def test_close_escalates(self):
+        """
+        A tunnel ignoring SIGTERM is killed once its close timeout passes and
+        closing it never blocks the loop.
+        """
+        stubborn = TunnelBase(['sh', '-c', "trap '' TERM; exec sleep 60"],
+                              'sh', name='stubborn')
+        self.tm.tunnels = [stubborn]
+        self.tm.start_tunnels()
+        _run_until(self.tm.loop, stubborn.is_running)
+        # Give the shell a moment to install its trap
+        time.sleep(.1)
+
+        start = time.time()
+        self.tm.close_tunnel(stubborn, timeout=0.2)
+        self.assertTrue(time.time() - start < 0.1)
+
+        closed = _run_until(self.tm.loop, lambda: stubborn.proc is None)
+        self.assertTrue(closed)
+        self.assertFalse('stubborn' in self.tm._restart_timers)
+
+class TestAsyncHealth(AsyncManagerTestCase):
+
+    def test_wedged_tunnel_recycled(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        closed_port = sock.getsockname()[1]
+        sock.close()
+
+        wedged = TunnelBase([self.executable], self.executable, name='wedged',
+                            probes=['tcp:127.0.0.1:%s' % closed_port])
+        self.tm.tunnels = [wedged]
+        self.tm.probe_interval = 0.05
+        self.tm.probe_failures = 1
+        self.tm.start_tunnels()
+        _run_until(self.tm.loop, wedged.is_running)
+        pid = wedged.proc.pid
+
+        recycled = _run_until(
+            self.tm.loop,
+            lambda: wedged.proc is not None and wedged.proc.pid != pid)
+
+        self.assertTrue(recycled)
@@ -0,0 +1,161 @@
+import unittest
+import os
+import signal
+import subprocess
+import time
+from StringIO import StringIO
+
+from calabar.tunnels import TunnelManager
+from calabar.tunnels.base import TunnelBase
+from calabar.tunnels.events import (
+    BufferedSink,
+    EventLog,
+    RateLimiter,
+    exit_fields,
+    format_event,
+)
+
+class TestFormat(unittest.TestCase):
+
+    def test_fields_sorted(self):
+        line = format_event(0, 'exited', 'foo', {'pid': 12, 'code': 1})
+
+        self.assertTrue(line.endswith(' event=exited tunnel=foo code=1 pid=12\n'))
+        self.assertTrue(line.startswith('time='))
+
+    def test_quoted(self):
+        line = format_event(0, 'summary', None, {'msg': 'a "b" c', 'empty': ''})
+
+        self.assertTrue('msg="a \\"b\\" c"' in line)
+        self.assertTrue('empty=""' in line)
+        self.assertFalse('tunnel=' in line)
+
+    def test_exit_fields(self):
+        self.assertEqual(exit_fields(1 << 8), {'code': 1})
+        self.assertEqual(exit_fields(signal.SIGKILL), {'signal': signal.SIGKILL})
+
+class TestBufferedSink(unittest.TestCase):
+
+    def test_buffered_until_flush(self):
+        out = StringIO()
+        sink = BufferedSink(out, flush_interval=60)
+        sink.write('a\n')
+        sink.write('b\n')
+
+        self.assertEqual(out.getvalue(), '')
+        sink.flush()
+        self.assertEqual(out.getvalue(), 'a\nb\n')
+
+    def test_size_limit(self):
+        out = StringIO()
+        sink = BufferedSink(out, flush_interval=60, buffer_size=4)
+        sink.write('a\n')
+        sink.write('b\n')
+
+        self.assertEqual(out.getvalue(), 'a\nb\n')
+
+    def test_interval(self):
+        out = StringIO()
+        sink = BufferedSink(out, flush_interval=0)
+        sink.write('a\n')
+
+        self.assertEqual(out.getvalue(), 'a\n')
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_refills(self):
+        limiter = RateLimiter(rate=2, period=10)
+
+        self.assertTrue(limiter.allow('a', now=0))
+        self.assertTrue(limiter.allow('a', now=0))
+        self.assertFalse(limiter.allow('a', now=1))
+        self.assertTrue(limiter.allow('b', now=1))
+        self.assertTrue(limiter.allow('a', now=5))
+
+class TestEventLog(unittest.TestCase):
+
+    def setUp(self):
+        self.out = StringIO()
+        self.log = EventLog(BufferedSink(self.out), rate=2, period=60)
+
+    def lines(self):
+        self.log.flush()
+        return self.out.getvalue().splitlines()
+
+    def test_transitions_only(self):
+        self.assertTrue(self.log.transition('a', 'started', now=0, pid=1))
+        self.assertFalse(self.log.transition('a', 'started', now=1, pid=1))
+        self.assertTrue(self.log.transition('a', 'unhealthy', 'health', now=2))
+
+        self.assertEqual(len(self.lines()), 2)
+        self.assertEqual(self.log.state('a'), 'started')
+        self.assertEqual(self.log.state('a', 'health'), 'unhealthy')
+
+    def test_rate_limited(self):
+        for now in range(5):
+            self.log.emit('recycling', 'a', now=now)
+        self.log.emit('started', 'a', now=60)
+
+        lines = self.lines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[-1].endswith('event=started tunnel=a suppressed=3'))
+
+    def test_summary_due(self):
+        self.assertTrue(self.log.summary_due(now=0))
+        self.log.summary(now=0, running=3)
+
+        self.assertFalse(self.log.summary_due(now=1))
+        self.assertTrue(self.log.summary_due(now=60))
+        self.assertTrue(self.lines()[0].endswith('event=summary running=3'))
+
+    def test_forget(self):
+        self.log.transition('a', 'started', now=0)
+        self.log.forget('a')
+
+        self.assertTrue(self.log.transition('a', 'started', now=1))
+
+class TestManagerEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.executable = 'cal_run_forever'
+        self.t = TunnelBase([self.executable], self.executable, name='a')
+
+        self.tm = TunnelManager()
+        self.tm.backoff_base = 0
+        self.tm.tunnels = [self.t]
+        self.out = StringIO()
+        self.tm.events = EventLog(BufferedSink(self.out))
+
+    def tearDown(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        try:
+            subprocess.call("ps auxww | grep %s | awk '{print $2}' | xargs kill" % self.executable, shell=True)
+        except OSError:
+            pass
+
+    def events(self):
+        return [line.split()[1] for line in self.out.getvalue().splitlines()]
+
+    def test_no_heartbeats(self):
+        self.tm.start_tunnels()
+        for x in range(3):
+            self.tm.continue_tunnels()
+
+        self.assertEqual(self.events(), ['event=started', 'event=summary'])
+        self.assertTrue('ready=1' in self.out.getvalue())
+
+    def test_exit_and_restart(self):
+        self.tm.start_tunnels()
+        self.tm.continue_tunnels()
+        os.kill(self.t.proc.pid, signal.SIGKILL)
+        for x in range(20):
+            if self.tm._child_exited:
+                break
+            time.sleep(0.05)
+        self.tm.continue_tunnels()
+
+        self.assertEqual(self.events(), [
+            'event=started', 'event=summary', 'event=exited',
+            'event=restarting', 'event=started'])
+        self.assertTrue('signal=9' in self.out.getvalue())
+        self.assertTrue(self.t.is_running())
@@ -0,0 +1,315 @@
+import unittest
+import os
+import resource
+import signal
+import socket
+import struct
+import time
+from ConfigParser import SafeConfigParser
+
+from calabar.tunnels import TunnelManager
+from calabar.tunnels.evented import AsyncTunnelManager
+from calabar.tunnels.forward import ForwardTunnel, Forwarder
+from calabar.tunnels.loop import EventLoop
+from calabar.tunnels.states import BACKING_OFF, READY, STOPPED
+from calabar.tests.test_tunnels import close_tunnels
+
+def _listener():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    return sock
+
+class EchoServer(object):
+    """
+    Echoes back whatever its clients send, on the same loop as the forwarder.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.sock = _listener()
+        self.sock.setblocking(0)
+        self.port = self.sock.getsockname()[1]
+        self.clients = []
+        loop.add_reader(self.sock.fileno(), self._accept)
+
+    def _accept(self):
+        client, addr = self.sock.accept()
+        client.setblocking(0)
+        self.clients.append(client)
+        self.loop.add_reader(client.fileno(), lambda: self._echo(client))
+
+    def _echo(self, client):
+        data = client.recv(65536)
+        if data:
+            client.sendall(data)
+        else:
+            self.loop.remove_reader(client.fileno())
+            self.clients.remove(client)
+            client.close()
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        for client in self.clients:
+            self.loop.remove_reader(client.fileno())
+            client.close()
+
+class TestConfiguration(unittest.TestCase):
+
+    def test_parse(self):
+        config = SafeConfigParser()
+        config.add_section('tunnel:ldap')
+        config.set('tunnel:ldap', 'tunnel_type', 'forward')
+        config.set('tunnel:ldap', 'listen', '3389')
+        config.set('tunnel:ldap', 'target', '10.10.250.1:389')
+        config.set('tunnel:ldap', 'max_connections', '10')
+
+        tun_conf_d = ForwardTunnel.parse_configuration(config, 'tunnel:ldap')
+        t = ForwardTunnel(name='ldap', **tun_conf_d)
+
+        self.assertEqual(t.forwarder.listen, ('127.0.0.1', 3389))
+        self.assertEqual(t.forwarder.target, ('10.10.250.1', 389))
+        self.assertEqual(t.forwarder.max_connections, 10)
+        self.assertFalse(hasattr(t, '__dict__'))
+
+class ForwardTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.echo = EchoServer(self.loop)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.echo.close()
+        self.loop.close()
+
+    def connect(self, port):
+        client = socket.create_connection(('127.0.0.1', port))
+        client.settimeout(0)
+        self.clients.append(client)
+        return client
+
+    def run_until(self, cond):
+        for x in range(100):
+            if cond():
+                return
+            self.loop.run_once(0.02)
+        self.fail("Timed out")
+
+    def received(self, client, expected):
+        """Pump the loop until ``client`` has read ``expected``."""
+        got = []
+        def done():
+            try:
+                got.append(client.recv(65536))
+            except socket.error:
+                pass
+            return ''.join(got) == expected or (got and got[-1] == '')
+        self.run_until(done)
+        return ''.join(got)
+
+class TestForwarder(ForwardTestCase):
+
+    def setUp(self):
+        ForwardTestCase.setUp(self)
+        self.fwd = Forwarder(('127.0.0.1', 0), ('127.0.0.1', self.echo.port),
+                             max_connections=2, idle_timeout=60)
+        self.fwd.start(self.loop)
+        self.port = self.fwd.listen[1]
+
+    def tearDown(self):
+        self.fwd.stop()
+        ForwardTestCase.tearDown(self)
+
+    def test_relays(self):
+        client = self.connect(self.port)
+        data = 'x' * 100000
+        client.setblocking(1)
+        client.sendall(data)
+        client.settimeout(0)
+
+        self.assertEqual(self.received(client, data), data)
+        self.assertEqual(self.fwd.bytes_in, len(data))
+        self.assertEqual(self.fwd.bytes_out, len(data))
+        self.assertEqual(self.fwd.accepted, 1)
+
+    def test_half_close(self):
+        client = self.connect(self.port)
+        client.sendall('ping')
+        client.shutdown(socket.SHUT_WR)
+
+        # The target sees EOF, echoes and closes, which closes the client
+        self.assertEqual(self.received(client, 'ping'), 'ping')
+        self.run_until(lambda: not self.fwd.connections)
+
+    def test_connection_limit(self):
+        self.connect(self.port)
+        self.connect(self.port)
+        refused = self.connect(self.port)
+        self.run_until(lambda: self.fwd.refused)
+
+        self.assertEqual(len(self.fwd.connections), 2)
+        self.assertEqual(self.received(refused, ''), '')
+
+    def test_idle_timeout(self):
+        self.fwd.idle_timeout = 0.1
+        client = self.connect(self.port)
+        client.sendall('ping')
+        self.assertEqual(self.received(client, 'ping'), 'ping')
+
+        time.sleep(0.1)
+        self.run_until(lambda: not self.fwd.connections)
+
+    def test_target_down(self):
+        closed = _listener()
+        port = closed.getsockname()[1]
+        closed.close()
+        self.fwd.stop()
+        self.fwd = Forwarder(('127.0.0.1', 0), ('127.0.0.1', port))
+        self.fwd.start(self.loop)
+
+        self.connect(self.fwd.listen[1])
+        self.run_until(lambda: self.fwd.failed)
+        self.assertEqual(self.fwd.connections, set())
+
+    def test_target_unreachable(self):
+        self.fwd.stop()
+        # Connecting to the broadcast address fails straight away
+        self.fwd = Forwarder(('127.0.0.1', 0), ('255.255.255.255', 80))
+        self.fwd.start(self.loop)
+
+        self.connect(self.fwd.listen[1])
+        self.run_until(lambda: self.fwd.failed)
+        self.assertEqual(self.fwd.accepted, 0)
+        self.assertEqual(self.fwd.connections, set())
+
+    def test_target_reset(self):
+        target = _listener()
+        self.fwd.stop()
+        self.fwd = Forwarder(('127.0.0.1', 0), target.getsockname())
+        self.fwd.start(self.loop)
+        client = self.connect(self.fwd.listen[1])
+        self.run_until(lambda: self.fwd.connections and
+                       list(self.fwd.connections)[0].pipes)
+        conn = list(self.fwd.connections)[0]
+
+        # The target resets the connection while the client is still sending
+        upstream, addr = target.accept()
+        upstream.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                            struct.pack('ii', 1, 0))
+        upstream.close()
+        target.close()
+        client.sendall('ping')
+        time.sleep(0.1)
+        conn.pipes[0]._readable()
+
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.fwd.connections, set())
+        self.loop.run_once(0)
+        self.assertEqual(self.received(client, ''), '')
+
+    def test_out_of_fds(self):
+        client = self.connect(self.port)
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        # Every fd from the lowest free one up is out of bounds
+        free = os.dup(0)
+        os.close(free)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (free, limits[1]))
+        try:
+            self.loop.run_once(0.5)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+
+        self.assertEqual(self.fwd.accept_errors, 1)
+        self.assertEqual(self.fwd.accepted, 0)
+        # Accepted once the pause is over
+        client.sendall('ping')
+        self.assertEqual(self.received(client, 'ping'), 'ping')
+        self.assertEqual(self.fwd.accepted, 1)
+
+class TestManagerForward(ForwardTestCase):
+
+    manager = TunnelManager
+
+    def setUp(self):
+        ForwardTestCase.setUp(self)
+        self.tm = self.manager()
+        self.tm.loop = self.loop
+        self.t = ForwardTunnel(0, '127.0.0.1', self.echo.port, name='echo')
+        self.tm.tunnels = [self.t]
+
+    def tearDown(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        close_tunnels(self.tm.tunnels)
+        ForwardTestCase.tearDown(self)
+
+    def test_lifecycle(self):
+        self.tm.start_tunnels()
+
+        self.assertEqual(self.t.state, READY)
+        self.assertTrue(self.t.proc is None)
+        self.assertEqual(self.tm.status(), ['[echo] running'])
+
+        client = self.connect(self.t.forwarder.listen[1])
+        client.sendall('ping')
+        self.assertEqual(self.received(client, 'ping'), 'ping')
+
+        self.t.close()
+        self.assertEqual(self.t.state, STOPPED)
+        self.assertEqual(self.t.forwarder.connections, set())
+
+        self.tm.continue_tunnels()
+        self.assertTrue(self.t.is_running())
+
+    def test_port_in_use(self):
+        taken = _listener()
+        self.addCleanup(taken.close)
+        bad = ForwardTunnel(taken.getsockname()[1], '127.0.0.1',
+                            self.echo.port, name='taken')
+        self.tm.tunnels = [bad, self.t]
+
+        self.tm.start_tunnels()
+        self.run_until(lambda: self.tm.startup_report)
+        self.assertEqual(self.tm.startup_report.failed, ['taken'])
+        self.assertFalse(bad.is_running())
+        self.assertTrue(self.t.is_running())
+
+        # Retried straight away, then backed off
+        self.retry()
+        self.assertEqual(bad.state, BACKING_OFF)
+        self.assertEqual(self.tm.backoffs['taken'].failures, 2)
+        self.assertTrue(self.t.is_running())
+
+    def test_unknown_target(self):
+        bad = ForwardTunnel(0, 'calabar.invalid', 389, name='unknown')
+        self.tm.tunnels = [bad, self.t]
+
+        self.tm.start_tunnels()
+        self.run_until(lambda: self.tm.startup_report)
+        self.assertEqual(self.tm.startup_report.failed, ['unknown'])
+        self.assertTrue(self.t.is_running())
+
+    def retry(self):
+        self.tm.continue_tunnels()
+
+class TestAsyncManagerForward(TestManagerForward):
+
+    manager = AsyncTunnelManager
+
+    def retry(self):
+        self.run_until(lambda: self.tm.backoffs['taken'].failures > 1)
+
+    def test_replace(self):
+        self.tm.start_tunnels()
+        self.run_until(lambda: self.tm.startup_report)
+
+        new = self.tm.replace_tunnel('echo', {
+            'tunnel_type': 'forward', 'listen_port': 0,
+            'target_host': '127.0.0.1', 'target_port': self.echo.port})
+        self.run_until(lambda: new.is_running())
+
+        self.assertEqual(self.t.state, STOPPED)
+        self.assertFalse(self.t.forwarder.is_listening())
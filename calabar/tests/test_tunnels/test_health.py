@@ -0,0 +1,129 @@
+import unittest
+import signal
+import socket
+from ConfigParser import SafeConfigParser
+
+from calabar.tunnels import TunnelManager, get_tunnels
+from calabar.tunnels.base import TunnelBase
+from calabar.tunnels.health import Probe, InvalidProbe, run_probes
+from calabar.tests.test_tunnels import close_tunnels
+
+def _closed_port():
+    """Return a local port that nothing is listening on."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+class TestProbeParsing(unittest.TestCase):
+
+    def test_parse(self):
+        probe = Probe.parse('tcp:10.10.10.10:389')
+
+        self.assertEqual(probe.key, ('tcp', '10.10.10.10', 389))
+
+    def test_invalid_kind(self):
+        self.assertRaises(InvalidProbe, Probe.parse, 'icmp:10.10.10.10:389')
+
+    def test_invalid_format(self):
+        self.assertRaises(InvalidProbe, Probe.parse, 'tcp:10.10.10.10')
+        self.assertRaises(InvalidProbe, Probe.parse, 'tcp:10.10.10.10:ldap')
+
+class TestRunProbes(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.open_port = self.listener.getsockname()[1]
+        self.closed_port = _closed_port()
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_tcp_open(self):
+        probe = Probe('tcp', '127.0.0.1', self.open_port)
+
+        self.assertTrue(run_probes([probe])[probe.key])
+
+    def test_tcp_refused(self):
+        probe = Probe('tcp', '127.0.0.1', self.closed_port)
+
+        self.assertFalse(run_probes([probe])[probe.key])
+
+    def test_reach_refused(self):
+        """
+        A refused connection still proves the host is reachable.
+        """
+        probe = Probe('reach', '127.0.0.1', self.closed_port)
+
+        self.assertTrue(run_probes([probe])[probe.key])
+
+    def test_many_probes(self):
+        probes = [Probe('tcp', '127.0.0.1', self.open_port),
+                  Probe('tcp', '127.0.0.1', self.closed_port),
+                  Probe('reach', '127.0.0.1', self.closed_port)]
+
+        results = run_probes(probes)
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual([results[p.key] for p in probes], [True, False, True])
+
+class TestProbeConfig(unittest.TestCase):
+
+    def test_probe_options(self):
+        conf = SafeConfigParser()
+        sec = 'tunnel:testvpnc'
+        conf.add_section(sec)
+        conf.set(sec, 'tunnel_type', 'vpnc')
+        conf.set(sec, 'conf_file', '/path/to/conf.conf')
+        conf.set(sec, 'ips', '10.10.10.10, 5.5.5.5, 10.20.0.0/16, 10.0.0.1-5')
+        conf.set(sec, 'probes', 'tcp:10.10.10.10:389')
+        conf.set(sec, 'probe_port', '22')
+
+        tun_conf_d = get_tunnels(conf)['testvpnc']
+
+        self.assertEqual(tun_conf_d['probes'], ['tcp:10.10.10.10:389',
+                                                'reach:10.10.10.10:22',
+                                                'reach:5.5.5.5:22'])
+
+    def test_invalid_probe_option(self):
+        conf = SafeConfigParser()
+        sec = 'tunnel:test'
+        conf.add_section(sec)
+        conf.set(sec, 'tunnel_type', 'base')
+        conf.set(sec, 'cmd', 'ls')
+        conf.set(sec, 'executable', 'ls')
+        conf.set(sec, 'probes', 'bogus')
+
+        self.assertRaises(InvalidProbe, get_tunnels, conf)
+
+class TestRecycling(unittest.TestCase):
+
+    def setUp(self):
+        self.executable = 'cal_run_forever'
+        probes = ['tcp:127.0.0.1:%s' % _closed_port()]
+        self.t = TunnelBase([self.executable], self.executable, probes=probes)
+
+        self.tm = TunnelManager()
+        self.tm.tunnels = [self.t]
+        self.tm.probe_failures = 2
+
+    def tearDown(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        close_tunnels(self.tm.tunnels)
+
+    def test_wedged_tunnel_recycled(self):
+        self.tm.start_tunnels()
+        pid = self.t.proc.pid
+
+        self.tm.check_health()
+        self.assertEqual(self.t.failed_probe_rounds, 1)
+        self.assertEqual(self.t.proc.pid, pid)
+
+        self.tm.check_health()
+        self.assertNotEqual(self.t.proc.pid, pid)
+        self.assertTrue(self.t.is_running())
+        self.assertEqual(self.t.failed_probe_rounds, 0)
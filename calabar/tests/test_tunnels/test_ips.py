@@ -0,0 +1,136 @@
+import unittest
+from ConfigParser import SafeConfigParser
+
+from calabar.tunnels import TunnelManager
+from calabar.tunnels.ips import (
+    InvalidAddress,
+    RouteIndex,
+    collapse,
+    int_to_ip,
+    ip_to_int,
+    masklen_to_mask,
+    merge_intervals,
+    parse_range,
+)
+
+def _cidrs(specs):
+    return ['%s/%s' % (int_to_ip(n), l) for n, l in collapse(specs)]
+
+class TestParseRange(unittest.TestCase):
+
+    def test_address(self):
+        n = ip_to_int('10.0.0.1')
+        self.assertEqual(parse_range('10.0.0.1'), (n, n))
+
+    def test_cidr(self):
+        self.assertEqual(parse_range('10.0.0.7/24'),
+                         (ip_to_int('10.0.0.0'), ip_to_int('10.0.0.255')))
+
+    def test_range(self):
+        self.assertEqual(parse_range('10.0.0.5-10.0.1.2'),
+                         (ip_to_int('10.0.0.5'), ip_to_int('10.0.1.2')))
+
+    def test_octet_shorthand(self):
+        self.assertEqual(parse_range('10.0.0.5-20'),
+                         (ip_to_int('10.0.0.5'), ip_to_int('10.0.0.20')))
+
+    def test_invalid(self):
+        for spec in ['10.1', '10.0.0.256', 'foo', '10.0.0.0/33',
+                     '10.0.0.9-10.0.0.1', '10.0.0.1-300', '']:
+            self.assertRaises(InvalidAddress, parse_range, spec)
+
+class TestCollapse(unittest.TestCase):
+
+    def test_mask(self):
+        self.assertEqual(masklen_to_mask(32), '255.255.255.255')
+        self.assertEqual(masklen_to_mask(20), '255.255.240.0')
+        self.assertEqual(masklen_to_mask(0), '0.0.0.0')
+
+    def test_merge(self):
+        self.assertEqual(merge_intervals([(5, 9), (1, 2), (3, 4), (8, 12)]),
+                         [(1, 12)])
+
+    def test_hosts_aggregated(self):
+        hosts = ['10.0.0.%s' % i for i in range(256)]
+
+        self.assertEqual(_cidrs(hosts), ['10.0.0.0/24'])
+
+    def test_range_split(self):
+        self.assertEqual(_cidrs(['10.0.0.1-6']),
+                         ['10.0.0.1/32', '10.0.0.2/31', '10.0.0.4/31',
+                          '10.0.0.6/32'])
+
+    def test_overlap(self):
+        self.assertEqual(_cidrs(['10.0.0.0/25', '10.0.0.128/25', '10.0.0.3']),
+                         ['10.0.0.0/24'])
+
+    def test_everything(self):
+        self.assertEqual(_cidrs(['0.0.0.0/0']), ['0.0.0.0/0'])
+
+    def test_empty(self):
+        self.assertEqual(collapse([]), [])
+
+class TestRouteIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = RouteIndex({
+            'a': ['10.0.0.0/24', '10.0.2.1'],
+            'b': ['10.0.0.128-10.0.1.10'],
+            'c': ['10.0.1.5', '192.168.0.0/16'],
+        })
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup('10.0.0.1'), ['a'])
+        self.assertEqual(self.index.lookup('10.0.0.200'), ['a', 'b'])
+        self.assertEqual(self.index.lookup('10.0.1.5'), ['b', 'c'])
+        self.assertEqual(self.index.lookup('10.0.2.1'), ['a'])
+        self.assertEqual(self.index.lookup('192.168.255.255'), ['c'])
+
+    def test_lookup_unrouted(self):
+        self.assertEqual(self.index.lookup('10.0.2.0'), [])
+        self.assertEqual(self.index.lookup('0.0.0.0'), [])
+        self.assertEqual(self.index.lookup('255.255.255.255'), [])
+
+    def test_conflicts(self):
+        self.assertEqual(self.index.conflicts(), {
+            ('a', 'b'): [(ip_to_int('10.0.0.128'), ip_to_int('10.0.0.255'))],
+            ('b', 'c'): [(ip_to_int('10.0.1.5'), ip_to_int('10.0.1.5'))],
+        })
+
+    def test_own_overlaps_ignored(self):
+        index = RouteIndex({'a': ['10.0.0.0/24', '10.0.0.5']})
+
+        self.assertEqual(index.conflicts(), {})
+        self.assertEqual(len(index), 1)
+
+    def test_many_addresses(self):
+        routes = {}
+        for t in range(20):
+            routes['t%s' % t] = ['10.%s.%s.%s' % (t, i // 256, i % 256)
+                                 for i in range(0, 2000, 2)]
+        index = RouteIndex(routes)
+
+        self.assertEqual(index.conflicts(), {})
+        self.assertEqual(index.lookup('10.7.3.2'), ['t7'])
+        self.assertEqual(index.lookup('10.7.3.3'), [])
+
+class TestManagerRoutes(unittest.TestCase):
+
+    def setUp(self):
+        self.conf = SafeConfigParser()
+        for name, ips in [('a', '10.0.0.0/24'), ('b', '10.0.0.9, 10.1.0.1')]:
+            sec = 'tunnel:%s' % name
+            self.conf.add_section(sec)
+            self.conf.set(sec, 'tunnel_type', 'vpnc')
+            self.conf.set(sec, 'conf_file', '/path/to/%s.conf' % name)
+            self.conf.set(sec, 'ips', ips)
+
+        self.tm = TunnelManager()
+        self.tm.load_tunnels(self.conf)
+
+    def test_conflicts_found_at_load(self):
+        self.assertEqual(self.tm.route_index.conflicts().keys(), [('a', 'b')])
+
+    def test_tunnels_for_ip(self):
+        self.assertEqual([t.name for t in self.tm.tunnels_for_ip('10.1.0.1')],
+                         ['b'])
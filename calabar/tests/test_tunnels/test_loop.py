@@ -0,0 +1,51 @@
+import unittest
+import os
+import time
+
+from calabar.tunnels.loop import EventLoop
+
+class TestEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.calls = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_timers_ordered(self):
+        self.loop.call_later(0.02, self.calls.append, 'second')
+        self.loop.call_soon(self.calls.append, 'first')
+
+        self.loop.run_once()
+        self.loop.run_once()
+
+        self.assertEqual(self.calls, ['first', 'second'])
+
+    def test_cancelled_timer(self):
+        timer = self.loop.call_soon(self.calls.append, 'cancelled')
+        timer.cancel()
+
+        self.loop.run_once(timeout=0)
+
+        self.assertEqual(self.calls, [])
+
+    def test_reader(self):
+        r, w = os.pipe()
+        try:
+            self.loop.add_reader(r, lambda: self.calls.append(os.read(r, 1)))
+            os.write(w, 'x')
+
+            self.loop.run_once(timeout=1)
+
+            self.assertEqual(self.calls, ['x'])
+        finally:
+            self.loop.remove_reader(r)
+            os.close(r)
+            os.close(w)
+
+    def test_idle_timeout(self):
+        start = time.time()
+        self.loop.run_once(timeout=0.05)
+
+        self.assertTrue(time.time() - start >= 0.04)
@@ -0,0 +1,140 @@
+import unittest
+import os
+import resource
+import socket
+
+from calabar.tunnels.loop import EventLoop
+from calabar.tunnels.metrics import Histogram, Metrics, MetricsServer
+
+class TestHistogram(unittest.TestCase):
+
+    def test_cumulative(self):
+        h = Histogram('h', 'Help.', (1, 5))
+        for value in [0.5, 1, 3, 10]:
+            h.observe(value)
+
+        lines = h.render().splitlines()
+
+        self.assertTrue('h_bucket{le="1"} 2' in lines)
+        self.assertTrue('h_bucket{le="5"} 3' in lines)
+        self.assertTrue('h_bucket{le="+Inf"} 4' in lines)
+        self.assertTrue('h_sum 14.5' in lines)
+        self.assertTrue('h_count 4' in lines)
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.m = Metrics()
+
+    def test_tracked_down(self):
+        self.m.track('a')
+
+        self.assertTrue('calabar_tunnel_up{tunnel="a"} 0' in self.m.render())
+
+    def test_lifecycle(self):
+        self.m.started('a', now=100)
+        self.m.exited('a', now=110, exited_at=109.5)
+        self.m.exited('a', now=111)
+        self.m.started('a', now=112)
+
+        lines = self.m.render(now=120).splitlines()
+
+        self.assertTrue('calabar_tunnel_up{tunnel="a"} 1' in lines)
+        self.assertTrue('calabar_tunnel_starts_total{tunnel="a"} 2' in lines)
+        self.assertTrue('calabar_tunnel_restarts_total{tunnel="a"} 1' in lines)
+        self.assertTrue('calabar_tunnel_uptime_seconds{tunnel="a"} 8.000' in lines)
+        self.assertTrue('calabar_exit_detect_seconds_sum 0.5' in lines)
+        self.assertTrue('calabar_restart_seconds_sum 2.0' in lines)
+        self.assertTrue('calabar_restart_seconds_count 1' in lines)
+
+    def test_samples_cached(self):
+        self.m.started('a')
+        self.m.render()
+        samples = self.m.tunnels['a'].samples()
+
+        self.m.render()
+        self.assertTrue(self.m.tunnels['a'].samples() is samples)
+
+        self.m.exited('a')
+        self.assertFalse(self.m.tunnels['a'].samples() is samples)
+
+    def test_families_grouped(self):
+        self.m.started('b')
+        self.m.started('a')
+
+        lines = [l for l in self.m.render().splitlines()
+                 if l.startswith('calabar_tunnel_up{')]
+
+        self.assertEqual(lines, ['calabar_tunnel_up{tunnel="a"} 1',
+                                 'calabar_tunnel_up{tunnel="b"} 1'])
+
+    def test_escaped(self):
+        self.m.started('a"b')
+
+        self.assertTrue('{tunnel="a\\"b"}' in self.m.render())
+
+    def test_removed(self):
+        self.m.started('a')
+        self.m.removed('a')
+        self.m.exited('a')
+
+        self.assertFalse('tunnel="a"' in self.m.render())
+
+class TestMetricsServer(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.server = MetricsServer(lambda: 'calabar_tunnels 0\n', 0)
+        self.server.start(self.loop)
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.close()
+
+    def _get(self, request):
+        client = socket.create_connection(('127.0.0.1', self.server.port))
+        client.sendall(request)
+        client.setblocking(0)
+        response = ''
+        for x in range(100):
+            self.loop.run_once(timeout=0.01)
+            try:
+                data = client.recv(4096)
+            except socket.error:
+                continue
+            if not data:
+                break
+            response += data
+        client.close()
+
+        return response
+
+    def test_metrics(self):
+        response = self._get('GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n')
+
+        self.assertTrue(response.startswith('HTTP/1.0 200 OK\r\n'))
+        self.assertTrue(response.endswith('\r\n\r\ncalabar_tunnels 0\n'))
+        self.assertEqual(self.server._clients, {})
+
+    def test_not_found(self):
+        response = self._get('GET / HTTP/1.1\r\n\r\n')
+
+        self.assertTrue(response.startswith('HTTP/1.0 404'))
+
+    def test_out_of_fds(self):
+        client = socket.create_connection(('127.0.0.1', self.server.port))
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        # Every fd from the lowest free one up is out of bounds
+        free = os.dup(0)
+        os.close(free)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (free, limits[1]))
+        try:
+            self.loop.run_once(timeout=0.5)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+        client.close()
+
+        self.assertTrue(self.server._paused is not None)
+        # Still serving once the pause is over
+        response = self._get('GET /metrics HTTP/1.1\r\n\r\n')
+        self.assertTrue(response.startswith('HTTP/1.0 200 OK\r\n'))
@@ -0,0 +1,184 @@
+import unittest
+import os
+import shutil
+import signal
+import socket
+import stat
+import tempfile
+from ConfigParser import SafeConfigParser
+
+from calabar.tunnels import TunnelManager
+from calabar.tunnels.ports import (
+    InvalidPortRange,
+    PortAllocator,
+    PortBitmap,
+    PortConflict,
+    PortsExhausted,
+    is_bound,
+    parse_port_ranges,
+)
+
+def _never_bound(port, protocol):
+    return False
+
+class TestParse(unittest.TestCase):
+
+    def test_ranges(self):
+        self.assertEqual(parse_port_ranges('20000-20009, 21000'),
+                         [(20000, 20009), (21000, 21000)])
+        self.assertEqual(parse_port_ranges(''), [])
+        self.assertRaises(InvalidPortRange, parse_port_ranges, '20009-20000')
+        self.assertRaises(InvalidPortRange, parse_port_ranges, '0-10')
+        self.assertRaises(InvalidPortRange, parse_port_ranges, 'http')
+
+class TestPortBitmap(unittest.TestCase):
+
+    def test_free_ports(self):
+        taken = PortBitmap()
+        for port in range(16, 26):
+            taken.add(port)
+        taken.discard(20)
+
+        self.assertTrue(17 in taken)
+        self.assertFalse(20 in taken)
+        self.assertEqual(list(taken.free_ports(14, 28)), [14, 15, 20, 26, 27, 28])
+
+class TestIsBound(unittest.TestCase):
+
+    def test_listening(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        port = sock.getsockname()[1]
+        try:
+            self.assertTrue(is_bound(port))
+            self.assertFalse(is_bound(port, 'udp'))
+        finally:
+            sock.close()
+
+class TestPortAllocator(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'ports.json')
+        self.ports = PortAllocator([(20000, 20003)], self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_allocates(self):
+        ports, in_use = self.ports.assign({
+            'a': ('tcp', None), 'b': ('tcp', 20000), 'c': ('udp', None)},
+            check_host=_never_bound)
+
+        self.assertEqual(ports, {'a': 20001, 'b': 20000, 'c': 20000})
+        self.assertEqual(in_use, [])
+        self.assertEqual(self.ports.assignments, {'a': 20001, 'c': 20000})
+
+    def test_conflict(self):
+        self.assertRaises(PortConflict, self.ports.assign, {
+            'a': ('tcp', 3389), 'b': ('tcp', 3389)}, _never_bound)
+        # Different protocols don't conflict
+        self.ports.assign({'a': ('tcp', 53), 'b': ('udp', 53)}, _never_bound)
+
+    def test_skips_bound(self):
+        bound = lambda port, protocol: port in (20000, 20001)
+        ports, in_use = self.ports.assign({'a': ('tcp', None), 'b': ('tcp', 20001)}, bound)
+
+        self.assertEqual(ports['a'], 20002)
+        self.assertEqual(in_use, [('b', 'tcp', 20001)])
+
+    def test_exhausted(self):
+        claims = dict([(name, ('tcp', None)) for name in 'abcde'])
+        self.assertRaises(PortsExhausted, self.ports.assign, claims, _never_bound)
+        self.assertEqual(self.ports.assignments, {})
+
+    def test_persisted(self):
+        self.ports.assign({'a': ('tcp', 20002), 'b': ('tcp', None)}, _never_bound)
+
+        # A new allocator, as after a restart, keeps b's port even though
+        # a is now listed first and the port would be free for it
+        ports = PortAllocator([(20000, 20003)], self.path)
+        assigned, in_use = ports.assign({'a': ('tcp', None), 'b': ('tcp', None)},
+                                        _never_bound)
+        self.assertEqual(assigned['b'], 20000)
+        self.assertEqual(assigned['a'], 20001)
+
+    def test_not_private(self):
+        self.ports.assign({'a': ('tcp', None)}, _never_bound)
+
+        os.chmod(self.path, 0622)
+        self.assertEqual(PortAllocator([], self.path).assignments, {})
+
+        os.chmod(self.path, 0600)
+        self.assertEqual(PortAllocator([], self.path).assignments, {'a': 20000})
+        if os.geteuid() == 0:
+            os.chown(self.path, 65534, 65534)
+            self.assertEqual(PortAllocator([], self.path).assignments, {})
+
+    def test_symlink(self):
+        self.ports.assign({'a': ('tcp', None)}, _never_bound)
+        link = os.path.join(self.dir, 'link.json')
+        os.symlink(self.path, link)
+
+        self.assertEqual(PortAllocator([], link).assignments, {})
+
+    def test_creates_directory(self):
+        path = os.path.join(self.dir, 'run', 'ports.json')
+        PortAllocator([(20000, 20003)], path).assign({'a': ('tcp', None)},
+                                                     _never_bound)
+
+        mode = os.stat(os.path.dirname(path)).st_mode
+        self.assertEqual(stat.S_IMODE(mode), 0700)
+        self.assertEqual(PortAllocator([], path).assignments, {'a': 20000})
+
+    def test_own_ports_not_in_use(self):
+        self.ports.assign({'a': ('tcp', None), 'b': ('tcp', 3389)}, _never_bound)
+
+        # Reloading while our tunnels hold their ports
+        bound = lambda port, protocol: True
+        ports, in_use = self.ports.assign({'a': ('tcp', None), 'b': ('tcp', 3389)}, bound)
+        self.assertEqual(ports['a'], 20000)
+        self.assertEqual(in_use, [])
+
+class TestManagerPorts(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = SafeConfigParser()
+        self.config.add_section('calabar')
+        self.config.set('calabar', 'port_ranges', '20000-20099')
+        self.config.set('calabar', 'port_state_file',
+                        os.path.join(self.dir, 'ports.json'))
+        for name, tun_type in (('ldap', 'forward'), ('dns', 'udp_forward')):
+            section = 'tunnel:%s' % name
+            self.config.add_section(section)
+            self.config.set(section, 'tunnel_type', tun_type)
+            self.config.set(section, 'listen', 'auto')
+            self.config.set(section, 'target', '10.10.250.1:389')
+
+    def tearDown(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        shutil.rmtree(self.dir)
+
+    def test_load(self):
+        tm = TunnelManager()
+        tm.load_tunnels(self.config)
+
+        ldap = tm.get_tunnel('ldap').forwarder.listen
+        self.assertTrue(20000 <= ldap[1] <= 20099)
+        self.assertEqual(ldap[0], '127.0.0.1')
+        self.assertTrue(20000 <= tm.get_tunnel('dns').forwarder.listen[1] <= 20099)
+
+        # Reloading the same config keeps the ports, so nothing changes
+        self.assertEqual(tm.update_tunnels(self.config), ([], [], []))
+
+    def test_conflict_on_reload(self):
+        tm = TunnelManager()
+        tm.load_tunnels(self.config)
+        self.config.set('tunnel:dns', 'tunnel_type', 'forward')
+        self.config.set('tunnel:dns', 'listen', '3389')
+        self.config.set('tunnel:ldap', 'listen', '3389')
+
+        self.assertRaises(PortConflict, tm.update_tunnels, self.config)
+        self.assertEqual(tm.get_tunnel('dns').TUNNEL_TYPE, 'udp_forward')
@@ -0,0 +1,90 @@
+import unittest
+import os
+import signal
+import subprocess
+import time
+
+from calabar.tunnels.procs import ProcessSnapshot, process_start_time
+from calabar.tunnels.base import TunnelBase
+from calabar.tunnels import is_really_running
+
+class TestProcessSnapshot(unittest.TestCase):
+
+    def test_self_running(self):
+        snapshot = ProcessSnapshot()
+
+        self.assertTrue(snapshot.is_running(os.getpid()))
+
+    def test_missing_pid(self):
+        snapshot = ProcessSnapshot()
+        # pid_max can't be reached on linux
+        pid = 2**22 + 1
+
+        self.assertEqual(snapshot.get(pid), None)
+        self.assertFalse(snapshot.is_running(pid))
+
+    def test_lookups_cached(self):
+        snapshot = ProcessSnapshot()
+        info = snapshot.get(os.getpid())
+
+        self.assertTrue(snapshot.get(os.getpid()) is info)
+
+    def test_start_time_matches(self):
+        start_time = process_start_time(os.getpid())
+        snapshot = ProcessSnapshot()
+
+        self.assertNotEqual(start_time, None)
+        self.assertTrue(snapshot.is_running(os.getpid(), start_time))
+
+    def test_reused_pid(self):
+        """
+        A process with the right pid but the wrong start time isn't ours.
+        """
+        snapshot = ProcessSnapshot()
+
+        self.assertFalse(snapshot.is_running(os.getpid(), 'not-a-start-time'))
+
+    def test_zombie_not_running(self):
+        proc = subprocess.Popen(['true'])
+        snapshot = None
+        for x in range(50):
+            snapshot = ProcessSnapshot()
+            info = snapshot.get(proc.pid)
+            if info is None or not info.running:
+                break
+            time.sleep(.05)
+
+        self.assertFalse(snapshot.is_running(proc.pid))
+        self.assertTrue(snapshot.has_exited(proc.pid))
+        proc.wait()
+
+    def test_stopped_not_exited(self):
+        proc = subprocess.Popen(['sleep', '60'])
+        try:
+            os.kill(proc.pid, signal.SIGSTOP)
+            for x in range(50):
+                snapshot = ProcessSnapshot()
+                if not snapshot.is_running(proc.pid):
+                    break
+                time.sleep(.05)
+
+            self.assertFalse(snapshot.is_running(proc.pid))
+            self.assertFalse(snapshot.has_exited(proc.pid))
+            self.assertTrue(snapshot.has_exited(proc.pid, 'not-a-start-time'))
+        finally:
+            proc.kill()
+            proc.wait()
+
+class TestTunnelStartTime(unittest.TestCase):
+
+    def test_pid_reuse_detected(self):
+        t = TunnelBase(['cal_run_forever'], 'cal_run_forever')
+        t.open()
+        try:
+            self.assertTrue(is_really_running(t))
+
+            t.proc_start_time = 'some other process'
+            self.assertFalse(is_really_running(t))
+        finally:
+            t.proc_start_time = None
+            t.close()
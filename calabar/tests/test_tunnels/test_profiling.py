@@ -0,0 +1,112 @@
+import unittest
+import os
+import shutil
+import signal
+import stat
+import tempfile
+from ConfigParser import SafeConfigParser
+
+from calabar.tunnels import TunnelManager
+from calabar.tunnels.profiling import MemorySnapshot, PhaseTimers, Profiler
+
+class TestPhaseTimers(unittest.TestCase):
+
+    def test_add(self):
+        timers = PhaseTimers()
+        timers.add('a', 0.5)
+        timers.add('a', 1.5)
+        timers.add('b', 0.1)
+
+        self.assertEqual(timers.phases['a'], [2, 2.0, 1.5])
+        report = timers.report()
+        self.assertTrue(report[1].startswith('a '))
+        self.assertTrue(report[2].startswith('b '))
+
+class TestMemorySnapshot(unittest.TestCase):
+
+    def test_diff(self):
+        before = MemorySnapshot()
+        kept = [Leaked() for i in range(100)]
+        after = MemorySnapshot()
+
+        rows = dict([(name, (count, change))
+                     for name, count, change in after.diff(before)])
+        self.assertEqual(rows['Leaked'], (100, 100))
+
+class Leaked(object):
+    pass
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.profiler = Profiler(self.dir, ticks=2)
+
+    def tearDown(self):
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+        shutil.rmtree(self.dir)
+
+    def test_profile_window(self):
+        self.profiler.request_profile()
+
+        self.assertEqual(self.profiler.tick(), [])
+        self.assertTrue(self.profiler.is_profiling())
+        self.assertEqual(self.profiler.tick(), [])
+        written = self.profiler.tick()
+
+        self.assertFalse(self.profiler.is_profiling())
+        self.assertEqual([os.path.splitext(p)[1] for p in written],
+                         ['.prof', '.txt'])
+        self.assertTrue('function calls' in open(written[1]).read())
+
+    def test_memory_report(self):
+        first = self.profiler.dump_memory()
+        second = self.profiler.dump_memory()
+
+        self.assertNotEqual(first, second)
+        self.assertTrue('change' in open(second).read())
+
+    def test_signals(self):
+        self.profiler.watch_signals()
+        os.kill(os.getpid(), signal.SIGUSR2)
+        os.kill(os.getpid(), signal.SIGUSR1)
+
+        written = self.profiler.tick()
+
+        self.assertEqual(len(written), 1)
+        self.assertTrue(self.profiler.is_profiling())
+        self.profiler.tick()
+        self.profiler.tick()
+
+    def test_private(self):
+        self.profiler.directory = os.path.join(self.dir, 'profiles')
+        path = self.profiler.dump_memory()
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.profiler.directory).st_mode), 0700)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0600)
+
+    def test_planted_symlink(self):
+        target = os.path.join(self.dir, 'target')
+        open(target, 'w').write('precious')
+        base = os.path.join(self.dir, 'report')
+        os.symlink(target, base + '.txt')
+        self.profiler._report_path = lambda kind: base
+
+        self.profiler.request_memory()
+        self.assertEqual(self.profiler.tick(), [])
+        self.assertEqual(open(target).read(), 'precious')
+
+class TestManagerProfiling(unittest.TestCase):
+
+    def test_options(self):
+        conf = SafeConfigParser()
+        conf.add_section('calabar')
+        conf.set('calabar', 'profile_dir', '/var/tmp/')
+        conf.set('calabar', 'profile_ticks', '3')
+
+        tm = TunnelManager()
+        tm.load_tunnels(conf)
+
+        self.assertEqual(tm.profiler.directory, '/var/tmp/')
+        self.assertEqual(tm.profiler.ticks, 3)
@@ -0,0 +1,68 @@
+import unittest
+import os
+import shutil
+import stat
+import tempfile
+
+from calabar.tunnels.rundir import UnsafePath, private_dir, is_private_file
+
+class TestPrivateDir(unittest.TestCase):
+
+    def setUp(self):
+        self.parent = tempfile.mkdtemp()
+        self.path = os.path.join(self.parent, 'run')
+
+    def tearDown(self):
+        shutil.rmtree(self.parent)
+
+    def test_created(self):
+        self.assertEqual(private_dir(self.path + '/'), self.path)
+
+        mode = os.stat(self.path).st_mode
+        self.assertTrue(stat.S_ISDIR(mode))
+        self.assertEqual(stat.S_IMODE(mode), 0700)
+
+        # Already there
+        self.assertEqual(private_dir(self.path), self.path)
+
+    def test_writable_by_others(self):
+        os.mkdir(self.path)
+        os.chmod(self.path, 0777)
+
+        self.assertRaises(UnsafePath, private_dir, self.path)
+
+    def test_symlink(self):
+        os.mkdir(self.path + '-real', 0700)
+        os.symlink(self.path + '-real', self.path)
+
+        self.assertRaises(UnsafePath, private_dir, self.path)
+        self.assertRaises(UnsafePath, private_dir, self.path + '/')
+
+    def test_not_ours(self):
+        if os.geteuid() != 0:
+            return
+        os.mkdir(self.path, 0700)
+        os.chown(self.path, 65534, 65534)
+
+        self.assertRaises(UnsafePath, private_dir, self.path)
+
+class TestPrivateFile(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        if os.path.lexists(self.path):
+            os.remove(self.path)
+
+    def test_private(self):
+        self.assertTrue(is_private_file(self.path))
+
+    def test_writable_by_others(self):
+        os.chmod(self.path, 0666)
+        self.assertFalse(is_private_file(self.path))
+
+    def test_missing(self):
+        os.remove(self.path)
+        self.assertFalse(is_private_file(self.path))
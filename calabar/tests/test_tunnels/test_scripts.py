@@ -0,0 +1,101 @@
+import unittest
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+from calabar.tunnels.rundir import UnsafePath
+from calabar.tunnels.scripts import ScriptStore, STALE_TEMP_AGE, TEMP_PREFIX
+
+class TestScriptStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = ScriptStore(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_store(self):
+        fpath = self.store.store('#!/bin/sh\n')
+
+        self.assertEqual(os.path.dirname(fpath), self.dir)
+        self.assertEqual(open(fpath).read(), '#!/bin/sh\n')
+        self.assertTrue(os.access(fpath, os.X_OK))
+        self.assertEqual(os.listdir(self.dir), [os.path.basename(fpath)])
+
+    def test_content_addressed(self):
+        self.assertEqual(self.store.store('a'), self.store.store('a'))
+        self.assertNotEqual(self.store.store('a'), self.store.store('b'))
+
+    def test_identical_not_rewritten(self):
+        fpath = self.store.store('a')
+        inode = os.stat(fpath).st_ino
+
+        self.store.store('a')
+
+        self.assertEqual(os.stat(fpath).st_ino, inode)
+
+    def test_corrupt_rewritten(self):
+        fpath = self.store.store('abc')
+        open(fpath, 'w').write('ab')
+
+        self.store.store('abc')
+
+        self.assertEqual(open(fpath).read(), 'abc')
+
+    def test_not_ours_rewritten(self):
+        fpath = self.store.store('abc')
+        os.chmod(fpath, 0777)
+
+        self.store.store('abc')
+
+        self.assertEqual(stat.S_IMODE(os.stat(fpath).st_mode), 0700)
+        if os.geteuid() == 0:
+            os.chown(fpath, 65534, 65534)
+            self.store.store('abc')
+            self.assertEqual(os.stat(fpath).st_uid, 0)
+
+    def test_planted_symlink_replaced(self):
+        target = os.path.join(self.dir, 'target')
+        open(target, 'w').write('abc')
+        os.chmod(target, 0700)
+        fpath = self.store.path_for('abc')
+        os.symlink(target, fpath)
+
+        self.assertEqual(self.store.store('abc'), fpath)
+
+        self.assertFalse(os.path.islink(fpath))
+
+    def test_unsafe_directory(self):
+        os.chmod(self.dir, 0777)
+        self.assertRaises(UnsafePath, self.store.store, 'abc')
+
+    def test_cleanup_missing_directory(self):
+        self.assertEqual(ScriptStore(os.path.join(self.dir, 'nope')).cleanup([]), [])
+
+    def test_cleanup(self):
+        live = self.store.store('live')
+        stale = self.store.store('stale')
+        other = os.path.join(self.dir, 'unrelated')
+        open(other, 'w').close()
+
+        removed = self.store.cleanup([live])
+
+        self.assertEqual(removed, [stale])
+        self.assertTrue(os.path.exists(live))
+        self.assertTrue(os.path.exists(other))
+
+    def test_cleanup_temp_files(self):
+        fresh = os.path.join(self.dir, TEMP_PREFIX + 'fresh')
+        abandoned = os.path.join(self.dir, TEMP_PREFIX + 'abandoned')
+        open(fresh, 'w').close()
+        open(abandoned, 'w').close()
+        old = time.time() - STALE_TEMP_AGE - 1
+        os.utime(abandoned, (old, old))
+
+        self.store.cleanup([])
+
+        self.assertTrue(os.path.exists(fresh))
+        self.assertFalse(os.path.exists(abandoned))
@@ -0,0 +1,250 @@
+import unittest
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+
+from calabar.tunnels.shards import (
+    MessageReader,
+    ShardSupervisor,
+    partition,
+    shard_for,
+    write_message,
+)
+from calabar.tunnels.loop import set_nonblocking
+from calabar.tunnels.scripts import SCRIPT_STORE
+from calabar.tunnels.vpnc import VpncTunnel
+
+EXECUTABLE = 'cal_run_forever'
+
+CONFIG = """
+[calabar]
+probe_interval = 0.1
+summary_interval = 0.1
+port_state_file = %(dir)s/ports.json
+
+[tunnel:a]
+tunnel_type = base
+cmd = %(exe)s
+executable = %(exe)s
+
+[tunnel:b]
+tunnel_type = base
+cmd = %(exe)s
+executable = %(exe)s
+
+[tunnel:c]
+tunnel_type = base
+cmd = %(exe)s
+executable = %(exe)s
+
+[tunnel:d]
+tunnel_type = base
+cmd = %(exe)s
+executable = %(exe)s
+"""
+
+VPNC_CONFIG = """
+[calabar]
+ready_timeout = 0.2
+summary_interval = 0.1
+port_state_file = %(dir)s/ports.json
+
+[vpnc]
+bin = %(exe)s
+"""
+
+VPNC_TUNNEL = """
+[tunnel:%(name)s]
+tunnel_type = vpnc
+conf_file = /etc/calabar/%(name)s.conf
+ips = 10.0.0.%(ip)s
+"""
+
+def _running_tunnels():
+    out = subprocess.Popen(['ps', '-eo', 'args'], stdout=subprocess.PIPE).communicate()[0]
+    return len([l for l in out.splitlines() if 'bin/' + EXECUTABLE in l])
+
+class TestPartition(unittest.TestCase):
+
+    def test_stable(self):
+        tun_confs_d = dict([('tunnel%s' % i, {}) for i in range(100)])
+        parts = partition(tun_confs_d, 4)
+
+        self.assertEqual(sum([len(part) for part in parts]), 100)
+        for shard, part in enumerate(parts):
+            self.assertTrue(part)
+            for name in part:
+                self.assertEqual(shard_for(name, 4), shard)
+
+class TestMessages(unittest.TestCase):
+
+    def setUp(self):
+        # Earlier tests may leave SIGCHLD ignored, which reaps the child
+        # before we can
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    def test_split_reads(self):
+        r, w = os.pipe()
+        set_nonblocking(r)
+        reader = MessageReader(r)
+        try:
+            big = 'x' * 100000
+            pid = os.fork()
+            if pid == 0:
+                os.close(r)
+                write_message(w, ('reload', big))
+                write_message(w, ('status', 1))
+                os._exit(0)
+            os.close(w)
+
+            messages = []
+            closed = False
+            while not closed:
+                got, closed = reader.read()
+                messages += got
+                time.sleep(0.01)
+            os.waitpid(pid, 0)
+
+            self.assertEqual(messages, [('reload', big), ('status', 1)])
+        finally:
+            os.close(r)
+
+class ShardTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.configfile = os.path.join(self.dir, 'calabar.conf')
+        open(self.configfile, 'w').write(self.config() % {
+            'dir': self.dir, 'exe': EXECUTABLE})
+        self.sup = ShardSupervisor(self.configfile, 2)
+
+    def config(self):
+        return CONFIG
+
+    def tearDown(self):
+        if self.sup.procs:
+            self.sup.stop()
+        self.sup.loop.close()
+        for signum in (signal.SIGCHLD, signal.SIGTERM, signal.SIGHUP,
+                       signal.SIGUSR1, signal.SIGUSR2):
+            signal.signal(signum, signal.SIG_DFL)
+        subprocess.call("ps auxww | grep %s | awk '{print $2}' | xargs kill 2>/dev/null" % EXECUTABLE, shell=True)
+        shutil.rmtree(self.dir)
+
+    def run_until(self, cond, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if cond():
+                return
+            self.sup.loop.run_once(0.05)
+        self.fail("Timed out")
+
+    def ready(self):
+        return sum([counts.get('ready', 0) for counts in self.sup.counts.values()])
+
+class TestShardSupervisor(ShardTestCase):
+
+    def test_supervises_in_workers(self):
+        self.sup.start()
+        self.run_until(lambda: self.ready() == 4 and len(self.sup.counts) == 2)
+
+        tunnels = [counts['tunnels'] for shard, counts in sorted(self.sup.counts.items())]
+        self.assertEqual(tunnels, [len(part) for part in self.sup.parts])
+        self.assertEqual(_running_tunnels(), 4)
+        self.assertTrue(self.sup.status()[0].startswith('[worker 0]:'))
+
+    def test_restarts_worker(self):
+        self.sup.start()
+        self.run_until(lambda: self.ready() == 4 and len(self.sup.counts) == 2)
+        pid = self.sup.procs[0].pid
+
+        os.kill(pid, signal.SIGKILL)
+        self.run_until(lambda: 0 in self.sup.procs and self.sup.procs[0].pid != pid)
+        self.run_until(lambda: self.ready() == 4 and len(self.sup.counts) == 2)
+
+        # The dead worker's tunnels went with it rather than running twice
+        self.run_until(lambda: _running_tunnels() == 4)
+
+    def test_stop(self):
+        self.sup.start()
+        self.run_until(lambda: self.ready() == 4 and len(self.sup.counts) == 2)
+
+        self.sup.stop()
+        self.assertEqual(self.sup.procs, {})
+        self.run_until(lambda: _running_tunnels() == 0)
+
+    def test_worker_process_group(self):
+        self.sup.start()
+
+        # Set by the parent, before the worker has necessarily run at all
+        for worker in self.sup.procs.values():
+            self.assertEqual(os.getpgid(worker.pid), worker.pid)
+
+    def test_worker_exits_while_stopping(self):
+        self.sup.start()
+        self.run_until(lambda: self.ready() == 4 and len(self.sup.counts) == 2)
+        pids = [worker.pid for worker in self.sup.procs.values()]
+
+        os.kill(pids[0], signal.SIGKILL)
+        self.sup.stop()
+
+        self.assertEqual(self.sup.procs, {})
+        for pid in pids:
+            self.assertRaises(OSError, os.waitpid, pid, os.WNOHANG)
+        # Its tunnels went with it, and it isn't restarted
+        self.run_until(lambda: _running_tunnels() == 0)
+        end = time.time() + 0.5
+        while time.time() < end:
+            self.sup.loop.run_once(0.05)
+        self.assertEqual(self.sup.procs, {})
+
+    def test_reload(self):
+        self.sup.start()
+        self.run_until(lambda: self.ready() == 4 and len(self.sup.counts) == 2)
+
+        open(self.configfile, 'a').write(
+            "\n[tunnel:e]\ntunnel_type = base\ncmd = %s\nexecutable = %s\n" % (
+                EXECUTABLE, EXECUTABLE))
+        self.sup.reload()
+
+        self.run_until(lambda: self.ready() == 5)
+        self.assertEqual(_running_tunnels(), 5)
+
+class TestShardScripts(ShardTestCase):
+
+    def setUp(self):
+        self.stale = SCRIPT_STORE.store('#!/bin/sh\n# stale\n')
+        ShardTestCase.setUp(self)
+
+    def config(self):
+        # A vpnc tunnel on each worker
+        names = {}
+        for i in range(100):
+            names.setdefault(shard_for('vpn%s' % i, 2), 'vpn%s' % i)
+        self.scripts = []
+        config = VPNC_CONFIG
+        for ip, name in enumerate(sorted(names.values())):
+            config += VPNC_TUNNEL % {'name': name, 'ip': ip}
+            t = VpncTunnel(conf_file=None, ips=['10.0.0.%s' % ip], name=name)
+            self.scripts.append(t.get_split_tunnel_script_fp())
+
+        return config
+
+    def test_workers_keep_each_others_scripts(self):
+        self.sup.start()
+        self.run_until(lambda: len(self.sup.counts) == 2)
+
+        self.assertFalse(os.path.exists(self.stale))
+        for fpath in self.scripts:
+            self.assertTrue(os.path.exists(fpath))
+
+        # Nor does a worker that's restarted
+        pid = self.sup.procs[0].pid
+        self.sup.counts.clear()
+        os.kill(pid, signal.SIGKILL)
+        self.run_until(lambda: 0 in self.sup.counts and self.sup.procs[0].pid != pid)
+        for fpath in self.scripts:
+            self.assertTrue(os.path.exists(fpath))
@@ -0,0 +1,165 @@
+import unittest
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from calabar.tunnels import TunnelManager
+from calabar.tunnels.adoption import AdoptedProcess, TunnelStateFile
+from calabar.tunnels.base import TunnelBase
+from calabar.tunnels.evented import AsyncTunnelManager
+from calabar.tunnels.procs import process_start_time
+from calabar.tunnels.shutdown import Shutdown
+from calabar.tunnels.states import STARTING, STOPPED
+from calabar.tests.test_tunnels import close_tunnels
+
+EXECUTABLE = 'cal_run_forever'
+IGNORE_TERM = ('import signal, time; '
+               'signal.signal(signal.SIGTERM, signal.SIG_IGN); time.sleep(60)')
+
+def _tunnel(name):
+    return TunnelBase([EXECUTABLE], EXECUTABLE, name=name)
+
+def _stubborn(name):
+    """A tunnel whose process ignores SIGTERM."""
+    return TunnelBase(['python', '-c', IGNORE_TERM], sys.executable, name=name)
+
+class ShutdownTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tunnels = []
+        # Keep exit statuses around to be reaped, as calabard does
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    def tearDown(self):
+        close_tunnels(self.tunnels)
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    def start(self, *tunnels):
+        for t in tunnels:
+            t.open()
+        self.tunnels += tunnels
+        if [t for t in tunnels if t.executable == sys.executable]:
+            # Give the stubborn ones time to start ignoring SIGTERM
+            time.sleep(0.5)
+        return list(tunnels)
+
+class TestShutdown(ShutdownTestCase):
+
+    def test_stops_together(self):
+        tunnels = self.start(*[_tunnel('t%s' % i) for i in range(5)])
+        procs = [t.proc for t in tunnels]
+
+        report = Shutdown(tunnels, timeout=5).run()
+
+        self.assertEqual(sorted(report.stopped), ['t0', 't1', 't2', 't3', 't4'])
+        self.assertEqual(report.killed, [])
+        self.assertTrue(report.total < 2)
+        for t, proc in zip(tunnels, procs):
+            self.assertEqual(t.state, STOPPED)
+            self.assertEqual(proc.returncode, -signal.SIGTERM)
+
+    def test_escalates_after_deadline(self):
+        tunnels = self.start(_tunnel('ok'), _stubborn('stuck1'),
+                             _stubborn('stuck2'))
+        stuck = tunnels[1].proc
+
+        report = Shutdown(tunnels, timeout=0.3).run()
+
+        self.assertEqual(sorted(report.killed), ['stuck1', 'stuck2'])
+        self.assertEqual(report.survived, [])
+        self.assertTrue(report.stopped['ok'] < 0.3)
+        self.assertTrue(0.3 <= report.total < 2)
+        self.assertEqual(stuck.returncode, -signal.SIGKILL)
+        self.assertTrue('[stuck1] KILLED after 0.3s' in str(report))
+
+    def test_stopped_processes(self):
+        tunnels = self.start(_tunnel('paused'), _stubborn('stuck'))
+        procs = [t.proc for t in tunnels]
+        for proc in procs:
+            os.kill(proc.pid, signal.SIGSTOP)
+
+        report = Shutdown(tunnels, timeout=0.5).run()
+
+        # Continued to act on SIGTERM, or killed once it didn't
+        self.assertTrue(report.stopped['paused'] < 0.5)
+        self.assertEqual(report.killed, ['stuck'])
+        self.assertEqual(report.survived, [])
+        self.assertEqual([proc.returncode for proc in procs],
+                         [-signal.SIGTERM, -signal.SIGKILL])
+
+    def test_not_running(self):
+        t = _tunnel('never')
+        report = Shutdown([t]).run()
+
+        self.assertEqual(report.stopped, {'never': 0})
+
+    def test_adopted(self):
+        sh = subprocess.Popen(
+            ['sh', '-c', '%s >/dev/null 2>&1 & echo $!' % EXECUTABLE],
+            stdout=subprocess.PIPE)
+        pid = int(sh.communicate()[0])
+        t = _tunnel('adopted')
+        t.proc = AdoptedProcess(pid, process_start_time(pid))
+        t.proc_start_time = t.proc.start_time
+        t.set_state(STARTING)
+        self.tunnels.append(t)
+
+        report = Shutdown([t], timeout=5).run()
+
+        self.assertEqual(report.killed, [])
+        self.assertTrue('adopted' in report.stopped)
+        self.assertEqual(t.proc, None)
+
+class TestStopTunnels(ShutdownTestCase):
+
+    manager = TunnelManager
+
+    def setUp(self):
+        ShutdownTestCase.setUp(self)
+        fd, self.state_file = tempfile.mkstemp()
+        os.close(fd)
+        self.tm = self.manager()
+        self.tm.tunnel_state.path = self.state_file
+
+    def tearDown(self):
+        ShutdownTestCase.tearDown(self)
+        os.remove(self.state_file)
+
+    def test_stop_tunnels(self):
+        self.tm.tunnels = self.start(_tunnel('ok'), _stubborn('stuck'))
+        self.tm.save_state()
+
+        report = self.tm.stop_tunnels(timeout=0.2)
+
+        self.assertEqual(report.killed, ['stuck'])
+        self.assertEqual(len(self.tm.tunnels_in(STOPPED)), 2)
+        self.assertEqual(TunnelStateFile(self.state_file).load(), {})
+
+    def test_stopped_process(self):
+        self.tm.tunnels = self.start(_stubborn('stuck'))
+        proc = self.tm.tunnels[0].proc
+        os.kill(proc.pid, signal.SIGSTOP)
+
+        report = self.tm.stop_tunnels(timeout=0.2)
+
+        self.assertEqual(report.killed, ['stuck'])
+        self.assertEqual(proc.returncode, -signal.SIGKILL)
+        self.assertEqual(self.tm.tunnels[0].state, STOPPED)
+
+class TestAsyncStopTunnels(TestStopTunnels):
+
+    manager = AsyncTunnelManager
+
+    def test_no_restarts(self):
+        self.tm.tunnels = self.start(_tunnel('ok'))
+        self.tm.start_tunnels()
+        self.tm.schedule_restart(self.tm.tunnels[0], 0)
+
+        self.tm.stop_tunnels(timeout=1)
+        self.tm.loop.run_once(0.05)
+
+        self.assertEqual(self.tm.tunnels[0].state, STOPPED)
+        self.assertEqual(self.tm._restart_timers, {})
@@ -0,0 +1,247 @@
+import unittest
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from ConfigParser import SafeConfigParser
+
+from calabar.tunnels import TunnelManager
+from calabar.tunnels.evented import AsyncTunnelManager
+from calabar.tunnels.rundir import UnsafePath
+from calabar.tunnels.ssh import (
+    SshTunnel,
+    InvalidForward,
+    parse_local,
+    parse_remote,
+    SSH_MASTERS,
+)
+from calabar.tunnels.states import READY, STOPPED
+from calabar.tests.test_tunnels import close_tunnels
+
+# Stands in for ssh: a master creates its control socket and waits, while
+# control commands are logged next to the socket
+FAKE_SSH = """#!%s
+import os, signal, socket, sys, time
+
+args = sys.argv[1:]
+path = args[args.index('-S') + 1]
+log = open(path + '.log', 'a')
+if '-O' in args:
+    if not os.path.exists(path):
+        sys.exit(255)
+    log.write('%%s %%s\\n' %% (args[args.index('-O') + 1], args[args.index('-L') + 1]))
+    sys.exit(0)
+
+log.write('master %%s\\n' %% os.getpid())
+log.close()
+def stop(signum, frame):
+    os.remove(path)
+    sys.exit(0)
+signal.signal(signal.SIGTERM, stop)
+sock = socket.socket(socket.AF_UNIX)
+sock.bind(path)
+while True:
+    time.sleep(60)
+""" % sys.executable
+
+class TestParse(unittest.TestCase):
+
+    def test_remote(self):
+        self.assertEqual(parse_remote('root@10.10.251.2:386'), ('root@10.10.251.2', 386))
+        self.assertRaises(InvalidForward, parse_remote, '10.10.251.2')
+        self.assertRaises(InvalidForward, parse_remote, ':386')
+        self.assertRaises(InvalidForward, parse_remote, 'host:http')
+
+    def test_local(self):
+        self.assertEqual(parse_local('387'), ('127.0.0.1', 387))
+        self.assertEqual(parse_local('0.0.0.0:387'), ('0.0.0.0', 387))
+        self.assertRaises(InvalidForward, parse_local, '70000')
+
+    def test_configuration(self):
+        config = SafeConfigParser()
+        config.add_section('ssh')
+        config.set('ssh', 'bin', '/opt/ssh')
+        config.add_section('tunnel:bar')
+        config.set('tunnel:bar', 'tunnel_type', 'ssh')
+        config.set('tunnel:bar', 'from', 'root@10.10.251.2:386')
+        config.set('tunnel:bar', 'to', '127.0.0.1:387')
+
+        tun_conf_d = SshTunnel.parse_configuration(config, 'tunnel:bar')
+
+        self.assertEqual(tun_conf_d['destination'], 'root@10.10.251.2')
+        self.assertEqual(tun_conf_d['remote_port'], 386)
+        self.assertEqual(tun_conf_d['local_port'], 387)
+        self.assertEqual(tun_conf_d['executable'], '/opt/ssh')
+
+        t = SshTunnel(name='bar', **tun_conf_d)
+        self.assertEqual(t.get_forward(), '127.0.0.1:387:localhost:386')
+
+class SshTestCase(unittest.TestCase):
+
+    manager = TunnelManager
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.ssh = os.path.join(self.dir, 'ssh')
+        open(self.ssh, 'w').write(FAKE_SSH)
+        os.chmod(self.ssh, 0700)
+        self.old_dir = SSH_MASTERS.directory
+        SSH_MASTERS.directory = self.dir
+        SSH_MASTERS.masters.clear()
+
+        self.tm = self.manager()
+        self.a = self._tunnel('a', 'root@alpha', 1001)
+        self.b = self._tunnel('b', 'root@alpha', 1002)
+        self.c = self._tunnel('c', 'root@beta', 1003)
+        self.tm.tunnels = [self.a, self.b, self.c]
+
+    def tearDown(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        close_tunnels(self.tm.tunnels)
+        SSH_MASTERS.directory = self.old_dir
+        SSH_MASTERS.masters.clear()
+        shutil.rmtree(self.dir)
+
+    def _tunnel(self, name, destination, port):
+        return SshTunnel(destination, 22, port, executable=self.ssh, name=name)
+
+    def log(self, t):
+        path = t.master.control_path + '.log'
+        if not os.path.exists(path):
+            return []
+        return open(path).read().splitlines()
+
+    def wait_for(self, cond):
+        for x in range(50):
+            if cond():
+                return
+            time.sleep(0.05)
+        self.fail("Timed out")
+
+class TestMultiplexing(SshTestCase):
+
+    def test_shared_connection(self):
+        self.tm.start_tunnels()
+
+        self.assertEqual(self.tm.startup_report.failed, [])
+        self.assertEqual([t.state for t in self.tm.tunnels], [READY] * 3)
+        self.assertTrue(self.a.master is self.b.master)
+        self.assertEqual(self.a.proc.pid, self.b.proc.pid)
+        self.assertNotEqual(self.a.proc.pid, self.c.proc.pid)
+
+        log = self.log(self.a)
+        self.assertEqual(len([l for l in log if l.startswith('master')]), 1)
+        self.assertTrue('forward 127.0.0.1:1001:localhost:22' in log)
+        self.assertTrue('forward 127.0.0.1:1002:localhost:22' in log)
+
+    def test_close_one_forward(self):
+        self.tm.start_tunnels()
+        pid = self.a.proc.pid
+
+        self.a.close()
+
+        self.assertEqual(self.a.state, STOPPED)
+        self.assertTrue('cancel 127.0.0.1:1001:localhost:22' in self.log(self.a))
+        self.assertTrue(self.b.is_running())
+        self.assertEqual(self.b.proc.pid, pid)
+
+        # Reopening reuses the connection
+        self.a.open()
+        self.assertEqual(self.a.proc.pid, pid)
+        self.assertTrue(self.a.forwarded)
+
+    def test_close_last_forward(self):
+        self.tm.start_tunnels()
+        master = self.a.master
+
+        self.a.close()
+        self.b.close()
+
+        self.assertFalse(master.is_running())
+        self.assertFalse(os.path.exists(master.control_path))
+
+    def test_connection_lost(self):
+        self.tm.start_tunnels()
+        pid = self.a.proc.pid
+        # Forget the exits of the control commands
+        self.tm.reap_children()
+
+        os.kill(pid, signal.SIGKILL)
+        self.wait_for(lambda: self.tm._child_exited)
+        reaped = self.tm.reap_children()
+
+        self.assertEqual([p for p, status in reaped], [pid])
+        self.assertEqual(self.a.state, STOPPED)
+        self.assertEqual(self.b.state, STOPPED)
+        self.assertTrue(self.c.is_running())
+
+        self.tm.continue_tunnels()
+        self.assertTrue(self.a.is_running())
+        self.assertEqual(self.a.proc.pid, self.b.proc.pid)
+        self.assertNotEqual(self.a.proc.pid, pid)
+
+class TestControlSocket(SshTestCase):
+
+    def _socket(self, path):
+        sock = socket.socket(socket.AF_UNIX)
+        sock.bind(path)
+        self.addCleanup(sock.close)
+
+    def test_not_ours(self):
+        self.a.open()
+        master = self.a.master
+        self.wait_for(lambda: master.is_connected())
+        os.remove(master.control_path)
+
+        # Anything but a socket that only we can write to is ignored
+        real = os.path.join(self.dir, 'real')
+        self._socket(real)
+        os.symlink(real, master.control_path)
+        self.assertFalse(master.is_connected())
+
+        os.remove(master.control_path)
+        self._socket(master.control_path)
+        os.chmod(master.control_path, 0777)
+        self.assertFalse(master.is_connected())
+
+    def test_planted_symlink(self):
+        master = self.a.master
+        target = os.path.join(self.dir, 'target')
+        os.symlink(target, master.control_path)
+
+        self.tm.start_tunnels()
+
+        self.assertEqual(self.a.state, READY)
+        self.assertFalse(os.path.lexists(target))
+        self.assertFalse(os.path.islink(master.control_path))
+
+    def test_unsafe_directory(self):
+        os.chmod(self.dir, 0777)
+
+        self.assertRaises(UnsafePath, self.a.master.start)
+        self.assertTrue(self.a.master.proc is None)
+
+class TestAsyncMultiplexing(SshTestCase):
+
+    manager = AsyncTunnelManager
+
+    def tearDown(self):
+        SshTestCase.tearDown(self)
+        self.tm.loop.close()
+
+    def test_replace_forward(self):
+        self.tm.start_tunnels()
+        self.wait_for(lambda: self.tm.loop.run_once(0.05) or self.tm.startup_report)
+        pid = self.a.proc.pid
+
+        new = self.tm.replace_tunnel('a', {
+            'tunnel_type': 'ssh', 'destination': 'root@alpha',
+            'remote_port': 22, 'local_port': 1004, 'executable': self.ssh})
+        self.wait_for(lambda: self.tm.loop.run_once(0.05) or new.forwarded)
+
+        self.assertEqual(new.proc.pid, pid)
+        self.assertTrue('forward 127.0.0.1:1004:localhost:22' in self.log(new))
+        self.assertTrue(self.b.is_running())
@@ -0,0 +1,118 @@
+import unittest
+import signal
+import time
+from ConfigParser import SafeConfigParser
+
+from calabar.tunnels import TunnelManager
+from calabar.tunnels.base import TunnelBase
+from calabar.tunnels.startup import StartupPipeline
+from calabar.tunnels.states import STOPPED
+from calabar.tests.test_tunnels import close_tunnels
+
+class SlowTunnel(TunnelBase):
+    """A tunnel that takes ``ready_delay`` seconds to connect."""
+    def __init__(self, ready_delay, *args, **kwargs):
+        self.ready_delay = ready_delay
+        self.opened_at = None
+        super(SlowTunnel, self).__init__(*args, **kwargs)
+
+    def open(self):
+        self.opened_at = time.time()
+        return super(SlowTunnel, self).open()
+
+    def is_ready(self, snapshot=None):
+        return self.is_running(snapshot) and \
+               time.time() - self.opened_at >= self.ready_delay
+
+def _open(t):
+    t.open()
+    return True
+
+class StartupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.executable = 'cal_run_forever'
+        self.tunnels = []
+
+    def tearDown(self):
+        close_tunnels(self.tunnels)
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    def _tunnels(self, count, delay):
+        tunnels = [SlowTunnel(delay, [self.executable], self.executable,
+                              name='slow%s' % i)
+                   for i in range(count)]
+        self.tunnels += tunnels
+
+        return tunnels
+
+class TestStartupPipeline(StartupTestCase):
+
+    def test_concurrent_startup(self):
+        """
+        Startup takes about as long as the slowest tunnel, not the sum of them.
+        """
+        tunnels = self._tunnels(4, 0.2)
+        report = StartupPipeline(tunnels, _open, concurrency=4).run()
+
+        self.assertEqual(len(report.ready), 4)
+        self.assertTrue(report.total < 0.6)
+        for elapsed in report.ready.values():
+            self.assertTrue(elapsed >= 0.2)
+
+    def test_concurrency_limit(self):
+        tunnels = self._tunnels(4, 0.1)
+        report = StartupPipeline(tunnels, _open, concurrency=2).run()
+
+        self.assertEqual(len(report.ready), 4)
+        self.assertTrue(report.total >= 0.2)
+
+    def test_timeout(self):
+        tunnels = self._tunnels(1, 60)
+        report = StartupPipeline(tunnels, _open, timeout=0.1).run()
+
+        self.assertEqual(report.timed_out, ['slow0'])
+        self.assertEqual(report.ready, {})
+
+    def test_failed_launch(self):
+        bad = TunnelBase(['ls'], 'DOESNOTEXIST', name='bad')
+        report = StartupPipeline([bad], lambda t: False).run()
+
+        self.assertEqual(report.failed, ['bad'])
+        self.assertTrue('bad' in str(report))
+
+class TestManagerStartup(StartupTestCase):
+
+    def test_start_report(self):
+        tm = TunnelManager()
+        tm.tunnels = self._tunnels(3, 0)
+
+        report = tm.start_tunnels()
+
+        self.assertTrue(report is tm.startup_report)
+        self.assertEqual(sorted(report.ready.keys()), ['slow0', 'slow1', 'slow2'])
+
+    def test_reaps_while_starting(self):
+        tm = TunnelManager()
+        quitter = TunnelBase(['true'], '/bin/true', name='quitter')
+        self.tunnels.append(quitter)
+        tm.tunnels = [quitter] + self._tunnels(1, 0.3)
+
+        report = tm.start_tunnels()
+
+        self.assertEqual(report.failed, ['quitter'])
+        # Reaped while the slow tunnel was still connecting
+        self.assertEqual(quitter.state, STOPPED)
+        self.assertTrue(quitter.proc is None)
+
+    def test_options(self):
+        conf = SafeConfigParser()
+        conf.add_section('calabar')
+        conf.set('calabar', 'startup_concurrency', '3')
+        conf.set('calabar', 'ready_timeout', '2.5')
+
+        tm = TunnelManager()
+        tm.load_tunnels(conf)
+
+        self.assertEqual(tm.startup_concurrency, 3)
+        self.assertEqual(tm.ready_timeout, 2.5)
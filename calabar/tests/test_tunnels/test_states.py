@@ -0,0 +1,143 @@
+import unittest
+import signal
+import subprocess
+
+from calabar.tunnels import TunnelManager
+from calabar.tunnels.base import TunnelBase
+from calabar.tunnels.health import Probe
+from calabar.tunnels.vpnc import VpncTunnel
+from calabar.tunnels.states import (
+    InvalidTransition,
+    StateIndex,
+    TunnelList,
+    BACKING_OFF,
+    DEGRADED,
+    READY,
+    STARTING,
+    STOPPED,
+    STOPPING,
+)
+
+def _tunnel(name='a'):
+    return TunnelBase(['cal_run_forever'], 'cal_run_forever', name=name)
+
+class TestTransitions(unittest.TestCase):
+
+    def test_valid(self):
+        t = _tunnel()
+        self.assertEqual(t.state, STOPPED)
+
+        self.assertTrue(t.set_state(STARTING, now=10))
+        self.assertEqual(t.state_since, 10)
+        self.assertTrue(t.opening)
+        t.set_state(READY)
+        t.set_state(DEGRADED)
+        t.set_state(STOPPING)
+        self.assertTrue(t.closing)
+        t.set_state(STOPPED)
+        t.set_state(BACKING_OFF)
+
+    def test_same_state(self):
+        t = _tunnel()
+        t.set_state(STARTING, now=10)
+
+        self.assertFalse(t.set_state(STARTING, now=20))
+        self.assertEqual(t.state_since, 10)
+
+    def test_invalid(self):
+        t = _tunnel()
+
+        self.assertRaises(InvalidTransition, t.set_state, READY)
+        t.set_state(STARTING)
+        t.set_state(STOPPING)
+        self.assertRaises(InvalidTransition, t.set_state, STARTING)
+        self.assertEqual(t.state, STOPPING)
+
+    def test_slots(self):
+        self.assertFalse(hasattr(_tunnel(), '__dict__'))
+        t = VpncTunnel('/path/to/conf.conf', name='v')
+        self.assertFalse(hasattr(t, '__dict__'))
+
+class TestStateIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = StateIndex()
+        self.a = _tunnel('a')
+        self.b = _tunnel('b')
+        self.tunnels = TunnelList(self.index, [self.a])
+
+    def test_follows_state(self):
+        self.a.set_state(STARTING)
+
+        self.assertEqual(self.index.tunnels(STARTING), [self.a])
+        self.assertEqual(self.index.tunnels(STOPPED), [])
+        self.assertEqual(self.index.counts()[STARTING], 1)
+
+    def test_list_changes(self):
+        self.tunnels.append(self.b)
+        self.assertEqual(len(self.index.tunnels(STOPPED)), 2)
+
+        self.tunnels[0] = _tunnel('c')
+        self.assertTrue(self.a.state_index is None)
+        self.a.set_state(STARTING)
+        self.assertEqual(self.index.tunnels(STARTING), [])
+
+        self.tunnels.remove(self.b)
+        self.assertEqual(len(self.index.tunnels(STOPPED)), 1)
+
+    def test_slices_refused(self):
+        self.assertRaises(TypeError, self.tunnels.__setslice__, 0, 1, [self.b])
+
+class TestManagerStates(unittest.TestCase):
+
+    def setUp(self):
+        self.t = _tunnel()
+        self.tm = TunnelManager()
+        self.tm.tunnels = [self.t]
+
+    def tearDown(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        try:
+            subprocess.call("ps auxww | grep cal_run_forever | awk '{print $2}' | xargs kill", shell=True)
+        except OSError:
+            pass
+
+    def test_lifecycle(self):
+        self.assertEqual(self.tm.tunnels_in(STOPPED), [self.t])
+
+        self.tm.start_tunnels()
+        self.assertEqual(self.tm.tunnels_in(READY), [self.t])
+
+        self.t.close()
+        self.assertEqual(self.tm.tunnels_in(STOPPED), [self.t])
+
+        self.tm.continue_tunnels()
+        self.assertEqual(self.tm.tunnels_in(STARTING, READY), [self.t])
+
+    def test_backing_off(self):
+        self.tm.backoff_base = 60
+        self.tm.start_tunnels()
+        self.t.close()
+        self.tm.continue_tunnels()
+        self.t.close()
+        self.tm.continue_tunnels()
+
+        self.assertEqual(self.tm.tunnels_in(BACKING_OFF), [self.t])
+        self.assertFalse(self.t.is_running())
+
+    def test_degraded(self):
+        self.tm.probe_failures = 2
+        self.t.probes = [Probe.parse('tcp:127.0.0.1:1')]
+        self.tm.start_tunnels()
+
+        self.tm._handle_probe_results([self.t], {})
+        self.assertEqual(self.t.state, DEGRADED)
+
+        self.tm._handle_probe_results([self.t], {self.t.probes[0].key: True})
+        self.assertEqual(self.t.state, READY)
+
+    def test_removed(self):
+        self.tm.tunnels = []
+
+        self.assertEqual(self.tm.tunnels_in(STOPPED), [])
+        self.assertTrue(self.t.state_index is None)
@@ -3,10 +3,14 @@ import os
 import subprocess
 import time
 import signal
+import shutil
+import tempfile
 from ConfigParser import SafeConfigParser
 
 from calabar.tunnels import TunnelManager, TunnelsAlreadyLoadedException, ExecutableNotFound, is_really_running
+from calabar.tunnels import base
 from calabar.tunnels.base import TunnelBase, which
+from calabar.tunnels.scripts import SCRIPT_STORE
 
 
 
@@ -111,8 +115,8 @@ class TestVpncParser(unittest.TestCase):
         for expected_arg in expected_cmd:
             self.assertTrue(expected_arg in t.cmd)
 
-        # Now check the last arg and make sure it's to /tmp/...
-        self.assertTrue(t.cmd[-1].startswith('/tmp/'))
+        # Now check the last arg and make sure it's to the script store
+        self.assertTrue(t.cmd[-1].startswith(SCRIPT_STORE.directory))
 
 
     def test_executable(self):
@@ -291,4 +295,126 @@ def _wait_for_condition(cond, msg):
 def test_which_fs():
     which_path = which('/bin/ls')
 
-    assert which_path == '/bin/ls'
\ No newline at end of file
+    assert which_path == '/bin/ls'
+
+class TestWhichCache(unittest.TestCase):
+
+    def setUp(self):
+        self.bin_dir = tempfile.mkdtemp()
+        self.exe = os.path.join(self.bin_dir, 'cal_test_exe')
+        self._write_exe()
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = os.pathsep.join([self.bin_dir, self.old_path])
+
+    def tearDown(self):
+        os.environ['PATH'] = self.old_path
+        shutil.rmtree(self.bin_dir)
+
+    def _write_exe(self):
+        f = open(self.exe, 'w')
+        f.write('#!/bin/sh\n')
+        f.close()
+        os.chmod(self.exe, 0755)
+
+    def test_cached(self):
+        self.assertEqual(which('cal_test_exe'), self.exe)
+        self.assertTrue(('cal_test_exe', os.environ['PATH']) in base._which_cache)
+        self.assertEqual(which('cal_test_exe'), self.exe)
+
+    def test_removed(self):
+        which('cal_test_exe')
+        os.remove(self.exe)
+
+        self.assertEqual(which('cal_test_exe'), None)
+
+    def test_chmod(self):
+        which('cal_test_exe')
+        os.chmod(self.exe, 0644)
+
+        self.assertEqual(which('cal_test_exe'), None)
+
+    def test_path_changed(self):
+        which('cal_test_exe')
+        os.environ['PATH'] = self.old_path
+
+        self.assertEqual(which('cal_test_exe'), None)
+
+class TestMissingExecutables(unittest.TestCase):
+
+    def setUp(self):
+        self.conf = SafeConfigParser()
+        for name, executable in [('a', 'DOESNOTEXIST'), ('b', 'DOESNOTEXIST'),
+                                 ('c', 'ALSOMISSING'), ('d', 'ls')]:
+            sec = 'tunnel:%s' % name
+            self.conf.add_section(sec)
+            self.conf.set(sec, 'tunnel_type', 'base')
+            self.conf.set(sec, 'cmd', executable)
+            self.conf.set(sec, 'executable', executable)
+
+        self.tm = TunnelManager()
+
+    def test_reported_at_load(self):
+        self.tm.load_tunnels(self.conf)
+
+        self.assertEqual(self.tm.missing_executables,
+                         {'DOESNOTEXIST': ['a', 'b'], 'ALSOMISSING': ['c']})
+
+    def test_open_still_fails(self):
+        self.tm.load_tunnels(self.conf)
+
+        self.assertFalse(self.tm._open_tunnel(self.tm.get_tunnel('a')))
+
+
+class RecordingTunnel(TunnelBase):
+    def handle_closed(self, exit_status):
+        self.exit_status = exit_status
+        super(RecordingTunnel, self).handle_closed(exit_status)
+
+class TestReaping(TearDownRunForever):
+
+    def setUp(self):
+        self.executable = 'cal_run_forever'
+        self.tunnels = [RecordingTunnel([self.executable], self.executable,
+                                        name='t%s' % i)
+                        for i in range(3)]
+
+        self.tm = TunnelManager()
+        self.tm.tunnels = list(self.tunnels)
+        self.tm.start_tunnels()
+
+    def test_mass_exit_reaped(self):
+        """
+        Several tunnels exiting together are all reaped and each gets its own
+        exit status even though their SIGCHLDs coalesce.
+        """
+        sigs = [signal.SIGKILL, signal.SIGTERM, signal.SIGHUP]
+        pids = [t.proc.pid for t in self.tunnels]
+        for t, sig in zip(self.tunnels, sigs):
+            os.kill(t.proc.pid, sig)
+
+        reaped = set()
+        for x in range(20):
+            reaped.update([pid for pid, status in self.tm.reap_children()])
+            if reaped.issuperset(pids):
+                break
+            time.sleep(.05)
+
+        self.assertTrue(reaped.issuperset(pids))
+        for t, sig in zip(self.tunnels, sigs):
+            self.assertEqual(os.WTERMSIG(t.exit_status), sig)
+            self.assertEqual(t.proc, None)
+
+    def test_handler_only_queues(self):
+        pid = self.tunnels[0].proc.pid
+        os.kill(pid, signal.SIGKILL)
+        _wait_for_condition(
+            lambda: self.tm._child_exited and not is_really_running(self.tunnels[0]),
+            "No SIGCHLD")
+
+        # Nothing has been reaped by the handler itself
+        self.assertTrue(self.tunnels[0].proc is not None)
+
+        self.tm.continue_tunnels()
+        self.assertFalse(self.tm._child_exited)
+        self.assertNotEqual(self.tunnels[0].proc.pid, pid)
+        self.assertTrue(self.tunnels[0].is_running())
@@ -0,0 +1,232 @@
+import unittest
+import os
+import resource
+import signal
+import socket
+import time
+from ConfigParser import SafeConfigParser
+
+from calabar.tunnels import TunnelManager, parse_tunnel
+from calabar.tunnels.loop import EventLoop
+from calabar.tunnels.states import BACKING_OFF, READY, STOPPED
+from calabar.tunnels.udp import UdpForwarder, UdpForwardTunnel
+from calabar.tests.test_tunnels import close_tunnels
+
+def _udp_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.setblocking(0)
+    return sock
+
+class UdpEchoServer(object):
+    """
+    Echoes datagrams back to their sender, on the same loop as the forwarder.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.sock = _udp_socket()
+        self.port = self.sock.getsockname()[1]
+        self.senders = set()
+        loop.add_reader(self.sock.fileno(), self._echo)
+
+    def _echo(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except socket.error:
+                return
+            self.senders.add(addr)
+            self.sock.sendto(data, addr)
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+class TestConfiguration(unittest.TestCase):
+
+    def test_parse(self):
+        config = SafeConfigParser()
+        config.add_section('tunnel:dns')
+        config.set('tunnel:dns', 'tunnel_type', 'udp_forward')
+        config.set('tunnel:dns', 'listen', '5353')
+        config.set('tunnel:dns', 'target', '10.10.250.1:53')
+        config.set('tunnel:dns', 'max_sessions', '10')
+        config.set('tunnel:dns', 'idle_timeout', '5')
+
+        tun_conf_d = parse_tunnel(config, 'tunnel:dns')
+        t = UdpForwardTunnel(name='dns', **tun_conf_d)
+
+        self.assertEqual(t.TUNNEL_TYPE, 'udp_forward')
+        self.assertEqual(t.forwarder.listen, ('127.0.0.1', 5353))
+        self.assertEqual(t.forwarder.target, ('10.10.250.1', 53))
+        self.assertEqual(t.forwarder.max_sessions, 10)
+        self.assertEqual(t.forwarder.idle_timeout, 5)
+        self.assertFalse(hasattr(t, '__dict__'))
+
+class UdpTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.echo = UdpEchoServer(self.loop)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.echo.close()
+        self.loop.close()
+
+    def client(self):
+        client = _udp_socket()
+        self.clients.append(client)
+        return client
+
+    def run_until(self, cond):
+        for x in range(100):
+            if cond():
+                return
+            self.loop.run_once(0.02)
+        self.fail("Timed out")
+
+    def replies(self, client, count):
+        """Pump the loop until ``client`` has received ``count`` datagrams."""
+        got = []
+        def done():
+            while True:
+                try:
+                    got.append(client.recv(65535))
+                except socket.error:
+                    return len(got) >= count
+        self.run_until(done)
+        return got
+
+class TestUdpForwarder(UdpTestCase):
+
+    def setUp(self):
+        UdpTestCase.setUp(self)
+        self.fwd = UdpForwarder(('127.0.0.1', 0), ('127.0.0.1', self.echo.port),
+                                max_sessions=2, idle_timeout=60, batch=4)
+        self.fwd.start(self.loop)
+        self.addr = self.fwd.listen
+
+    def tearDown(self):
+        self.fwd.stop()
+        UdpTestCase.tearDown(self)
+
+    def test_sessions(self):
+        a = self.client()
+        b = self.client()
+        a.sendto('from a', self.addr)
+        b.sendto('from b', self.addr)
+
+        self.assertEqual(self.replies(a, 1), ['from a'])
+        self.assertEqual(self.replies(b, 1), ['from b'])
+        self.assertEqual(len(self.fwd.sessions), 2)
+        # Each client reaches the target from its own session's socket
+        self.assertEqual(len(self.echo.senders), 2)
+        self.assertEqual(self.fwd.bytes_in, 12)
+        self.assertEqual(self.fwd.bytes_out, 12)
+
+    def test_batched(self):
+        a = self.client()
+        for i in range(10):
+            a.sendto(str(i), self.addr)
+
+        # More datagrams than a batch just take a few wakeups
+        self.assertEqual(sorted(self.replies(a, 10)), [str(i) for i in range(10)])
+        self.assertEqual(self.fwd.accepted, 1)
+
+    def test_session_limit(self):
+        for i in range(3):
+            self.client().sendto('hi', self.addr)
+        self.run_until(lambda: self.fwd.refused)
+
+        self.assertEqual(len(self.fwd.sessions), 2)
+
+    def test_idle_expiry(self):
+        self.fwd.idle_timeout = 0.1
+        a = self.client()
+        a.sendto('hi', self.addr)
+        self.replies(a, 1)
+
+        time.sleep(0.1)
+        self.run_until(lambda: not self.fwd.sessions)
+
+        # A later datagram starts a new session
+        a.sendto('again', self.addr)
+        self.assertEqual(self.replies(a, 1), ['again'])
+        self.assertEqual(self.fwd.accepted, 2)
+
+    def test_out_of_fds(self):
+        a = self.client()
+        a.sendto('lost', self.addr)
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        # Every fd from the lowest free one up is out of bounds
+        free = os.dup(0)
+        os.close(free)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (free, limits[1]))
+        try:
+            self.loop.run_once(0.5)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+
+        self.assertEqual(self.fwd.refused, 1)
+        self.assertEqual(self.fwd.sessions, {})
+        # Nothing leaked
+        self.assertEqual(os.dup(0), free)
+        os.close(free)
+
+        a.sendto('again', self.addr)
+        self.assertEqual(self.replies(a, 1), ['again'])
+
+class TestManagerUdpForward(UdpTestCase):
+
+    def setUp(self):
+        UdpTestCase.setUp(self)
+        self.tm = TunnelManager()
+        self.tm.loop = self.loop
+        self.t = UdpForwardTunnel(0, '127.0.0.1', self.echo.port, name='dns')
+        self.tm.tunnels = [self.t]
+
+    def tearDown(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        close_tunnels(self.tm.tunnels)
+        UdpTestCase.tearDown(self)
+
+    def test_lifecycle(self):
+        self.tm.start_tunnels()
+        self.assertEqual(self.t.state, READY)
+
+        a = self.client()
+        a.sendto('hi', self.t.forwarder.listen)
+        self.assertEqual(self.replies(a, 1), ['hi'])
+
+        self.t.close()
+        self.assertEqual(self.t.state, STOPPED)
+        self.assertEqual(self.t.forwarder.sessions, {})
+
+        self.tm.continue_tunnels()
+        self.assertTrue(self.t.is_running())
+
+    def test_port_in_use(self):
+        taken = self.client()
+        bad = UdpForwardTunnel(taken.getsockname()[1], '127.0.0.1',
+                               self.echo.port, name='taken')
+        self.tm.tunnels = [bad, self.t]
+
+        self.tm.start_tunnels()
+        self.assertEqual(self.tm.startup_report.failed, ['taken'])
+        self.assertFalse(bad.is_running())
+        self.assertTrue(self.t.is_running())
+
+        self.tm.continue_tunnels()
+        self.assertEqual(bad.state, BACKING_OFF)
+        self.assertTrue(self.t.is_running())
+
+    def test_unknown_target(self):
+        bad = UdpForwardTunnel(0, 'calabar.invalid', 53, name='unknown')
+        self.tm.tunnels = [bad, self.t]
+
+        self.tm.start_tunnels()
+        self.assertEqual(self.tm.startup_report.failed, ['unknown'])
+        self.assertTrue(self.t.is_running())
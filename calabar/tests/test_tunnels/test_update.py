@@ -0,0 +1,160 @@
+import unittest
+import os
+import signal
+import tempfile
+import time
+from ConfigParser import SafeConfigParser
+
+from calabar.tunnels import (
+    TunnelManager,
+    TunnelNotFound,
+    DuplicateTunnel,
+    config_hash,
+    get_tunnels,
+)
+from calabar.tunnels.evented import AsyncTunnelManager
+from calabar.tunnels.loop import EventLoop
+from calabar.tests.test_tunnels import close_tunnels
+
+EXECUTABLE = 'cal_run_forever'
+
+def _config(tunnels):
+    """
+    Build a config from a dictionary of tunnel name to the extra argument
+    passed to cal_run_forever, which is enough to change its config hash.
+    """
+    conf = SafeConfigParser()
+    for name, arg in tunnels.items():
+        sec = 'tunnel:%s' % name
+        conf.add_section(sec)
+        conf.set(sec, 'tunnel_type', 'base')
+        conf.set(sec, 'cmd', '%s %s' % (EXECUTABLE, arg))
+        conf.set(sec, 'executable', EXECUTABLE)
+
+    return conf
+
+class UpdateTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        close_tunnels(self.tm.tunnels)
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+class TestConfigHash(unittest.TestCase):
+
+    def test_stable(self):
+        confs = get_tunnels(_config({'a': '1'}))
+        confs_again = get_tunnels(_config({'a': '1'}))
+
+        self.assertEqual(config_hash(confs['a']), config_hash(confs_again['a']))
+
+    def test_changes(self):
+        confs = get_tunnels(_config({'a': '1'}))
+        changed = get_tunnels(_config({'a': '2'}))
+
+        self.assertNotEqual(config_hash(confs['a']), config_hash(changed['a']))
+
+class TestUpdateTunnels(UpdateTestCase):
+
+    def setUp(self):
+        self.tm = TunnelManager()
+        self.tm.load_tunnels(_config({'a': '1', 'b': '1', 'c': '1'}))
+        self.tm.start_tunnels()
+
+    def test_diff(self):
+        a, b, c = [self.tm.get_tunnel(name) for name in 'abc']
+        a_proc, b_pid, c_pid = a.proc, b.proc.pid, c.proc.pid
+
+        result = self.tm.update_tunnels(
+            _config({'b': '2', 'c': '1', 'd': '1'}))
+
+        self.assertEqual(result, (['d'], ['a'], ['b']))
+        self.assertEqual(sorted([t.name for t in self.tm.tunnels]),
+                         ['b', 'c', 'd'])
+        # Untouched
+        self.assertEqual(self.tm.get_tunnel('c').proc.pid, c_pid)
+        # Removed
+        self.assertNotEqual(a_proc.returncode, None)
+        # Restarted with its new config
+        new_b = self.tm.get_tunnel('b')
+        self.assertNotEqual(new_b.proc.pid, b_pid)
+        self.assertEqual(new_b.cmd, [EXECUTABLE, '2'])
+        # Added
+        self.assertTrue(self.tm.get_tunnel('d').is_running())
+
+    def test_no_changes(self):
+        pids = [t.proc.pid for t in self.tm.tunnels]
+
+        result = self.tm.update_tunnels(_config({'a': '1', 'b': '1', 'c': '1'}))
+
+        self.assertEqual(result, ([], [], []))
+        self.assertEqual([t.proc.pid for t in self.tm.tunnels], pids)
+
+    def test_missing(self):
+        self.assertRaises(TunnelNotFound, self.tm.remove_tunnel, 'nope')
+
+    def test_duplicate(self):
+        tun_conf_d = get_tunnels(_config({'a': '1'}))['a']
+
+        self.assertRaises(DuplicateTunnel, self.tm.add_tunnel, 'a', tun_conf_d)
+
+class TestReloadOnSighup(UpdateTestCase):
+
+    def setUp(self):
+        fd, self.configfile = tempfile.mkstemp()
+        os.close(fd)
+        self._write_config({'a': '1'})
+
+        self.tm = TunnelManager()
+        self.tm.watch_config(self.configfile)
+        self.tm.load_tunnels(_config({'a': '1'}))
+        self.tm.start_tunnels()
+
+    def tearDown(self):
+        os.remove(self.configfile)
+        super(TestReloadOnSighup, self).tearDown()
+
+    def _write_config(self, tunnels):
+        f = open(self.configfile, 'w')
+        try:
+            _config(tunnels).write(f)
+        finally:
+            f.close()
+
+    def test_sighup(self):
+        self._write_config({'a': '1', 'b': '1'})
+
+        os.kill(os.getpid(), signal.SIGHUP)
+        self.tm.continue_tunnels()
+
+        self.assertTrue(self.tm.get_tunnel('b').is_running())
+
+    def test_bad_config_ignored(self):
+        f = open(self.configfile, 'a')
+        f.write('[tunnel:bad]\ntunnel_type = INVALID\n')
+        f.close()
+
+        os.kill(os.getpid(), signal.SIGHUP)
+        self.tm.continue_tunnels()
+
+        self.assertEqual([t.name for t in self.tm.tunnels], ['a'])
+
+class TestAsyncReplace(UpdateTestCase):
+
+    def test_replace_after_close(self):
+        self.tm = tm = AsyncTunnelManager(EventLoop())
+        tm.load_tunnels(_config({'a': '1'}))
+        tm.start_tunnels()
+        old = tm.get_tunnel('a')
+        old_pid = old.proc.pid
+
+        tm.update_tunnels(_config({'a': '2'}))
+        new = tm.get_tunnel('a')
+        start = time.time()
+        while time.time() - start < 2 and not new.is_running():
+            tm.loop.run_once(timeout=0.05)
+        tm.loop.close()
+
+        self.assertTrue(new.is_running())
+        self.assertNotEqual(new.proc.pid, old_pid)
+        self.assertEqual(old.proc, None)
@@ -1,9 +1,13 @@
 import unittest
 import os
+import shutil
+import stat
+import tempfile
 from ConfigParser import SafeConfigParser
 
-from calabar.tunnels.vpnc import VpncTunnel
-from calabar.tunnels import TunnelTypeDoesNotMatch
+from calabar.tunnels.vpnc import VpncTunnel, InvalidTunnelName
+from calabar.tunnels import ExecutableNotFound, TunnelTypeDoesNotMatch
+from calabar.tunnels.ips import InvalidAddress
 
 class TestDefaultTunnelConf(unittest.TestCase):
     def setUp(self):
@@ -78,6 +82,28 @@ class TestSplitTunneling(unittest.TestCase):
         self.assertEqual(contents.count('add_ip 192.168.3.50'), 1)
         self.assertEqual(contents.count('add_ip 8.8.8.8'), 1)
 
+    def test_single_ip_mask(self):
+        self.cp.set(self.sec, 'ips', '192.168.3.50')
+
+        t = VpncTunnel(**VpncTunnel.parse_configuration(self.cp, self.sec))
+
+        self.assertTrue('add_ip 192.168.3.50 255.255.255.255 32 ' in t._tun_script)
+
+    def test_cidr_aggregated(self):
+        self.cp.set(self.sec, 'ips', '10.1.0.0/24, 10.1.1.0-10.1.1.255, 10.1.0.9')
+
+        t = VpncTunnel(**VpncTunnel.parse_configuration(self.cp, self.sec))
+
+        contents = t._tun_script
+        self.assertEqual(contents.count('add_ip 10.'), 1)
+        self.assertTrue('add_ip 10.1.0.0 255.255.254.0 23 ' in contents)
+
+    def test_invalid_ip(self):
+        self.cp.set(self.sec, 'ips', '10.1.0.0/40')
+
+        self.assertRaises(InvalidAddress, VpncTunnel.parse_configuration,
+                          self.cp, self.sec)
+
     def test_file_exists(self):
         tun_conf_d = VpncTunnel.parse_configuration(self.cp, self.sec)
         t = VpncTunnel(**tun_conf_d)
@@ -97,3 +123,78 @@ class TestInvalidConf(unittest.TestCase):
     def test_invalid_type(self):
         self.assertRaises(TunnelTypeDoesNotMatch, VpncTunnel,
                           *[None], **{'tunnel_type':'invalid'})
+
+class TestReadiness(unittest.TestCase):
+
+    def setUp(self):
+        self.t = VpncTunnel(conf_file=None, name='readytest')
+
+    def test_ready_env(self):
+        env = self.t._open_env()
+
+        self.assertEqual(env['CALABAR_READY_FILE'], self.t.get_ready_fp())
+
+    def test_not_ready_when_stopped(self):
+        open(self.t.get_ready_fp(), 'w').close()
+        try:
+            self.assertFalse(self.t.is_ready())
+        finally:
+            os.remove(self.t.get_ready_fp())
+
+    def test_script_signals_ready(self):
+        self.assertTrue('CALABAR_READY_FILE' in self.t._tun_script)
+
+    def test_private_ready_dir(self):
+        parent = tempfile.mkdtemp()
+        ready_dir, VpncTunnel.READY_DIR = VpncTunnel.READY_DIR, \
+            os.path.join(parent, 'run')
+        try:
+            t = VpncTunnel(conf_file=None, executable='DOESNOTEXIST',
+                           name='readytest')
+            self.assertRaises(ExecutableNotFound, t.open)
+
+            mode = os.stat(VpncTunnel.READY_DIR).st_mode
+            self.assertEqual(stat.S_IMODE(mode), 0700)
+            self.assertEqual(os.path.dirname(t.get_ready_fp()),
+                             VpncTunnel.READY_DIR)
+        finally:
+            VpncTunnel.READY_DIR = ready_dir
+            shutil.rmtree(parent)
+
+    def test_invalid_name(self):
+        self.assertRaises(InvalidTunnelName, VpncTunnel, conf_file=None,
+                          name='../../etc/passwd')
+
+        cp = SafeConfigParser()
+        cp.add_section('tunnel:a/b')
+        cp.set('tunnel:a/b', 'conf_file', '/path/to/conf.conf')
+        self.assertRaises(InvalidTunnelName, VpncTunnel.parse_configuration,
+                          cp, 'tunnel:a/b')
+
+class TestScriptSharing(unittest.TestCase):
+
+    def test_same_ips_shared(self):
+        t1 = VpncTunnel(conf_file=None, ips=['10.0.0.1'], name='one')
+        t2 = VpncTunnel(conf_file=None, ips=['10.0.0.1'], name='two')
+
+        self.assertEqual(t1.get_split_tunnel_script_fp(),
+                         t2.get_split_tunnel_script_fp())
+
+    def test_same_routes_shared(self):
+        t1 = VpncTunnel(conf_file=None, ips=['10.0.0.1', '10.0.0.0/30'])
+        t2 = VpncTunnel(conf_file=None, ips=['10.0.0.0-3'])
+
+        self.assertEqual(t1.get_split_tunnel_script_fp(),
+                         t2.get_split_tunnel_script_fp())
+
+    def test_different_ips_differ(self):
+        t1 = VpncTunnel(conf_file=None, ips=['10.0.0.1'])
+        t2 = VpncTunnel(conf_file=None, ips=['10.0.0.2'])
+
+        self.assertNotEqual(t1.get_split_tunnel_script_fp(),
+                            t2.get_split_tunnel_script_fp())
+
+    def test_script_files(self):
+        t = VpncTunnel(conf_file=None)
+
+        self.assertEqual(t.get_script_files(), [t.get_split_tunnel_script_fp()])
@@ -4,32 +4,127 @@ calabar.tunnels
 This module encapsulates various tunnel processes and their management.
 """
 
+import errno
 import signal
 import os
+import socket
 import sys
-import psi.process
+import time
+from ConfigParser import SafeConfigParser
+from hashlib import md5
+
+from calabar.tunnels.adoption import (
+    TunnelStateFile,
+    TUNNEL_STATE_FILE,
+    adopt,
+    terminate_stale,
+    tunnel_entry,
+)
+from calabar.tunnels.backoff import (
+    Backoff,
+    BACKOFF_BASE,
+    BACKOFF_MAX,
+    BACKOFF_JITTER,
+    STABLE_UPTIME,
+)
+from calabar.tunnels.health import (
+    Probe,
+    run_probes,
+    is_healthy,
+    PROBE_INTERVAL,
+    PROBE_TIMEOUT,
+    PROBE_FAILURES,
+)
+from calabar.tunnels.events import (
+    EventLog,
+    exit_fields,
+    EVENT_RATE,
+    SUMMARY_INTERVAL,
+)
+from calabar.tunnels.ips import RouteIndex, int_to_ip, parse_range
+from calabar.tunnels.loop import EventLoop
+from calabar.tunnels.metrics import Metrics, MetricsServer, METRICS_ADDRESS
+from calabar.tunnels.ports import (
+    PortAllocator,
+    PORT_STATE_FILE,
+    parse_port_ranges,
+)
+from calabar.tunnels.procs import ProcessSnapshot, PROC_NOT_RUNNING
+from calabar.tunnels.profiling import (
+    Profiler,
+    PHASE_TIMERS,
+    PROFILE_DIR,
+    PROFILE_TICKS,
+)
+from calabar.tunnels.scripts import SCRIPT_STORE
+from calabar.tunnels.states import (
+    StateIndex,
+    TunnelList,
+    ALIVE_STATES,
+    STOPPED,
+    STARTING,
+    READY,
+    DEGRADED,
+    BACKING_OFF,
+)
+from calabar.tunnels.shutdown import Shutdown, SHUTDOWN_TIMEOUT
+from calabar.tunnels.startup import (
+    StartupPipeline,
+    STARTUP_CONCURRENCY,
+    READY_TIMEOUT,
+    READY_POLL_INTERVAL,
+)
 
 TUN_TYPE_STR = 'tunnel_type' # Configuration/dictionary key for the type of tunnel
 # Should match the tunnel_type argument to Tunnel __init__ methods
 
-PROC_NOT_RUNNING = [
-    psi.process.PROC_STATUS_DEAD,
-    psi.process.PROC_STATUS_ZOMBIE,
-    psi.process.PROC_STATUS_STOPPED
-]
-def is_really_running(tunnel):
-    pt = psi.process.ProcessTable()
+CALABAR_SECTION = 'calabar' # Configuration section for manager-wide options
+# Options in the CALABAR_SECTION and the ConfigParser getter used for each
+MANAGER_OPTIONS = {
+    'startup_concurrency': 'getint',
+    'ready_timeout': 'getfloat',
+    'probe_interval': 'getfloat',
+    'probe_timeout': 'getfloat',
+    'probe_failures': 'getint',
+    'backoff_base': 'getfloat',
+    'backoff_max': 'getfloat',
+    'backoff_jitter': 'getfloat',
+    'stable_uptime': 'getfloat',
+    'metrics_port': 'getint',
+    'metrics_address': 'get',
+    'profile_dir': 'get',
+    'profile_ticks': 'getint',
+    'summary_interval': 'getfloat',
+    'event_rate': 'getint',
+    'port_ranges': 'get',
+    'port_state_file': 'get',
+    'control_socket': 'get',
+    'state_file': 'get',
+    'shutdown_timeout': 'getfloat',
+}
+
+
+def is_really_running(tunnel, snapshot=None):
+    """
+    Is the ``tunnel``'s process actually alive?
+
+    Pass a shared :class:`calabar.tunnels.procs.ProcessSnapshot` as
+    ``snapshot`` when checking several tunnels in the same pass so that the
+    process table is only consulted once per pid.
+    """
+    started = time.time()
+    if snapshot is None:
+        snapshot = ProcessSnapshot()
     try:
-        proc = pt.get(tunnel.proc.pid, None)
+        pid = tunnel.proc.pid
     except AttributeError:
         # we might not actually have a tunnel.proc or it might poof while we're checking
         return False
-    if proc:
-        status = proc.status
-        if not status in PROC_NOT_RUNNING:
-            return True
 
-    return False
+    running = snapshot.is_running(pid, getattr(tunnel, 'proc_start_time', None))
+    PHASE_TIMERS.add('is_really_running', time.time() - started)
+
+    return running
 
 class TunnelsAlreadyLoadedException(Exception):
     """Once tunnels are loaded the first time, other methods must be used to
@@ -48,31 +143,441 @@ class TunnelTypeDoesNotMatch(Exception):
     """
     pass
 
-class TunnelManager():
+class TunnelNotFound(Exception):
+    """
+    No tunnel with the given name is being managed.
+    """
+    pass
+
+class DuplicateTunnel(Exception):
+    """
+    A tunnel with the given name is already being managed.
+    """
+    pass
+
+class TunnelManager(object):
     """
     A class for working with multiple :class:`calabar.tunnels.base.TunnelBase`
     tunnels.
 
+    :attr:`tunnels` keeps :attr:`state_index` up to date, so the tunnels in a
+    given state are found with :meth:`tunnels_in` without scanning them all.
+
     Creating this tunnels registers it for SIG_CHLD signals, so only ONE
     TunnelManager can exist at a time for purposes of keeping the other tunnels
     running.
     """
     def __init__(self):
+        self.state_index = StateIndex()
         self.tunnels = []
+        self.startup_concurrency = STARTUP_CONCURRENCY
+        self.ready_timeout = READY_TIMEOUT
+        self.startup_report = None # Set once start_tunnels finishes
+        self.probe_interval = PROBE_INTERVAL
+        self.probe_timeout = PROBE_TIMEOUT
+        self.probe_failures = PROBE_FAILURES
+        self._last_probe = 0
+        self.backoff_base = BACKOFF_BASE
+        self.backoff_max = BACKOFF_MAX
+        self.backoff_jitter = BACKOFF_JITTER
+        self.stable_uptime = STABLE_UPTIME
+        self.backoffs = {} # tunnel name -> Backoff
+        self.config_hashes = {} # tunnel name -> hash of its tun_conf_d
+        self.configs = {} # tunnel name -> its tun_conf_d
+        self.config = None # The config most recently loaded
+        self.runtime_tunnels = set() # names of tunnels added over the control socket
+        self.missing_executables = {} # executable -> names of tunnels using it
+        self.route_index = RouteIndex({})
+        self.metrics = Metrics()
+        self.metrics_port = None # Metrics are only served if this is set
+        self.metrics_address = METRICS_ADDRESS
+        self.loop = None # See event_loop()
+        self._last_pass = None # When continue_tunnels last ran
+        self.profile_dir = PROFILE_DIR
+        self.profile_ticks = PROFILE_TICKS
+        self.profiler = Profiler(self.profile_dir, self.profile_ticks)
+        self.summary_interval = SUMMARY_INTERVAL
+        self.event_rate = EVENT_RATE
+        self.events = EventLog(rate=self.event_rate,
+                               summary_interval=self.summary_interval)
+        self.port_ranges = ''
+        self.port_state_file = PORT_STATE_FILE
+        self.ports = PortAllocator([], self.port_state_file)
+        self.control_socket = None # Only served if this is set
+        self.state_file = TUNNEL_STATE_FILE
+        self.tunnel_state = TunnelStateFile(self.state_file)
+        self._state_dirty = False # Has a tunnel started or exited since the last save?
+        self._adopted = {} # pid -> tunnel whose process was adopted
+        self.shutdown_timeout = SHUTDOWN_TIMEOUT
+        self._child_exited_at = None # When the oldest unreaped SIGCHLD arrived
+        self.configfile = None # Reloaded on SIGHUP once watch_config is called
+        self._reload_requested = False
+        self._child_exited = False # Set by the SIGCHLD handler
+        self._tunnels_by_pid = {} # pid -> tunnels using that process
         self._register_for_close()
 
-    def load_tunnels(self, config):
+    def event_loop(self):
+        """
+        Return the :class:`calabar.tunnels.loop.EventLoop` that in-process
+        tunnels (and the metrics server) run on, creating it if needed.
+        """
+        if self.loop is None:
+            self.loop = EventLoop()
+        return self.loop
+
+    def _get_tunnels(self):
+        return self._tunnels
+
+    def _set_tunnels(self, tunnels):
+        for t in getattr(self, '_tunnels', []):
+            self.state_index.discard(t)
+        self._tunnels = TunnelList(self.state_index, tunnels)
+
+    tunnels = property(_get_tunnels, _set_tunnels)
+
+    def tunnels_in(self, *states):
+        """
+        Return the managed tunnels in any of the given ``states`` (see
+        :mod:`calabar.tunnels.states`).
+        """
+        return self.state_index.tunnels(*states)
+
+    def load_tunnels(self, config, tun_confs_d=None):
         """
         Load config information to create all required tunnels.
+
+        ``tun_confs_d`` replaces the tunnels configured in ``config``, eg. with
+        the part of them that a :mod:`calabar.tunnels.shards` worker
+        supervises. Their ports must already be assigned, and stored scripts
+        aren't cleaned up since other tunnels may still use them.
         """
         if self.tunnels:
             raise TunnelsAlreadyLoadedException("TunnelManager.load_tunnels can't be called after tunnels have already been loaded. Use update_tunnels() instead")
-        tun_confs_d = get_tunnels(config)
+        self._load_options(config)
+        all_tunnels = tun_confs_d is None
+        if all_tunnels:
+            tun_confs_d = get_tunnels(config)
+            self.assign_ports(tun_confs_d)
 
         for name, tun_conf_d in tun_confs_d.items():
             t = self._load_tunnel(name, tun_conf_d)
             self.tunnels.append(t)
 
+        self.adopt_tunnels()
+        self.check_executables()
+        self.index_routes(tun_confs_d)
+        if all_tunnels:
+            self.cleanup_scripts()
+
+    def index_routes(self, tun_confs_d):
+        """
+        Build the :class:`calabar.tunnels.ips.RouteIndex` of the ``ips`` of
+        every tunnel in ``tun_confs_d`` and report tunnels that route the same
+        addresses, since only one of them will actually get the traffic.
+
+        Returns the conflicts as given by
+        :meth:`calabar.tunnels.ips.RouteIndex.conflicts`.
+        """
+        routes = {}
+        for name, tun_conf_d in tun_confs_d.items():
+            if tun_conf_d.get('ips'):
+                routes[name] = tun_conf_d['ips']
+        self.route_index = RouteIndex(routes)
+
+        conflicts = self.route_index.conflicts()
+        for (name, other), shared in sorted(conflicts.items()):
+            ranges = []
+            for first, last in shared:
+                if first == last:
+                    ranges.append(int_to_ip(first))
+                else:
+                    ranges.append('%s-%s' % (int_to_ip(first), int_to_ip(last)))
+            print >> sys.stderr, "ROUTE CONFLICT: [%s] and [%s] both route %s" % (
+                name, other, ', '.join(ranges))
+
+        return conflicts
+
+    def assign_ports(self, tun_confs_d):
+        """
+        Fill in the local port of every tunnel in ``tun_confs_d`` configured
+        to listen on port ``auto``, using :attr:`ports` (see
+        :mod:`calabar.tunnels.ports`), and report explicitly configured ports
+        that something else on the host already listens on.
+
+        Raises :class:`calabar.tunnels.ports.PortConflict` if two tunnels are
+        configured with the same port, before any tunnel is touched.
+        """
+        claims = {}
+        for name, tun_conf_d in tun_confs_d.items():
+            tunnel = tunnel_class(tun_conf_d[TUN_TYPE_STR])
+            if tunnel.PORT_OPTION is not None:
+                claims[name] = (tunnel.PORT_PROTOCOL,
+                                tun_conf_d[tunnel.PORT_OPTION])
+
+        ports, in_use = self.ports.assign(claims)
+        for name, port in ports.items():
+            tunnel = tunnel_class(tun_confs_d[name][TUN_TYPE_STR])
+            tun_confs_d[name][tunnel.PORT_OPTION] = port
+        for name, protocol, port in in_use:
+            print >> sys.stderr, "PORT IN USE: [%s] listens on %s port %s, which is already bound on this host" % (
+                name, protocol, port)
+
+        return ports
+
+    def port_claims(self, names=None):
+        """
+        Return the ``tun_conf_d`` of each managed tunnel in ``names`` (all of
+        them by default) as they were before :meth:`assign_ports`, so that
+        assigning ports again gives an ``auto`` tunnel the port it already has
+        rather than turning it into an explicitly configured one.
+        """
+        if names is None:
+            names = self.configs.keys()
+
+        tun_confs_d = {}
+        for name in names:
+            tun_conf_d = self.configs[name]
+            if name in self.ports.assignments:
+                tunnel = tunnel_class(tun_conf_d[TUN_TYPE_STR])
+                tun_conf_d = dict(tun_conf_d)
+                tun_conf_d[tunnel.PORT_OPTION] = None
+            tun_confs_d[name] = tun_conf_d
+
+        return tun_confs_d
+
+    def _keep_runtime_tunnels(self, tun_confs_d):
+        """
+        Add the tunnels added over the control socket to the ``tun_confs_d``
+        read from the config file, so that a reload leaves them running. One
+        that the config file now configures itself is taken over by it.
+        """
+        for name in list(self.runtime_tunnels):
+            if name in tun_confs_d:
+                self.runtime_tunnels.discard(name)
+        tun_confs_d.update(self.port_claims(self.runtime_tunnels))
+
+    def tunnels_for_ip(self, ip):
+        """
+        Return the tunnels that route traffic for the address ``ip``.
+        """
+        names = self.route_index.lookup(ip)
+        return [t for t in self.tunnels if t.name in names]
+
+    def cleanup_scripts(self, tunnels=None):
+        """
+        Remove the stored tunnel scripts that none of ``tunnels`` (the managed
+        tunnels by default) use.
+
+        Only call this while no tunnel that has been removed is still running,
+        since its process may still need its script (eg. when vpnc
+        disconnects).
+        """
+        if tunnels is None:
+            tunnels = self.tunnels
+
+        live_paths = []
+        for t in tunnels:
+            live_paths += t.get_script_files()
+
+        return SCRIPT_STORE.cleanup(live_paths)
+
+    def check_executables(self, tunnels=None):
+        """
+        Resolve the executable of every tunnel in ``tunnels`` (all of them by
+        default) and report the missing ones together, rather than each tunnel
+        failing on its own when it's opened.
+
+        Returns a dictionary mapping each missing executable to the names of
+        the tunnels that need it.
+        """
+        if tunnels is None:
+            tunnels = self.tunnels
+
+        missing = {}
+        for t in tunnels:
+            if not t.find_executable():
+                missing.setdefault(t.executable, []).append(t.name)
+
+        if missing:
+            print >> sys.stderr, "EXECUTABLES NOT FOUND:"
+            for executable, names in sorted(missing.items()):
+                names.sort()
+                print >> sys.stderr, "  <%s> needed by %s" % (
+                    executable, ', '.join(names))
+        self.missing_executables.update(missing)
+
+        return missing
+
+    def update_tunnels(self, config, tun_confs_d=None):
+        """
+        Bring the managed tunnels in line with ``config`` without touching the
+        tunnels whose configuration didn't change.
+
+        Tunnels are matched by name and compared by a hash of their parsed
+        configuration: tunnels that are new are started, those no longer
+        configured are stopped and those whose configuration changed are
+        restarted with the new configuration.
+
+        As with :meth:`load_tunnels`, ``tun_confs_d`` replaces the tunnels
+        configured in ``config``.
+
+        Returns a tuple of the ``(added, removed, changed)`` tunnel names.
+        """
+        self._load_options(config)
+        if tun_confs_d is None:
+            tun_confs_d = get_tunnels(config)
+            self._keep_runtime_tunnels(tun_confs_d)
+            self.assign_ports(tun_confs_d)
+
+        current = set([t.name for t in self.tunnels])
+        added = sorted([name for name in tun_confs_d if name not in current])
+        removed = sorted([name for name in current if name not in tun_confs_d])
+        changed = sorted([
+            name for name in tun_confs_d
+            if name in current and \
+               self.config_hashes.get(name) != config_hash(tun_confs_d[name])])
+
+        for name in removed:
+            self.remove_tunnel(name)
+        for name in changed:
+            self.replace_tunnel(name, tun_confs_d[name])
+        for name in added:
+            self.add_tunnel(name, tun_confs_d[name])
+        self.index_routes(tun_confs_d)
+
+        print "TUNNELS UPDATED: %s added, %s removed, %s changed" % (
+            len(added), len(removed), len(changed))
+
+        return added, removed, changed
+
+    def get_tunnel(self, name):
+        """
+        Return the managed tunnel called ``name``.
+        """
+        for t in self.tunnels:
+            if t.name == name:
+                return t
+
+        raise TunnelNotFound("No tunnel named <%s> is being managed" % name)
+
+    def add_tunnel(self, name, tun_conf_d):
+        """
+        Create a tunnel from the ``tun_conf_d`` dictionary (as returned by
+        :func:`parse_tunnel`) and start it.
+        """
+        if name in [t.name for t in self.tunnels]:
+            raise DuplicateTunnel("A tunnel named <%s> already exists" % name)
+
+        t = self._load_tunnel(name, tun_conf_d)
+        self.tunnels.append(t)
+        self._start_new_tunnel(t)
+
+        return t
+
+    def remove_tunnel(self, name):
+        """
+        Stop the tunnel called ``name`` and stop managing it.
+        """
+        t = self.get_tunnel(name)
+        self.tunnels.remove(t)
+        self.backoffs.pop(name, None)
+        self.config_hashes.pop(name, None)
+        self.configs.pop(name, None)
+        self.runtime_tunnels.discard(name)
+        self._state_dirty = True
+        self.metrics.removed(name)
+        self.events.forget(name)
+        self.events.emit('removed', name)
+        self._stop_tunnel(t)
+
+        return t
+
+    def replace_tunnel(self, name, tun_conf_d):
+        """
+        Stop the tunnel called ``name`` and start a replacement created from
+        ``tun_conf_d`` once it has closed.
+        """
+        old = self.get_tunnel(name)
+        # Build the replacement first so that a bad config leaves the old
+        # tunnel running
+        new = self._load_tunnel(name, tun_conf_d)
+
+        self.tunnels[self.tunnels.index(old)] = new
+        self.backoffs.pop(name, None)
+        self._stop_tunnel(old, lambda: self._start_new_tunnel(new))
+
+        return new
+
+    def restart_tunnel(self, name):
+        """
+        Close the tunnel called ``name`` and open it again once it has closed.
+        """
+        t = self.get_tunnel(name)
+        self.backoffs.pop(name, None)
+        self._stop_tunnel(t, lambda: self._start_new_tunnel(t))
+
+        return t
+
+    def _start_new_tunnel(self, t):
+        self._open_tunnel(t)
+
+    def _stop_tunnel(self, t, then=None):
+        """
+        Close the tunnel ``t`` and call ``then`` once it has exited.
+        """
+        t.close()
+        if then:
+            then()
+
+    def watch_config(self, configfile):
+        """
+        Reload ``configfile`` and apply it with :meth:`update_tunnels` whenever
+        the process receives SIGHUP.
+        """
+        self.configfile = configfile
+        signal.signal(signal.SIGHUP, self._handle_reload)
+
+    def _handle_reload(self, signum, frame):
+        # Like SIGCHLD, the actual work happens on the next supervision pass
+        self._reload_requested = True
+
+    def reload_config(self):
+        """
+        Re-read ``configfile`` and update the tunnels to match it. A config
+        that can't be loaded is reported and leaves the tunnels untouched.
+        """
+        self._reload_requested = False
+
+        config = SafeConfigParser()
+        config.read(self.configfile)
+        try:
+            return self.update_tunnels(config)
+        except Exception, e:
+            print >> sys.stderr, "CONFIG RELOAD FAILED: %s" % e
+
+    def _load_options(self, config):
+        """
+        Load the manager-wide options from the ``[calabar]`` section, if any.
+        """
+        self.config = config
+        if not config.has_section(CALABAR_SECTION):
+            return
+
+        for option, getter in MANAGER_OPTIONS.items():
+            if config.has_option(CALABAR_SECTION, option):
+                value = getattr(config, getter)(CALABAR_SECTION, option)
+                setattr(self, option, value)
+
+        self.profiler.directory = self.profile_dir
+        self.profiler.ticks = self.profile_ticks
+        self.events.summary_interval = self.summary_interval
+        self.events.limiter.rate = self.event_rate
+        self.tunnel_state.path = self.state_file
+        self.ports.ranges = parse_port_ranges(self.port_ranges)
+        if self.ports.path != self.port_state_file:
+            self.ports.path = self.port_state_file
+            self.ports.assignments = self.ports.load()
+
     def _load_tunnel(self, tunnel_name, tun_conf_d):
         """
         Create and return a tunnel instance from a ``tun_conf_d`` dictionary.
@@ -81,39 +586,306 @@ class TunnelManager():
         implementation of :mod:`calabar.tunnels.base.TunnelBase:parse_configuration`
         method.
         """
-        from calabar.conf import TUNNELS
-        tun_type = tun_conf_d[TUN_TYPE_STR]
-        for tunnel in TUNNELS:
-            if tunnel.TUNNEL_TYPE == tun_type:
-                t = tunnel(name=tunnel_name, **tun_conf_d)
-                return t
-
-        raise NotImplementedError()
+        tunnel = tunnel_class(tun_conf_d[TUN_TYPE_STR])
+        t = tunnel(name=tunnel_name, **tun_conf_d)
+        self.config_hashes[tunnel_name] = config_hash(tun_conf_d)
+        self.configs[tunnel_name] = tun_conf_d
+        self.metrics.track(tunnel_name)
+        return t
 
     def start_tunnels(self):
         """
-        Start all of the configured tunnels and register to keep them running.
+        Start all of the configured tunnels that aren't already running and
+        register to keep them running.
+
+        Up to ``startup_concurrency`` tunnels connect at the same time and this
+        blocks until every tunnel is ready, failed or took longer than
+        ``ready_timeout`` seconds: at worst ``ceil(tunnels /
+        startup_concurrency) * ready_timeout`` seconds. Tunnels that exit in
+        the meantime are reaped as they go, but they're only restarted, and a
+        SIGHUP only reloads the config, once the first
+        :meth:`continue_tunnels` pass after that. Returns the
+        :class:`calabar.tunnels.startup.StartupReport`.
         """
-        for t in self.tunnels:
-            try:
-                t.open()
-            except ExecutableNotFound, e:
-                print >> sys.stderr, e
+        pipeline = self._startup_pipeline(self._open_tunnel)
+        while not pipeline.step():
+            if self._child_exited:
+                self.reap_children()
+            if self._adopted:
+                self.reap_adopted()
+            time.sleep(READY_POLL_INTERVAL)
+        self.startup_report = pipeline.report
+        self.events.flush()
+        self.save_state()
+        print self.startup_report
+
+        return self.startup_report
+
+    def _startup_pipeline(self, open_tunnel):
+        # Tunnels that are already running are left alone
+        tunnels = [t for t in self.tunnels
+                   if t.state not in ALIVE_STATES or not t.is_running()]
+        return StartupPipeline(tunnels, open_tunnel,
+                               concurrency=self.startup_concurrency,
+                               timeout=self.ready_timeout)
 
     def continue_tunnels(self):
         """
         Ensure that all of the tunnels are still running.
+
+        Returns a list of the tunnels that couldn't be restarted.
         """
-        for t in self.tunnels:
-            if not t.is_running():
-                print "TUNNEL [%s] EXITED" % t.name
-                print "RESTARTING"
-                try:
-                    t.open()
-                except ExecutableNotFound, e:
-                    print >> sys.stderr, e
-            else:
-                print "[%s]:%s running" % (t.name, t.proc.pid)
+        self.profiler.tick()
+        started = time.time()
+        if self._child_exited:
+            self.reap_children()
+        if self._adopted:
+            self.reap_adopted()
+        if self._reload_requested:
+            self.reload_config()
+
+        failed = []
+        now = time.time()
+        snapshot = ProcessSnapshot()
+        for t in self.tunnels_in(*ALIVE_STATES):
+            if not t.is_running(snapshot):
+                t.set_state(STOPPED, now)
+
+        for t in self.tunnels_in(STOPPED, BACKING_OFF):
+            backoff = self._backoff_for(t)
+            if backoff.next_retry is None:
+                self.events.transition(t.name, 'exited', now=now)
+                # It was last seen running on the previous pass
+                self.metrics.exited(t.name, now, self._last_pass)
+                backoff.failed(now)
+            if not backoff.due(now):
+                self._back_off(t, backoff, now)
+                continue
+
+            self.events.transition(t.name, 'restarting', now=now,
+                                   failures=backoff.failures)
+            if not self._open_tunnel(t):
+                failed.append(t)
+
+        if time.time() - self._last_probe >= self.probe_interval:
+            self.check_health(snapshot)
+        if self.events.summary_due(now):
+            self.log_summary()
+        self.events.flush()
+        self.save_state()
+
+        self._last_pass = started
+        self.metrics.supervise.observe(time.time() - started)
+        PHASE_TIMERS.add('continue_tunnels', time.time() - started)
+
+        return failed
+
+    def check_health(self, snapshot=None):
+        """
+        Run the health probes of every ready tunnel and recycle the tunnels
+        that have failed ``probe_failures`` rounds in a row.
+
+        All probes run concurrently, so this blocks for at most
+        ``probe_timeout`` seconds.
+        """
+        self._last_probe = time.time()
+        tunnels = self._probed_tunnels(snapshot)
+        if not tunnels:
+            return
+
+        probes = []
+        for t in tunnels:
+            probes += t.probes
+        self._handle_probe_results(tunnels, run_probes(probes, self.probe_timeout))
+
+    def _probed_tunnels(self, snapshot=None):
+        """
+        Return the tunnels that should be health checked right now.
+        """
+        if snapshot is None:
+            snapshot = ProcessSnapshot()
+        for t in self.tunnels_in(STARTING):
+            if t.is_ready(snapshot):
+                t.set_state(READY)
+
+        return [t for t in self.tunnels_in(READY, DEGRADED)
+                if t.probes and t.is_ready(snapshot)]
+
+    def _handle_probe_results(self, tunnels, results):
+        for t in tunnels:
+            if t.state not in (READY, DEGRADED):
+                # It exited or was closed while the probes were running
+                continue
+            if is_healthy(t, results):
+                t.failed_probe_rounds = 0
+                t.set_state(READY)
+                if self.events.state(t.name, 'health') == 'unhealthy':
+                    self.events.transition(t.name, 'healthy', 'health')
+                continue
+
+            t.failed_probe_rounds += 1
+            t.set_state(DEGRADED)
+            self.events.transition(t.name, 'unhealthy', 'health',
+                                   failed_rounds=t.failed_probe_rounds,
+                                   limit=self.probe_failures)
+            if t.failed_probe_rounds >= self.probe_failures:
+                self.recycle_tunnel(t)
+
+    def recycle_tunnel(self, t):
+        """
+        Restart the tunnel ``t`` even though its process is still alive.
+        """
+        self.events.emit('recycling', t.name)
+        t.close()
+        self.metrics.exited(t.name)
+        backoff = self._backoff_for(t)
+        backoff.failed()
+        if backoff.due():
+            self._open_tunnel(t)
+        else:
+            self._back_off(t, backoff)
+
+    def serve_metrics(self, loop):
+        """
+        Serve :attr:`metrics` over HTTP from ``loop`` if ``metrics_port`` is
+        configured. Returns the :class:`calabar.tunnels.metrics.MetricsServer`
+        or ``None``.
+        """
+        if self.metrics_port is None:
+            return None
+
+        server = MetricsServer(self.metrics.render, self.metrics_port,
+                               self.metrics_address)
+        server.start(loop)
+        print "SERVING METRICS ON http://%s:%s/metrics" % (
+            server.address, server.port)
+
+        return server
+
+    def serve_control(self, loop):
+        """
+        Serve a :class:`calabar.tunnels.control.ControlServer` for this
+        manager from ``loop`` if ``control_socket`` is configured. Returns the
+        server or ``None``.
+        """
+        if self.control_socket is None:
+            return None
+
+        from calabar.tunnels.control import Controller, ControlServer
+        server = ControlServer(Controller(self).handle, self.control_socket)
+        server.start(loop)
+        print "SERVING CONTROL REQUESTS ON %s" % server.path
+
+        return server
+
+    def log_summary(self):
+        """
+        Log a summary event with the number of tunnels in each state. Returns
+        the counts.
+        """
+        counts = self.state_index.counts()
+        counts['tunnels'] = len(self.tunnels)
+        self.events.summary(**counts)
+
+        return counts
+
+    def _back_off(self, t, backoff, now=None):
+        """
+        Note that the stopped tunnel ``t`` has to wait for its ``backoff``
+        before it can be restarted.
+        """
+        if now is None:
+            now = time.time()
+        if backoff.due(now):
+            return
+        t.set_state(BACKING_OFF, now)
+        self.events.transition(t.name, 'backing_off', now=now,
+                               failures=backoff.failures,
+                               retry_in='%.1f' % (backoff.next_retry - now))
+
+    def status(self, snapshot=None):
+        """
+        Return a list of lines describing the state of every tunnel, including
+        when tunnels that are backing off will next be retried.
+        """
+        if snapshot is None:
+            snapshot = ProcessSnapshot()
+        now = time.time()
+
+        return [self._status_line(t, snapshot, now) for t in self.tunnels]
+
+    def _status_line(self, t, snapshot, now):
+        if t.is_running(snapshot):
+            if t.proc is None:
+                return "[%s] running" % t.name
+            return "[%s]:%s running" % (t.name, t.proc.pid)
+
+        backoff = self.backoffs.get(t.name)
+        if backoff and not backoff.due(now):
+            return "[%s] backing off after %s failures. Next retry at %s (in %.1fs)" % (
+                t.name, backoff.failures,
+                time.strftime('%H:%M:%S', time.localtime(backoff.next_retry)),
+                backoff.next_retry - now)
+
+        return "[%s] not running" % t.name
+
+    def _backoff_for(self, t):
+        """
+        Return the :class:`calabar.tunnels.backoff.Backoff` for the tunnel
+        ``t``.
+        """
+        try:
+            return self.backoffs[t.name]
+        except KeyError:
+            backoff = Backoff(base=self.backoff_base, cap=self.backoff_max,
+                              jitter=self.backoff_jitter,
+                              stable_uptime=self.stable_uptime)
+            self.backoffs[t.name] = backoff
+            return backoff
+
+    def _open_tunnel(self, t):
+        """
+        Open the tunnel ``t``, reporting rather than raising a missing
+        executable or an in-process tunnel that can't listen.
+
+        Returns ``True`` if the tunnel process was launched. Either way, the
+        tunnel's backoff is updated.
+        """
+        if t.IN_PROCESS:
+            t.loop = self.event_loop()
+        try:
+            t.open()
+        except ExecutableNotFound, e:
+            # Missing executables are reported in one batch when the tunnels
+            # are loaded, not again on every attempt
+            if t.executable not in self.missing_executables:
+                print >> sys.stderr, e
+            self.missing_executables.setdefault(t.executable, [t.name])
+            backoff = self._backoff_for(t)
+            backoff.failed()
+            self._back_off(t, backoff)
+            return False
+        except socket.error, e:
+            # Eg. a forward's listen port is already bound or its target
+            # doesn't resolve, which mustn't stop the other tunnels starting
+            print >> sys.stderr, "TUNNEL OPEN FAILED: [%s]: %s" % (t.name, e)
+            t.set_state(STOPPED)
+            backoff = self._backoff_for(t)
+            backoff.failed()
+            self._back_off(t, backoff)
+            return False
+
+        self.missing_executables.pop(t.executable, None)
+        self._state_dirty = True
+        self._backoff_for(t).started()
+        self.metrics.started(t.name)
+        if t.proc is None:
+            # In-process, so there's no pid to watch for
+            self.events.transition(t.name, 'started')
+        else:
+            self.events.transition(t.name, 'started', pid=t.proc.pid)
+            self._index_pid(t)
+        return True
 
     def _register_for_close(self):
         """
@@ -124,29 +896,215 @@ class TunnelManager():
 
         # Register for a termination signal so we can clean up children
         signal.signal(signal.SIGTERM, self._handle_terminate)
+        signal.signal(signal.SIGQUIT, self._handle_detach)
 
     def _handle_terminate(self, signum, frame):
-        for t in self.tunnels:
-            t.close(wait=False)
+        self.stop_tunnels()
+
+        exit()
+
+    def stop_tunnels(self, timeout=None):
+        """
+        Close every tunnel at once and wait for all of them together, sending
+        SIGKILL to any still running after ``timeout`` seconds
+        (``shutdown_timeout`` by default). See
+        :mod:`calabar.tunnels.shutdown`.
+
+        Returns the :class:`calabar.tunnels.shutdown.ShutdownReport`.
+        """
+        if timeout is None:
+            timeout = self.shutdown_timeout
+
+        report = Shutdown(self.tunnels, timeout).run()
+        for name in report.killed:
+            self.events.emit('killing', name, after='%.1f' % timeout)
+        self._adopted.clear()
+        self._state_dirty = True
+        self.save_state()
+        self.events.flush()
+        print report
+
+        return report
+
+    def _handle_detach(self, signum, frame):
+        """
+        Exit without closing the tunnels, leaving their processes for the next
+        ``calabard`` to adopt, eg. while upgrading it.
+        """
+        self._state_dirty = True
+        self.save_state()
+        print "DETACHED: leaving the tunnels running"
+        self.events.flush()
 
         exit()
 
     def _handle_child_close(self, signum, frame):
         """
-        Handle a closed child.
+        Note that a child has closed.
 
-        Call :mod:os.wait() on the process so that it's not defunct.
+        Signal handlers should do as little as possible, so the actual reaping
+        is left to :meth:`reap_children` on the next supervision pass.
         """
         assert signum == signal.SIGCHLD
 
-        print "CHILD TUNNEL CLOSED"
-        pid, exit_status = os.wait()
+        if not self._child_exited:
+            self._child_exited_at = time.time()
+        self._child_exited = True
+
+    def reap_children(self):
+        """
+        Reap every exited child so that none are left defunct and hand each
+        exit status to the tunnel that owned the process.
+
+        SIGCHLD signals coalesce when several children exit at once, so this
+        keeps calling :func:`os.waitpid` until no exited children remain
+        instead of reaping a single child per signal. Children that don't
+        belong to a tunnel are reaped too.
+
+        Returns a list of the ``(pid, exit_status)`` tuples that were reaped.
+        """
+        self._child_exited = False
+        exited_at, self._child_exited_at = self._child_exited_at, None
+
+        reaped = []
+        while True:
+            try:
+                pid, exit_status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                break
+            if pid == 0:
+                break
+
+            reaped.append((pid, exit_status))
+            for t in self._tunnels_for_pid(pid):
+                self.metrics.exited(t.name, exited_at=exited_at)
+                self._handle_tunnel_exit(t, pid, exit_status)
+
+        return reaped
 
+    def adopt_tunnels(self):
+        """
+        Adopt the tunnel processes that a previous ``calabard`` saved to
+        ``state_file`` and left running, rather than starting them again (see
+        :mod:`calabar.tunnels.adoption`). Saved processes that can't be
+        adopted, eg. because their tunnel's configuration changed, are
+        terminated.
+
+        Returns the names of the adopted tunnels.
+        """
+        saved = self.tunnel_state.load()
+        if not saved:
+            return []
+
+        snapshot = ProcessSnapshot()
+        adopted = []
         for t in self.tunnels:
-            # For all of the "closing" tunnels, if they've stopped running, handle the close
-            if t.closing and not t.is_running():
-                # Assume the same exit_status
-                t.handle_closed(exit_status)
+            entry = saved.get(t.name)
+            if entry is None or \
+               not adopt(t, entry, self.config_hashes.get(t.name), snapshot):
+                continue
+            del saved[t.name]
+            t.set_state(STARTING)
+            t.set_state(READY)
+            self._adopted[t.proc.pid] = t
+            self._index_pid(t)
+            self._backoff_for(t).started()
+            self.metrics.started(t.name)
+            self.events.transition(t.name, 'adopted', pid=t.proc.pid)
+            adopted.append(t.name)
+
+        for name, pid in terminate_stale(saved, self._adopted, snapshot):
+            print >> sys.stderr, "STALE TUNNEL PROCESS: [%s]:%s terminated" % (
+                name, pid)
+        if adopted:
+            print "ADOPTED %s running tunnels" % len(adopted)
+        self._state_dirty = True
+
+        return adopted
+
+    def reap_adopted(self):
+        """
+        Handle the exits of adopted tunnel processes. They aren't our children,
+        so no SIGCHLD arrives for them and the process table is checked
+        instead.
+
+        Returns the pids that exited.
+        """
+        snapshot = ProcessSnapshot()
+        exited = []
+        for pid, t in self._adopted.items():
+            if t.proc is None or t.proc.pid != pid:
+                # It was already handled, eg. reaped as our own child
+                del self._adopted[pid]
+                continue
+            if t.proc.poll(snapshot) is None:
+                continue
+
+            del self._adopted[pid]
+            self._tunnels_by_pid.pop(pid, None)
+            exited.append(pid)
+            self.metrics.exited(t.name)
+            self._handle_tunnel_exit(t, pid, None)
+
+        return exited
+
+    def save_state(self):
+        """
+        Save the process of every tunnel to ``state_file`` if any tunnel
+        started or exited since the last save, for the next ``calabard`` to
+        adopt.
+        """
+        if not self._state_dirty:
+            return
+        self._state_dirty = False
+
+        entries = {}
+        for t in self.tunnels:
+            entry = tunnel_entry(t, self.config_hashes.get(t.name))
+            if entry is not None:
+                entries[t.name] = entry
+        try:
+            self.tunnel_state.save(entries)
+        except (IOError, OSError), e:
+            print >> sys.stderr, "TUNNEL STATE NOT SAVED: %s" % e
+
+    def _handle_tunnel_exit(self, t, pid, exit_status):
+        """
+        Handle the reaped process ``pid`` that belonged to tunnel ``t``.
+        ``exit_status`` is ``None`` for adopted processes, whose exit status
+        can't be known.
+        """
+        self._state_dirty = True
+        self.events.transition(t.name, 'exited', pid=pid,
+                               **exit_fields(exit_status))
+        t.handle_closed(exit_status)
+
+    def _index_pid(self, t):
+        sharing = self._tunnels_by_pid.setdefault(t.proc.pid, [])
+        if t not in sharing:
+            sharing.append(t)
+
+    def _tunnels_for_pid(self, pid):
+        """
+        Return the tunnels whose process has the given ``pid``. Several
+        tunnels can share one process, eg. SSH forwards multiplexed over the
+        same connection.
+        """
+        tunnels = self._tunnels_by_pid.pop(pid, None)
+        if tunnels is None:
+            # The tunnel might have been opened behind our back. Refresh the
+            # index once rather than scanning for every reaped pid. Existing
+            # entries are kept since removed tunnels may still be closing.
+            for tun in self.tunnels:
+                if tun.proc:
+                    self._index_pid(tun)
+            tunnels = self._tunnels_by_pid.pop(pid, [])
+
+        return [t for t in tunnels if t.proc is not None and t.proc.pid == pid]
 
 
 
@@ -169,8 +1127,11 @@ def get_tunnels(config):
             'bar':
                 {
                     'tunnel_type': 'ssh',
-                    'from': 'root@10.10.251.2:386',
-                    'to': '127.0.0.1:387
+                    'destination': 'root@10.10.251.2',
+                    'remote_port': 386,
+                    'local_address': '127.0.0.1',
+                    'local_port': 387,
+                    'executable': None
                 }
         }
     """
@@ -192,11 +1153,52 @@ def parse_tunnel(config, section):
     dictionary using all configured tunnel types and their configuration
     parsers.
     """
+    tunnel = tunnel_class(config.get(section, TUN_TYPE_STR))
+    tun_conf_d = tunnel.parse_configuration(config, section)
+    _parse_probes(config, section, tun_conf_d)
+    return tun_conf_d
+
+def tunnel_class(tun_type):
+    """
+    Return the tunnel class registered in :data:`calabar.conf.TUNNELS` for
+    the ``tun_type`` tunnel type.
+    """
     from calabar.conf import TUNNELS
-    tun_type = config.get(section, TUN_TYPE_STR)
     for tunnel in TUNNELS:
         if tun_type == tunnel.TUNNEL_TYPE:
-            tun_conf_d = tunnel.parse_configuration(config, section)
-            return tun_conf_d
+            return tunnel
 
     raise NotImplementedError("The tunnel type [%s] isn't supported" % tun_type)
+
+def config_hash(tun_conf_d):
+    """
+    Return a hash of the ``tun_conf_d`` tunnel configuration dictionary that
+    changes whenever any of its options do.
+    """
+    return md5(repr(sorted(tun_conf_d.items()))).hexdigest()
+
+def _parse_probes(config, section, tun_conf_d):
+    """
+    Add the health probes for any tunnel type to ``tun_conf_d``.
+
+    ``probes`` is a comma-separated list of probes while ``probe_port`` is a
+    shortcut for a ``reach`` probe against each single address in the
+    tunnel's ``ips``. CIDR blocks and ranges are skipped since there's no way
+    to know which of their hosts are up.
+    """
+    probes = []
+    if config.has_option(section, 'probes'):
+        probe_str = config.get(section, 'probes')
+        probes += [p.strip() for p in probe_str.split(',') if p.strip()]
+    if config.has_option(section, 'probe_port'):
+        port = config.getint(section, 'probe_port')
+        for ip in tun_conf_d.get('ips', []):
+            first, last = parse_range(ip)
+            if first == last:
+                probes.append('reach:%s:%s' % (int_to_ip(first), port))
+
+    if probes:
+        # Catch typos when the config is loaded rather than on the first check
+        for probe in probes:
+            Probe.parse(probe)
+        tun_conf_d['probes'] = probes
@@ -0,0 +1,214 @@
+"""
+calabar.tunnels.adoption
+
+Keeping tunnels running across restarts of ``calabard`` itself.
+
+The tunnel manager saves the process of every running tunnel to a
+:class:`TunnelStateFile`: its pid and start time, along with the hash of the
+tunnel's configuration and the scripts it uses. When ``calabard`` starts
+again, eg. after an upgrade or a crash, each tunnel whose process is still
+alive and whose configuration hasn't changed is adopted with :func:`adopt`
+instead of being started again, so a VPN doesn't have to renegotiate just
+because its supervisor restarted. Any other process left in the file is
+stale and is terminated so that it doesn't fight its replacement.
+
+An adopted process isn't a child of the new ``calabard``, so it's wrapped in
+an :class:`AdoptedProcess`, which stands in for :class:`subprocess.Popen`
+by watching the process table instead of waiting on the process.
+
+Since ``calabard`` runs as root and terminates the processes listed in the
+state file, the file is kept in the private
+:data:`calabar.tunnels.rundir.RUN_DIR` and ignored unless only we could have
+written it.
+"""
+from __future__ import with_statement
+
+import errno
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+
+from calabar.tunnels.procs import ProcessSnapshot
+from calabar.tunnels.rundir import RUN_DIR, is_private, private_dir
+
+TUNNEL_STATE_FILE = os.path.join(RUN_DIR, 'tunnels.json')
+WAIT_INTERVAL = 0.05 # Seconds between checks while waiting on an adopted process
+UNKNOWN_RETURNCODE = -1 # The exit status of a process that isn't our child is lost
+
+class AdoptedProcess(object):
+    """
+    The parts of the :class:`subprocess.Popen` interface used on tunnel
+    processes, for the process ``pid`` started at ``start_time`` (as given by
+    :func:`calabar.tunnels.procs.process_start_time`) by someone else.
+
+    Once the process is gone, :attr:`returncode` is
+    :data:`UNKNOWN_RETURNCODE` unless it was reaped as our own child.
+    """
+    __slots__ = ('pid', 'start_time', 'returncode')
+
+    def __init__(self, pid, start_time):
+        self.pid = pid
+        self.start_time = start_time
+        self.returncode = None
+
+    def poll(self, snapshot=None):
+        if self.returncode is None:
+            if snapshot is None:
+                snapshot = ProcessSnapshot()
+            if not snapshot.is_running(self.pid, self.start_time):
+                self.returncode = UNKNOWN_RETURNCODE
+        return self.returncode
+
+    def wait(self):
+        while self.poll() is None:
+            time.sleep(WAIT_INTERVAL)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+def tunnel_entry(t, config_hash):
+    """
+    Return what the state file records about the tunnel ``t``, or ``None`` if
+    it has no process of its own to record.
+    """
+    if t.proc is None or t.proc_start_time is None:
+        return None
+
+    return {
+        'pid': t.proc.pid,
+        'start_time': t.proc_start_time,
+        'config_hash': config_hash,
+        'scripts': t.get_script_files(),
+    }
+
+def adopt(t, entry, config_hash, snapshot=None):
+    """
+    Make the process recorded in the state file ``entry`` the process of the
+    tunnel ``t``, as long as the tunnel can be adopted, its configuration
+    still hashes to the recorded ``config_hash`` and uses the same scripts,
+    and the process is still running. Returns whether it was adopted.
+    """
+    if not t.ADOPTABLE or t.IN_PROCESS or t.proc is not None:
+        return False
+    if entry.get('config_hash') != config_hash:
+        return False
+    scripts = entry.get('scripts') or []
+    if sorted(scripts) != sorted(t.get_script_files()):
+        return False
+    for path in scripts:
+        if not os.path.exists(path):
+            return False
+
+    if snapshot is None:
+        snapshot = ProcessSnapshot()
+    pid, start_time = entry.get('pid'), entry.get('start_time')
+    if not pid or start_time is None or \
+       not snapshot.is_running(pid, start_time):
+        return False
+
+    t.proc = AdoptedProcess(pid, start_time)
+    t.proc_start_time = start_time
+
+    return True
+
+def terminate_stale(entries, keep=(), snapshot=None):
+    """
+    Send SIGTERM to the still running processes recorded in ``entries`` (a
+    dictionary of tunnel names to state file entries), apart from the pids in
+    ``keep``. Returns the ``(name, pid)`` of each process terminated.
+    """
+    if snapshot is None:
+        snapshot = ProcessSnapshot()
+
+    terminated = []
+    seen = set(keep)
+    for name, entry in sorted(entries.items()):
+        pid, start_time = entry.get('pid'), entry.get('start_time')
+        if not pid or pid in seen:
+            # Several tunnels can share a process
+            continue
+        seen.add(pid)
+        if start_time is None or not snapshot.is_running(pid, start_time):
+            continue
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            continue
+        terminated.append((name, pid))
+
+    return terminated
+
+class TunnelStateFile(object):
+    """
+    The tunnel processes saved at ``path``, as a JSON object of tunnel names
+    to :func:`tunnel_entry` dictionaries. An empty ``path`` saves nothing.
+    """
+    def __init__(self, path=TUNNEL_STATE_FILE):
+        self.path = path
+        self._saved = None # What was last written, to skip rewriting it
+
+    def load(self):
+        """
+        Return the saved entries, or an empty dictionary if there are none.
+
+        A file that's a symlink, isn't ours or that others can write to is
+        reported and ignored, since anyone could have listed any process in
+        it.
+        """
+        if not self.path:
+            return {}
+        try:
+            fd = os.open(self.path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError, e:
+            if e.errno == errno.ELOOP:
+                self._ignore("is a symlink")
+            # Otherwise it's missing: every tunnel is just started afresh
+            return {}
+        try:
+            with os.fdopen(fd) as f:
+                if not is_private(os.fstat(f.fileno())):
+                    self._ignore("could have been written by another user")
+                    return {}
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+
+        return dict([(str(name), entry) for name, entry in entries.items()
+                     if isinstance(entry, dict)])
+
+    def _ignore(self, reason):
+        print >> sys.stderr, "STATE FILE IGNORED: <%s> %s" % (self.path, reason)
+
+    def save(self, entries):
+        """
+        Save ``entries`` if they changed since they were last saved, replacing
+        the file atomically so that a crash never leaves it half written.
+        """
+        if not self.path or entries == self._saved:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            private_dir(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.calabar-tunnels-')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump(entries, tmp, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._saved = entries
@@ -0,0 +1,94 @@
+"""
+calabar.tunnels.backoff
+
+Restart scheduling for tunnels that keep failing.
+
+Restarting a tunnel the moment it exits is right when it died once, but a
+tunnel with bad credentials or an unreachable concentrator would otherwise be
+respawned forever on every supervision pass. A :class:`Backoff` tracks a
+tunnel's consecutive failures: the first restart is immediate, after which the
+delay doubles from ``base`` up to ``cap`` seconds with random jitter so that
+many tunnels failing together don't retry in lockstep. Once a tunnel has stayed
+up for ``stable_uptime`` seconds its failures are forgotten.
+"""
+
+import random
+import time
+
+BACKOFF_BASE = 1 # Seconds before the second restart attempt
+BACKOFF_MAX = 300 # The longest a tunnel will wait between restarts
+BACKOFF_JITTER = 0.5 # Up to this fraction of a delay is randomly shaved off
+STABLE_UPTIME = 60 # Seconds of uptime after which failures are forgotten
+
+class Backoff(object):
+    """
+    The restart schedule of a single tunnel.
+
+    ``next_retry`` is the time at which the tunnel may be restarted, or
+    ``None`` if no failure is pending.
+    """
+    def __init__(self, base=BACKOFF_BASE, cap=BACKOFF_MAX,
+                 jitter=BACKOFF_JITTER, stable_uptime=STABLE_UPTIME):
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.stable_uptime = stable_uptime
+        self.failures = 0
+        self.next_retry = None
+        self.started_at = None
+
+    def started(self, now=None):
+        """
+        Record that the tunnel was (re)started.
+        """
+        if now is None:
+            now = time.time()
+        self.started_at = now
+        self.next_retry = None
+
+    def failed(self, now=None):
+        """
+        Record a failure (the tunnel exited or couldn't be launched) and return
+        how many seconds to wait before restarting it.
+        """
+        if now is None:
+            now = time.time()
+        if self.is_stable(now):
+            self.failures = 0
+        self.started_at = None
+
+        self.failures += 1
+        delay = self.delay()
+        self.next_retry = now + delay
+
+        return delay
+
+    def delay(self):
+        """
+        The delay for the current number of failures.
+        """
+        if self.failures <= 1:
+            return 0
+
+        delay = min(self.cap, self.base * 2 ** (self.failures - 2))
+        return delay * (1 - self.jitter * random.random())
+
+    def due(self, now=None):
+        """
+        May the tunnel be restarted now?
+        """
+        if self.next_retry is None:
+            return True
+        if now is None:
+            now = time.time()
+        return now >= self.next_retry
+
+    def is_stable(self, now=None):
+        """
+        Has the tunnel been up long enough for its failures to be forgotten?
+        """
+        if self.started_at is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now - self.started_at >= self.stable_uptime
@@ -1,6 +1,7 @@
 import subprocess
 import os
 import signal
+import time
 
 from calabar.tunnels import (
     TUN_TYPE_STR,
@@ -8,6 +9,16 @@ from calabar.tunnels import (
     TunnelTypeDoesNotMatch,
     is_really_running,
 )
+from calabar.tunnels.health import Probe
+from calabar.tunnels.procs import process_start_time
+from calabar.tunnels.profiling import PHASE_TIMERS
+from calabar.tunnels.states import (
+    check_transition,
+    ALIVE_STATES,
+    STOPPED,
+    STARTING,
+    STOPPING,
+)
 
 class TunnelBase(object):
     """The base Tunnel clase for encapsulating a specific type of tunnel.
@@ -21,63 +32,155 @@ class TunnelBase(object):
     ``name`` will be this tunnels string identifier.
     ``tun_type`` if given, must match :attr:`TunnelBase.TYPE` or a
     :exc:`TunnelTypeDoesNotMatch` exception will be raised.
+    ``probes`` is an optional list of health probe strings as understood by
+    :meth:`calabar.tunnels.health.Probe.parse`.
 
     To implement other tunnels, you can extend this class (as :class:`calabar.tunnels.vpnc.VpncTunnel`
     does) or if the tunnel process is simple enough to only need command line
     options, you can simply pass in the appropriate ``cmd`` array and
     path to the required ``executable``.
+
+    The tunnel's lifecycle is tracked in :attr:`state` (see
+    :mod:`calabar.tunnels.states`), along with the time it entered that state
+    in :attr:`state_since`. Tunnels use ``__slots__`` to stay small when
+    there are lots of them, so subclasses should declare theirs as well.
     """
+    __slots__ = ('cmd', 'executable', 'proc', 'proc_start_time', 'name',
+                 'probes', 'failed_probe_rounds', 'state', 'state_since',
+                 'state_index')
 
     TUNNEL_TYPE = 'base'
+    IN_PROCESS = False # Run inside calabard on the manager's loop, not as a process?
+    PORT_OPTION = None # The __init__ argument holding the local port listened on, if any
+    PORT_PROTOCOL = 'tcp'
+    ADOPTABLE = True # Can a restarted calabard take over the running process?
 
-    def __init__(self, cmd, executable, name='default', tunnel_type=None):
+    def __init__(self, cmd, executable, name='default', tunnel_type=None,
+                 probes=None):
         self.cmd = cmd
         self.executable = executable
         self.proc = None
+        self.proc_start_time = None # Guards against pid reuse
         self.name = name
         if tunnel_type and tunnel_type != TunnelBase.TUNNEL_TYPE:
             raise TunnelTypeDoesNotMatch(
                 'Tunnel type <%s> does not match expected <%s>' % (tunnel_type, TunnelBase.TUNNEL_TYPE))
-        self.closing = False # Are we currently trying to close this tunnel
-        self.opening = False # Not currently trying to open this tunnel
+        self.state = STOPPED
+        self.state_since = time.time()
+        self.state_index = None # The StateIndex tracking this tunnel, if any
+        self.probes = [Probe.parse(probe) for probe in probes or []]
+        self.failed_probe_rounds = 0 # Consecutive failed health checks
 
     def open(self):
         """
         Open the tunnel.
         """
-        if not which(self.executable):
+        if not self.find_executable():
             raise ExecutableNotFound("The executable <%s> in invalid. Not found or not marked executable." % repr(self.executable))
 
-        self.closing = False
-        self.opening = True
+        started = time.time()
+        if self.state in ALIVE_STATES and not self.is_running():
+            # The process went away without us hearing about it
+            self.set_state(STOPPED)
+        self.set_state(STARTING)
+        self.failed_probe_rounds = 0
         self.proc = self._open(self.cmd, self.executable)
+        if self.proc is not None:
+            self.proc_start_time = process_start_time(self.proc.pid)
+        PHASE_TIMERS.add('open', time.time() - started)
 
         return self.proc
 
+    @property
+    def opening(self):
+        """Are we currently trying to open this tunnel?"""
+        return self.state == STARTING
+
+    @property
+    def closing(self):
+        """Are we currently trying to close this tunnel?"""
+        return self.state == STOPPING
+
+    def set_state(self, state, now=None):
+        """
+        Move the tunnel to ``state``, raising
+        :exc:`calabar.tunnels.states.InvalidTransition` if it can't get there
+        from its current state. Moving to the current state does nothing.
+
+        Returns whether the state changed.
+        """
+        old = self.state
+        if state == old:
+            return False
+        check_transition(old, state)
+
+        self.state = state
+        self.state_since = now or time.time()
+        if self.state_index is not None:
+            self.state_index.moved(self, old, state)
+        return True
+
+    def find_executable(self):
+        """
+        Return the path to this tunnel's executable, or ``None`` if it can't be
+        found or isn't executable.
+        """
+        return which(self.executable)
+
+    def get_script_files(self):
+        """
+        Return the paths of the generated scripts (see
+        :mod:`calabar.tunnels.scripts`) that this tunnel's process uses.
+        """
+        return []
+
     def _open(self, cmd, executable):
         """
         Perform the actual process launch using the command and executable
         configured for this tunnel.
         """
-        proc = subprocess.Popen(cmd, executable=executable)
+        proc = subprocess.Popen(cmd, executable=executable, env=self._open_env())
 
         return proc
 
-    def is_running(self):
+    def _open_env(self):
+        """
+        Return the environment for the tunnel process, or ``None`` to inherit
+        ours.
+        """
+        return None
+
+    def is_running(self, snapshot=None):
+        """
+        Is the tunnel process currently alive?
+
+        ``snapshot`` is an optional shared
+        :class:`calabar.tunnels.procs.ProcessSnapshot` for the current
+        supervision pass.
+        """
         if self.proc:
-            return is_really_running(self)
+            return is_really_running(self, snapshot)
         else:
             return False
 
+    def is_ready(self, snapshot=None):
+        """
+        Is the tunnel actually usable rather than just launched?
+
+        By default a tunnel is ready as soon as its process is running. Tunnels
+        with a connection phase should override this.
+        """
+        return self.is_running(snapshot)
+
     def close(self, wait=True, force=False):
         """
         Close this tunnel if currently running and waits for it to finish closing.
 
         If ``force`` is given as True, close using :mod:signal.SIGKILL to force a close.
         """
-        self.closing = True
-        self.opening = False
+        started = time.time()
         if self.is_running():
+            self.set_state(STOPPING)
             sig = signal.SIGTERM
             if force:
                 sig = signal.SIGKILL
@@ -85,15 +188,30 @@ class TunnelBase(object):
             os.kill(self.proc.pid, sig)
             if wait:
                 self.proc.wait()
+                self.set_state(STOPPED)
+        else:
+            self.set_state(STOPPED)
+        PHASE_TIMERS.add('close', time.time() - started)
 
     def handle_closed(self, exit_status):
         """
         Handle the tunnel process having closed externally. There was probably
         some sort of error.
+
+        ``exit_status`` is the raw status as returned by :func:`os.waitpid`, or
+        ``None`` if it isn't known.
         """
-        self.closing = False
-        self.opening = False
+        if exit_status is not None and self.proc is not None and \
+           self.proc.returncode is None:
+            # The process was already reaped, so make sure Popen doesn't try
+            # to wait on a pid that may since have been reused
+            if os.WIFSIGNALED(exit_status):
+                self.proc.returncode = -os.WTERMSIG(exit_status)
+            else:
+                self.proc.returncode = os.WEXITSTATUS(exit_status)
+        self.set_state(STOPPED)
         self.proc = None
+        self.proc_start_time = None
 
     @staticmethod
     def parse_configuration(config, section_name):
@@ -114,6 +232,9 @@ class TunnelBase(object):
         return tun_conf_d
 
 
+# (program, PATH) -> (resolved path, identity of the file when resolved)
+_which_cache = {}
+
 def which(program):
     """
     Determine where the given executable exists on the path (if it exists). Mimics
@@ -121,6 +242,41 @@ def which(program):
 
     Returns ``None`` if the executable is not found.
 
+    Successful lookups are cached per ``PATH`` so that restarting a tunnel
+    costs a single ``stat`` rather than one per ``PATH`` entry. A cached path
+    is only trusted while the file's device, inode, mtime and mode are
+    unchanged, so replacing or ``chmod``-ing the executable is noticed.
+    Executables that weren't found are looked up again every time.
+    """
+    key = (program, os.environ["PATH"])
+    cached = _which_cache.get(key)
+    if cached:
+        exe_file, identity = cached
+        if _file_identity(exe_file) == identity:
+            return exe_file
+        del _which_cache[key]
+
+    exe_file = _search_path(program)
+    if exe_file:
+        identity = _file_identity(exe_file)
+        if identity:
+            _which_cache[key] = (exe_file, identity)
+
+    return exe_file
+
+def _file_identity(fpath):
+    """
+    Return a tuple that changes whenever the file at ``fpath`` is replaced or
+    modified, or ``None`` if it doesn't exist.
+    """
+    try:
+        st = os.stat(fpath)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_mtime, st.st_mode)
+
+def _search_path(program):
+    """
     Taken from: http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python
     """
     def is_exe(fpath):
@@ -135,3 +291,5 @@ def which(program):
             exe_file = os.path.join(path, program)
             if is_exe(exe_file):
                 return exe_file
+
+    return None
@@ -0,0 +1,384 @@
+"""
+calabar.tunnels.control
+
+A control socket for changing the tunnels of a running ``calabard`` without
+restarting it or editing its config file.
+
+A :class:`ControlServer` listens on a Unix socket on the manager's
+:class:`calabar.tunnels.loop.EventLoop` and reads requests as lines of JSON,
+answering each with a line of JSON. A request is a single operation::
+
+    {"op": "add", "name": "acme", "tunnel": {"tunnel_type": "forward", "listen": "auto", "target": "10.10.250.1:389"}}
+    {"op": "remove", "name": "acme"}
+    {"op": "restart", "name": "acme"}
+    {"op": "status"}
+    {"op": "status", "name": "acme"}
+
+or a list of them, which is applied as a batch and answered with a list of
+results in the same order. A tunnel's options are those of its config file
+section. Every operation in a batch is checked, and ports are assigned to all
+of the new tunnels, before any of them is applied: if one is invalid, none
+are. Provisioning hundreds of tunnels is therefore a single round trip, and
+only the tunnels named in the batch are ever touched.
+"""
+
+import errno
+import json
+import os
+import socket
+import stat
+import sys
+from ConfigParser import SafeConfigParser
+
+from calabar.tunnels import (
+    TUNNEL_PREFIX,
+    TUN_TYPE_STR,
+    parse_tunnel,
+)
+from calabar.tunnels.ports import PortConflict, PortsExhausted
+
+MAX_REQUEST_SIZE = 16 * 1024 * 1024 # Bytes a single request line may take
+CLIENT_TIMEOUT = 300 # Seconds a client may stay connected without a request
+ACCEPT_PAUSE = 0.1 # Seconds to stop accepting after an error, eg. out of fds
+
+class ControlError(Exception):
+    """
+    A control operation is invalid and wasn't applied.
+    """
+    pass
+
+class Controller(object):
+    """
+    Applies control operations to a :class:`calabar.tunnels.TunnelManager`.
+    """
+    OPERATIONS = ('add', 'remove', 'restart', 'status')
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def handle(self, line):
+        """
+        Apply the JSON request ``line`` and return the JSON response line.
+        """
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return json.dumps({'ok': False, 'error': 'Invalid JSON'})
+
+        if isinstance(request, list):
+            response = self.batch(request)
+        else:
+            response = self.batch([request])[0]
+
+        return json.dumps(response)
+
+    def batch(self, ops):
+        """
+        Check every operation in ``ops`` and apply them in order if they're
+        all valid. Returns a result dictionary for each operation.
+        """
+        names = set([t.name for t in self.manager.tunnels])
+        added = {} # name -> tun_conf_d of tunnels added by the batch
+        removed = set()
+        prepared = []
+        failed = False
+        for op in ops:
+            try:
+                prepared.append(self._prepare(op, names, added, removed))
+            except ControlError, e:
+                prepared.append(e)
+                failed = True
+
+        if not failed and added:
+            try:
+                self._assign_ports(added, removed)
+            except (PortConflict, PortsExhausted), e:
+                return [{'ok': False, 'error': str(e)} for op in ops]
+
+        if failed:
+            return [{'ok': False, 'error': str(p)} if isinstance(p, ControlError)
+                    else {'ok': False, 'error': 'Not applied'}
+                    for p in prepared]
+
+        return [apply() for apply in prepared]
+
+    def _prepare(self, op, names, added, removed):
+        """
+        Check the operation ``op`` against the tunnel ``names`` as they'll be
+        once the operations before it are applied, and return a callable that
+        applies it.
+        """
+        if not isinstance(op, dict):
+            raise ControlError("Operations must be objects")
+        kind = op.get('op')
+        if kind not in self.OPERATIONS:
+            raise ControlError("Unknown operation <%s>" % kind)
+
+        name = op.get('name')
+        if name is not None:
+            if not isinstance(name, basestring) or not name:
+                raise ControlError("Invalid tunnel name")
+            name = str(name)
+        elif kind != 'status':
+            raise ControlError("<%s> needs a tunnel name" % kind)
+
+        if kind == 'add':
+            if name in names:
+                raise ControlError("A tunnel named <%s> already exists" % name)
+            tun_conf_d = self._parse(name, op.get('tunnel'))
+            names.add(name)
+            added[name] = tun_conf_d
+            return lambda: self._add(name, tun_conf_d)
+
+        if name is not None and name not in names:
+            raise ControlError("No tunnel named <%s> is being managed" % name)
+
+        if kind == 'remove':
+            names.discard(name)
+            removed.add(name)
+            return lambda: self._remove(name)
+        if kind == 'restart':
+            return lambda: self._restart(name)
+        return lambda: self._status(name)
+
+    def _parse(self, name, options):
+        """
+        Parse the ``options`` of a new tunnel as if they were its config file
+        section, with the manager-wide sections of the loaded config around
+        it.
+        """
+        if not isinstance(options, dict) or TUN_TYPE_STR not in options:
+            raise ControlError("<tunnel> must be an object with a %s" % TUN_TYPE_STR)
+
+        config = SafeConfigParser()
+        base = self.manager.config
+        if base is not None:
+            for section in base.sections():
+                if section.startswith(TUNNEL_PREFIX):
+                    continue
+                config.add_section(section)
+                for option, value in base.items(section, raw=True):
+                    config.set(section, option, value)
+
+        section = TUNNEL_PREFIX + name
+        config.add_section(section)
+        for option, value in options.items():
+            if isinstance(value, list):
+                value = ', '.join([unicode(v) for v in value])
+            # Values are taken literally rather than interpolated
+            value = unicode(value).encode('utf-8').replace('%', '%%')
+            config.set(section, str(option), value)
+
+        try:
+            return parse_tunnel(config, section)
+        except Exception, e:
+            raise ControlError("Invalid tunnel <%s>: %s" % (name, e))
+
+    def _assign_ports(self, added, removed):
+        confs = self.manager.port_claims()
+        for name in removed:
+            confs.pop(name, None)
+        confs.update(added)
+        self.manager.assign_ports(confs)
+
+    def _add(self, name, tun_conf_d):
+        t = self.manager.add_tunnel(name, tun_conf_d)
+        self.manager.runtime_tunnels.add(name)
+        return {'ok': True, 'tunnel': self._describe(t)}
+
+    def _remove(self, name):
+        self.manager.remove_tunnel(name)
+        return {'ok': True}
+
+    def _restart(self, name):
+        self.manager.restart_tunnel(name)
+        return {'ok': True}
+
+    def _status(self, name):
+        if name is not None:
+            return {'ok': True,
+                    'tunnel': self._describe(self.manager.get_tunnel(name))}
+        return {'ok': True,
+                'tunnels': [self._describe(t) for t in self.manager.tunnels]}
+
+    def _describe(self, t):
+        description = {
+            'name': t.name,
+            'type': t.TUNNEL_TYPE,
+            'state': t.state,
+            'state_since': t.state_since,
+            'pid': t.proc.pid if t.proc is not None else None,
+        }
+        tun_conf_d = self.manager.configs.get(t.name, {})
+        if t.PORT_OPTION is not None and t.PORT_OPTION in tun_conf_d:
+            description['port'] = tun_conf_d[t.PORT_OPTION]
+
+        return description
+
+class ControlServer(object):
+    """
+    Serve the requests of a :class:`Controller` on the Unix socket at
+    ``path``, which only the user running ``calabard`` may connect to.
+
+    As with :class:`calabar.tunnels.metrics.MetricsServer`, every socket is
+    non-blocking and handled by callbacks on the loop passed to
+    :meth:`start`. Clients may send any number of requests over one
+    connection.
+    """
+    def __init__(self, handle, path):
+        self.handle = handle
+        self.path = path
+        self.sock = None
+        self._loop = None
+        self._clients = {} # fd -> _Client
+        self._paused = None # Timer resuming accepts after an error, if paused
+
+    def start(self, loop):
+        self._loop = loop
+        self._remove_stale_socket()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(16)
+        sock.setblocking(0)
+        self.sock = sock
+        loop.add_reader(sock.fileno(), self._accept)
+
+    def _remove_stale_socket(self):
+        """
+        Remove a socket left behind at :attr:`path` by a ``calabard`` that
+        didn't exit cleanly, but never one that's still being served.
+        """
+        try:
+            mode = os.stat(self.path).st_mode
+        except OSError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise ControlError("<%s> exists and isn't a socket" % self.path)
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except socket.error:
+            os.remove(self.path)
+        else:
+            raise ControlError("<%s> is already being served" % self.path)
+        finally:
+            probe.close()
+
+    def close(self):
+        for client in self._clients.values():
+            self._close_client(client)
+        if self._paused is not None:
+            self._paused.cancel()
+            self._paused = None
+        if self.sock:
+            self._loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR,
+                                 errno.ECONNABORTED):
+                    return
+                # Eg. EMFILE, which mustn't take supervision down with it. The
+                # connection stays queued, so stop trying for a moment rather
+                # than spinning on it.
+                print >> sys.stderr, "CONTROL ACCEPT FAILED: %s" % e
+                self._pause()
+                return
+            conn.setblocking(0)
+            client = _Client(conn)
+            client.timer = self._loop.call_later(
+                CLIENT_TIMEOUT, self._close_client, client)
+            self._clients[conn.fileno()] = client
+            self._loop.add_reader(conn.fileno(), self._read, client)
+
+    def _pause(self):
+        self._loop.remove_reader(self.sock.fileno())
+        self._paused = self._loop.call_later(ACCEPT_PAUSE, self._resume)
+
+    def _resume(self):
+        self._paused = None
+        if self.sock:
+            self._loop.add_reader(self.sock.fileno(), self._accept)
+
+    def _read(self, client):
+        try:
+            data = client.conn.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self._close_client(client)
+            return
+
+        client.timer.cancel()
+        client.timer = self._loop.call_later(
+            CLIENT_TIMEOUT, self._close_client, client)
+
+        client.request += data
+        while '\n' in client.request:
+            line, client.request = client.request.split('\n', 1)
+            if line.strip():
+                client.response += self._respond(line) + '\n'
+        if len(client.request) > MAX_REQUEST_SIZE:
+            client.response += json.dumps(
+                {'ok': False, 'error': 'Request too large'}) + '\n'
+            client.request = ''
+            client.closing = True
+            self._loop.remove_reader(client.conn.fileno())
+
+        if client.response:
+            self._loop.add_writer(client.conn.fileno(), self._write, client)
+
+    def _respond(self, line):
+        try:
+            return self.handle(line)
+        except Exception, e:
+            # A bug handling one request mustn't take down supervision
+            print >> sys.stderr, "CONTROL REQUEST FAILED: %s" % e
+            return json.dumps({'ok': False, 'error': 'Internal error: %s' % e})
+
+    def _write(self, client):
+        try:
+            sent = client.conn.send(client.response)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._close_client(client)
+            return
+        client.response = client.response[sent:]
+        if not client.response:
+            self._loop.remove_writer(client.conn.fileno())
+            if client.closing:
+                self._close_client(client)
+
+    def _close_client(self, client):
+        fd = client.conn.fileno()
+        if self._clients.pop(fd, None) is None:
+            return
+        client.timer.cancel()
+        self._loop.remove_reader(fd)
+        self._loop.remove_writer(fd)
+        client.conn.close()
+
+class _Client(object):
+    __slots__ = ('conn', 'request', 'response', 'timer', 'closing')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.request = ''
+        self.response = ''
+        self.timer = None
+        self.closing = False
@@ -0,0 +1,293 @@
+"""
+calabar.tunnels.evented
+
+An event-driven tunnel supervisor.
+
+:class:`calabar.tunnels.TunnelManager` works in passes over every tunnel and
+closing a tunnel with ``wait=True`` blocks everything else until the process
+exits. :class:`AsyncTunnelManager` instead runs every tunnel's lifecycle as
+independent callbacks on a single :class:`calabar.tunnels.loop.EventLoop`:
+exits are picked up from SIGCHLD as they happen, restarts and kill escalations
+are per-tunnel timers, health probes run on the same loop and nothing ever
+blocks waiting on a child process.
+"""
+
+import time
+
+from calabar.tunnels import TunnelManager
+from calabar.tunnels.health import ProbeRound
+from calabar.tunnels.loop import EventLoop
+from calabar.tunnels.procs import ProcessSnapshot
+from calabar.tunnels.profiling import PHASE_TIMERS
+from calabar.tunnels.startup import READY_POLL_INTERVAL
+from calabar.tunnels.states import DEGRADED, READY, STARTING, STOPPED
+
+SUPERVISE_INTERVAL = 60 # Seconds between safety-net passes over every tunnel
+CLOSE_TIMEOUT = 10 # Seconds a closing tunnel gets before it's sent SIGKILL
+ADOPTED_POLL_INTERVAL = 1 # Seconds between checks that adopted processes still run
+
+class AsyncTunnelManager(TunnelManager):
+    """
+    A :class:`calabar.tunnels.TunnelManager` that supervises each tunnel
+    independently on an :class:`calabar.tunnels.loop.EventLoop`.
+
+    Like :class:`calabar.tunnels.TunnelManager`, only ONE of these can exist at
+    a time since it claims SIGCHLD and the loop's signal wakeup fd.
+    """
+    def __init__(self, loop=None):
+        TunnelManager.__init__(self)
+        if loop is None:
+            loop = EventLoop()
+        self.loop = loop
+        self._restart_timers = {} # tunnel name -> pending restart Timer
+        self._kill_timers = {} # pid -> pending SIGKILL escalation Timer
+        self._recycling = set() # names of tunnels to restart once they close
+        self._after_close = {} # pid -> callback for once the process exits
+        self._next_pass = None
+        self._watching = False
+        self._running = False
+
+    def start_tunnels(self):
+        """
+        Begin starting the configured tunnels and watching for tunnel exits.
+
+        Startup runs as a :class:`calabar.tunnels.startup.StartupPipeline`
+        stepped from the loop, so exits and other events are handled while
+        tunnels are still connecting. ``startup_report`` is set once every
+        tunnel has settled.
+        """
+        self._watch()
+        self._step_startup(self._startup_pipeline(self._start_tunnel))
+
+    def _start_tunnel(self, t):
+        if self._open_tunnel(t):
+            return True
+
+        self.schedule_restart(t, self._retry_delay(t))
+        return False
+
+    def _retry_delay(self, t):
+        """
+        Seconds until the tunnel ``t``'s backoff allows a restart.
+        """
+        next_retry = self._backoff_for(t).next_retry
+        if next_retry is None:
+            return 0
+        return max(0, next_retry - time.time())
+
+    def _step_startup(self, pipeline):
+        if pipeline.step():
+            self.startup_report = pipeline.report
+            self.events.flush()
+            print self.startup_report
+        else:
+            self.loop.call_later(
+                READY_POLL_INTERVAL, self._step_startup, pipeline)
+
+    def run(self):
+        """
+        Supervise the tunnels until :meth:`stop` is called.
+
+        Every pass through the loop counts as a supervision pass for the
+        :attr:`profiler`.
+        """
+        self._watch()
+        self._running = True
+        while self._running:
+            self.loop.run_once()
+            self.profiler.tick()
+            # Whatever happened during the pass is written in one go
+            self.events.flush()
+            self.save_state()
+
+    def stop(self):
+        self._running = False
+
+    def stop_tunnels(self, timeout=None):
+        # Nothing pending may restart or signal a tunnel once it's stopped
+        for timer in self._restart_timers.values() + self._kill_timers.values():
+            timer.cancel()
+        self._restart_timers.clear()
+        self._kill_timers.clear()
+        self._after_close.clear()
+        self._recycling.clear()
+
+        return TunnelManager.stop_tunnels(self, timeout)
+
+    def schedule_restart(self, t, delay):
+        """
+        (Re)start the tunnel ``t`` after ``delay`` seconds, replacing any
+        restart that's already pending for it.
+        """
+        self._cancel_restart(t)
+        self._restart_timers[t.name] = self.loop.call_later(
+            delay, self._restart, t)
+
+    def close_tunnel(self, t, timeout=CLOSE_TIMEOUT, then=None):
+        """
+        Ask the tunnel ``t`` to close without waiting for it to exit. If it's
+        still running after ``timeout`` seconds, it's sent SIGKILL.
+
+        ``then`` is called once the tunnel's process has exited.
+        """
+        self._cancel_restart(t)
+        if not t.is_running() or t.proc is None:
+            # No process to wait for, eg. an in-process forward
+            t.close(wait=False)
+            if then:
+                then()
+            return
+
+        pid = t.proc.pid
+        t.close(wait=False)
+        if t.state == STOPPED:
+            # There was no process of its own to wait for, eg. an SSH forward
+            # sharing its connection with other tunnels
+            if then:
+                then()
+            return
+        self._kill_timers[pid] = self.loop.call_later(
+            timeout, self._escalate_close, t, pid)
+        if then:
+            self._after_close[pid] = then
+
+    def _start_new_tunnel(self, t):
+        self.schedule_restart(t, 0)
+
+    def _stop_tunnel(self, t, then=None):
+        self.close_tunnel(t, then=then)
+
+    def _watch(self):
+        if self._watching:
+            return
+        self._watching = True
+        self.loop.watch_signals(self._handle_signal_wakeup)
+        self._next_pass = self.loop.call_later(
+            SUPERVISE_INTERVAL, self._supervise_pass)
+        self.loop.call_later(self.probe_interval, self.check_health)
+        self.loop.call_later(self.summary_interval, self._summary_timer)
+        if self._adopted:
+            self.loop.call_later(ADOPTED_POLL_INTERVAL, self._poll_adopted)
+
+    def _poll_adopted(self):
+        """
+        Check on the adopted tunnel processes, which don't send us SIGCHLD,
+        for as long as there are any.
+        """
+        self.reap_adopted()
+        if self._adopted:
+            self.loop.call_later(ADOPTED_POLL_INTERVAL, self._poll_adopted)
+
+    def _summary_timer(self):
+        self.log_summary()
+        self.loop.call_later(self.summary_interval, self._summary_timer)
+
+    def _restart(self, t):
+        self._restart_timers.pop(t.name, None)
+        if t.state_index is not self.state_index or t.is_running():
+            # It was removed or started some other way
+            return
+        if not self._open_tunnel(t):
+            self.schedule_restart(t, self._retry_delay(t))
+
+    def _cancel_restart(self, t):
+        timer = self._restart_timers.pop(t.name, None)
+        if timer:
+            timer.cancel()
+
+    def _escalate_close(self, t, pid):
+        self._kill_timers.pop(pid, None)
+        if t.proc is not None and t.proc.pid == pid and t.is_running():
+            self.events.emit('killing', t.name, pid=pid)
+            t.close(wait=False, force=True)
+
+    def _handle_signal_wakeup(self):
+        started = time.time()
+        if self._child_exited:
+            self.reap_children()
+        if self._reload_requested:
+            self.reload_config()
+        self.metrics.supervise.observe(time.time() - started)
+        PHASE_TIMERS.add('handle_signals', time.time() - started)
+
+    def _handle_tunnel_exit(self, t, pid, exit_status):
+        timer = self._kill_timers.pop(pid, None)
+        if timer:
+            timer.cancel()
+
+        closing = t.closing
+        TunnelManager._handle_tunnel_exit(self, t, pid, exit_status)
+
+        then = self._after_close.pop(pid, None)
+        if then:
+            then()
+            return
+        if t not in self.tunnels:
+            # It was removed while it was still running
+            return
+
+        if not closing or t.name in self._recycling:
+            self._recycling.discard(t.name)
+            backoff = self._backoff_for(t)
+            delay = backoff.failed()
+            if delay:
+                self._back_off(t, backoff)
+            else:
+                self.events.transition(t.name, 'restarting',
+                                       failures=backoff.failures)
+            self.schedule_restart(t, delay)
+
+    def check_health(self, snapshot=None):
+        """
+        Start a round of health probes on the loop. The next round is
+        scheduled ``probe_interval`` seconds after this one finishes.
+        """
+        tunnels = self._probed_tunnels(snapshot)
+        probes = []
+        for t in tunnels:
+            probes += t.probes
+        if not probes:
+            self.loop.call_later(self.probe_interval, self.check_health)
+            return
+
+        ProbeRound(probes, lambda results: self._probes_finished(tunnels, results),
+                   self.probe_timeout).start(self.loop)
+
+    def _probes_finished(self, tunnels, results):
+        self._handle_probe_results(tunnels, results)
+        self.loop.call_later(self.probe_interval, self.check_health)
+
+    def recycle_tunnel(self, t):
+        """
+        Close the tunnel ``t`` without waiting and restart it once it exits.
+        """
+        self.events.emit('recycling', t.name)
+        if not t.is_running():
+            # It already exited and will be restarted through the usual route
+            return
+        self._recycling.add(t.name)
+        self.close_tunnel(t)
+
+    def _supervise_pass(self):
+        """
+        Catch anything that slipped past the SIGCHLD handling, eg. tunnels
+        adopted from elsewhere that aren't our children.
+        """
+        started = time.time()
+        snapshot = ProcessSnapshot()
+        for t in self.tunnels_in(STARTING, READY, DEGRADED, STOPPED):
+            if t.name in self._restart_timers:
+                continue
+            if not t.is_running(snapshot):
+                t.set_state(STOPPED)
+                self.events.transition(t.name, 'exited')
+                self.metrics.exited(t.name)
+                backoff = self._backoff_for(t)
+                delay = backoff.failed()
+                self._back_off(t, backoff)
+                self.schedule_restart(t, delay)
+
+        self.metrics.supervise.observe(time.time() - started)
+        PHASE_TIMERS.add('supervise_pass', time.time() - started)
+        self._next_pass = self.loop.call_later(
+            SUPERVISE_INTERVAL, self._supervise_pass)
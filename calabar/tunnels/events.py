@@ -0,0 +1,195 @@
+"""
+calabar.tunnels.events
+
+Structured, state-change-only logging of tunnel supervision.
+
+Printing a status line for every tunnel on every pass drowns the few lines
+that matter. An :class:`EventLog` instead records an event only when a
+tunnel's state changes (it started, exited, is restarting or backing off, went
+unhealthy or became healthy again) along with a periodic summary line counting
+the tunnels in each state. Events are ``key=value`` lines::
+
+    time=2011-03-02T14:05:11 event=exited tunnel=foo pid=1234 signal=9
+
+A flapping tunnel can't flood the log either: each tunnel gets ``rate`` events
+per ``period`` seconds and the next event after a quiet spell says how many
+were suppressed. Lines are collected by a :class:`BufferedSink` and written in
+batches.
+"""
+
+import os
+import sys
+import time
+
+EVENT_RATE = 10 # Events a single tunnel may log per RATE_PERIOD
+RATE_PERIOD = 60 # Seconds
+SUMMARY_INTERVAL = 60 # Seconds between summary lines
+FLUSH_INTERVAL = 1 # Seconds buffered events may wait before being written
+BUFFER_SIZE = 64 * 1024 # Bytes of buffered events that force a write
+
+def _quote(value):
+    value = str(value)
+    if not value or ' ' in value or '"' in value or '=' in value:
+        return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+    return value
+
+def format_event(when, kind, tunnel=None, fields=None):
+    """
+    Format an event as a single ``key=value`` line.
+    """
+    parts = ['time=%s' % time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(when)),
+             'event=%s' % kind]
+    if tunnel is not None:
+        parts.append('tunnel=%s' % _quote(tunnel))
+    for key, value in sorted((fields or {}).items()):
+        parts.append('%s=%s' % (key, _quote(value)))
+
+    return ' '.join(parts) + '\n'
+
+def exit_fields(exit_status):
+    """
+    Describe a raw :func:`os.waitpid` status as event fields. A status of
+    ``None`` isn't known, so there's nothing to describe.
+    """
+    if exit_status is None:
+        return {}
+    if os.WIFSIGNALED(exit_status):
+        return {'signal': os.WTERMSIG(exit_status)}
+    return {'code': os.WEXITSTATUS(exit_status)}
+
+class BufferedSink(object):
+    """
+    Write lines to ``stream`` (``sys.stdout`` by default) in batches, once
+    ``buffer_size`` bytes have built up or ``flush_interval`` seconds have
+    passed since the last write. Call :meth:`flush` to write immediately.
+    """
+    def __init__(self, stream=None, flush_interval=FLUSH_INTERVAL,
+                 buffer_size=BUFFER_SIZE):
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self._lines = []
+        self._size = 0
+        self._last_flush = time.time()
+
+    def write(self, line):
+        self._lines.append(line)
+        self._size += len(line)
+        if self._size >= self.buffer_size or \
+           time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        if not self._lines:
+            return
+        stream = self.stream or sys.stdout
+        stream.write(''.join(self._lines))
+        stream.flush()
+        self._lines = []
+        self._size = 0
+
+class RateLimiter(object):
+    """
+    A token bucket per key allowing ``rate`` events per ``period`` seconds.
+    """
+    def __init__(self, rate=EVENT_RATE, period=RATE_PERIOD):
+        self.rate = rate
+        self.period = period
+        self._buckets = {} # key -> [tokens, last update]
+
+    def allow(self, key, now=None):
+        if now is None:
+            now = time.time()
+        try:
+            bucket = self._buckets[key]
+        except KeyError:
+            bucket = self._buckets[key] = [self.rate, now]
+
+        bucket[0] = min(self.rate,
+                        bucket[0] + (now - bucket[1]) * self.rate / float(self.period))
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        return False
+
+    def forget(self, key):
+        self._buckets.pop(key, None)
+
+class EventLog(object):
+    """
+    Log supervision events to ``sink`` (a :class:`BufferedSink` on
+    ``sys.stdout`` by default).
+    """
+    def __init__(self, sink=None, rate=EVENT_RATE, period=RATE_PERIOD,
+                 summary_interval=SUMMARY_INTERVAL):
+        if sink is None:
+            sink = BufferedSink()
+        self.sink = sink
+        self.limiter = RateLimiter(rate, period)
+        self.summary_interval = summary_interval
+        self.states = {} # (tunnel, aspect) -> the last state logged
+        self.suppressed = {} # tunnel -> events dropped by the rate limit
+        self._last_summary = None
+
+    def emit(self, kind, tunnel=None, now=None, **fields):
+        """
+        Log an event, subject to the tunnel's rate limit. Returns whether the
+        event was logged.
+        """
+        if now is None:
+            now = time.time()
+        if tunnel is not None:
+            if not self.limiter.allow(tunnel, now):
+                self.suppressed[tunnel] = self.suppressed.get(tunnel, 0) + 1
+                return False
+            suppressed = self.suppressed.pop(tunnel, 0)
+            if suppressed:
+                fields['suppressed'] = suppressed
+
+        self.sink.write(format_event(now, kind, tunnel, fields))
+        return True
+
+    def transition(self, tunnel, state, aspect='lifecycle', now=None, **fields):
+        """
+        Log ``state`` as an event for ``tunnel`` only if it differs from the
+        last state logged for the same ``aspect`` of that tunnel.
+        """
+        key = (tunnel, aspect)
+        if self.states.get(key) == state:
+            return False
+        self.states[key] = state
+
+        return self.emit(state, tunnel, now, **fields)
+
+    def state(self, tunnel, aspect='lifecycle'):
+        return self.states.get((tunnel, aspect))
+
+    def forget(self, tunnel):
+        """
+        Drop everything known about ``tunnel``, eg. once it's removed.
+        """
+        for key in [k for k in self.states if k[0] == tunnel]:
+            del self.states[key]
+        self.suppressed.pop(tunnel, None)
+        self.limiter.forget(tunnel)
+
+    def summary_due(self, now=None):
+        if self._last_summary is None:
+            return True
+        if now is None:
+            now = time.time()
+        return now - self._last_summary >= self.summary_interval
+
+    def summary(self, now=None, **counts):
+        """
+        Log a summary line with the given counts, eg. of tunnels per state.
+        """
+        if now is None:
+            now = time.time()
+        self._last_summary = now
+        self.emit('summary', None, now, **counts)
+
+    def flush(self):
+        self.sink.flush()
@@ -0,0 +1,382 @@
+"""
+calabar.tunnels.forward
+
+TCP port forwarding inside ``calabard`` itself.
+
+A :class:`ForwardTunnel` listens on a local port and relays every connection
+to a target host and port, eg. to reach a remote LDAP server as if it were
+local, without an external process per forward. Connections are handled by
+callbacks on the tunnel manager's :class:`calabar.tunnels.loop.EventLoop`
+with non-blocking sockets. Each direction of a connection relays through one
+fixed buffer, filled with ``recv_into`` and drained with ``send`` on a
+``memoryview`` of it, so no new string is allocated per chunk.
+
+Each forward accepts at most ``max_connections`` connections at once (extra
+connections are closed straight away), closes connections that see no traffic
+for ``idle_timeout`` seconds and counts the bytes it relays in each direction.
+"""
+
+import errno
+import socket
+import sys
+import time
+
+from calabar.tunnels import TUN_TYPE_STR
+from calabar.tunnels.base import TunnelBase, TunnelTypeDoesNotMatch
+from calabar.tunnels.ssh import parse_local, parse_remote
+from calabar.tunnels.states import STOPPED
+
+MAX_CONNECTIONS = 256 # Connections a forward relays at once
+IDLE_TIMEOUT = 300 # Seconds without traffic before a connection is closed
+BUFFER_SIZE = 16 * 1024 # Bytes buffered in each direction of a connection
+LISTEN_BACKLOG = 128
+ACCEPT_PAUSE = 0.1 # Seconds to stop accepting after an error, eg. out of fds
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+def _would_block(e):
+    return e.args and e.args[0] in _WOULD_BLOCK
+
+def resolve(target, socktype):
+    """
+    Look up the ``(host, port)`` tuple ``target`` once, when a forward starts,
+    so that relaying never blocks on DNS. Returns a ``(family, address)``
+    tuple.
+    """
+    family, socktype, proto, name, addr = socket.getaddrinfo(
+        target[0], target[1], 0, socktype)[0]
+    return family, addr
+
+class Forwarder(object):
+    """
+    Relay connections accepted on ``listen`` (an ``(address, port)`` tuple)
+    to ``target`` (a ``(host, port)`` tuple).
+
+    ``bytes_in`` counts the bytes relayed from clients to the target and
+    ``bytes_out`` those relayed back. The counters, like ``accepted``,
+    ``refused`` (over ``max_connections``), ``failed`` (couldn't reach the
+    target) and ``accept_errors`` (couldn't accept a connection at all, eg.
+    because ``calabard`` ran out of file descriptors), keep counting across
+    restarts.
+    """
+    def __init__(self, listen, target, max_connections=MAX_CONNECTIONS,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.listen = listen
+        self.target = target
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.loop = None
+        self.sock = None
+        self.connections = set()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.accepted = 0
+        self.refused = 0
+        self.failed = 0
+        self.accept_errors = 0
+        self._target_addr = None
+        self._paused = None # Timer resuming accepts after an error, if paused
+
+    def start(self, loop):
+        """
+        Start listening and accepting connections on ``loop``.
+        """
+        self._target_addr = resolve(self.target, socket.SOCK_STREAM)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(self.listen)
+            sock.listen(LISTEN_BACKLOG)
+            sock.setblocking(0)
+        except socket.error:
+            sock.close()
+            raise
+        self.loop = loop
+        self.sock = sock
+        # The actual port, if we were asked for any free one
+        self.listen = sock.getsockname()
+        loop.add_reader(sock.fileno(), self._accept)
+
+    def stop(self):
+        """
+        Stop listening and close every open connection.
+        """
+        if self._paused is not None:
+            self._paused.cancel()
+            self._paused = None
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+        for conn in list(self.connections):
+            conn.close()
+
+    def is_listening(self):
+        return self.sock is not None
+
+    def _accept(self):
+        while True:
+            try:
+                client, addr = self.sock.accept()
+            except socket.error, e:
+                if _would_block(e) or e.args[0] == errno.ECONNABORTED:
+                    return
+                # Eg. EMFILE, which mustn't take the whole loop down with it.
+                # The connection stays queued, so stop trying for a moment
+                # rather than spinning on it.
+                self.accept_errors += 1
+                print >> sys.stderr, "FORWARD ACCEPT FAILED: %s:%s: %s" % (
+                    self.listen[0], self.listen[1], e)
+                self._pause()
+                return
+            if len(self.connections) >= self.max_connections:
+                self.refused += 1
+                client.close()
+                continue
+
+            try:
+                conn = _Connection(self, client)
+            except socket.error:
+                # Couldn't create the upstream socket
+                self.failed += 1
+                client.close()
+                continue
+            if not conn.closed:
+                # Only once it's connecting, not if the connect failed outright
+                self.accepted += 1
+
+    def _pause(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self._paused = self.loop.call_later(ACCEPT_PAUSE, self._resume)
+
+    def _resume(self):
+        self._paused = None
+        if self.sock is not None:
+            self.loop.add_reader(self.sock.fileno(), self._accept)
+
+class _Connection(object):
+    """
+    A client connection and its connection to the target.
+    """
+    __slots__ = ('forwarder', 'loop', 'client', 'upstream', 'pipes',
+                 'last_active', 'timer', 'closed')
+
+    def __init__(self, forwarder, client):
+        self.forwarder = forwarder
+        self.loop = forwarder.loop
+        self.client = client
+        self.pipes = ()
+        self.closed = False
+        self.last_active = time.time()
+        family, addr = forwarder._target_addr
+        self.upstream = socket.socket(family, socket.SOCK_STREAM)
+        forwarder.connections.add(self)
+
+        client.setblocking(0)
+        self.upstream.setblocking(0)
+        # Connecting counts as idle time, so this also bounds the connect
+        self.timer = self.loop.call_later(forwarder.idle_timeout, self._check_idle)
+
+        err = self.upstream.connect_ex(addr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._failed()
+            return
+        self.loop.add_writer(self.upstream.fileno(), self._connected)
+
+    def _connected(self):
+        self.loop.remove_writer(self.upstream.fileno())
+        err = self.upstream.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._failed()
+            return
+
+        self.pipes = (_Pipe(self, self.client, self.upstream, True),
+                      _Pipe(self, self.upstream, self.client, False))
+        for pipe in self.pipes:
+            pipe.resume()
+
+    def _failed(self):
+        self.forwarder.failed += 1
+        self.close()
+
+    def _check_idle(self):
+        idle = time.time() - self.last_active
+        if idle >= self.forwarder.idle_timeout:
+            self.close()
+        else:
+            self.timer = self.loop.call_later(
+                self.forwarder.idle_timeout - idle, self._check_idle)
+
+    def pipe_finished(self):
+        for pipe in self.pipes:
+            if not pipe.finished():
+                return
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.timer.cancel()
+        self.forwarder.connections.discard(self)
+        for sock in (self.client, self.upstream):
+            self.loop.remove_reader(sock.fileno())
+            self.loop.remove_writer(sock.fileno())
+            sock.close()
+
+class _Pipe(object):
+    """
+    One direction of a connection: bytes read from ``src`` are written to
+    ``dst`` through a fixed buffer. Reading stops while the buffer waits for
+    ``dst`` to accept it.
+    """
+    __slots__ = ('conn', 'src', 'dst', 'inbound', 'buf', 'view', 'start', 'end',
+                 'eof')
+
+    def __init__(self, conn, src, dst, inbound):
+        self.conn = conn
+        self.src = src
+        self.dst = dst
+        self.inbound = inbound # From the client to the target?
+        self.buf = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0
+        self.eof = False
+
+    def finished(self):
+        return self.eof and self.start == self.end
+
+    def resume(self):
+        self.conn.loop.add_reader(self.src.fileno(), self._readable)
+
+    def _readable(self):
+        try:
+            n = self.src.recv_into(self.buf)
+        except socket.error, e:
+            if _would_block(e):
+                return
+            self.conn.close()
+            return
+
+        loop = self.conn.loop
+        if not n:
+            self.eof = True
+            loop.remove_reader(self.src.fileno())
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            self.conn.pipe_finished()
+            return
+
+        self.conn.last_active = time.time()
+        if self.inbound:
+            self.conn.forwarder.bytes_in += n
+        else:
+            self.conn.forwarder.bytes_out += n
+        self.start, self.end = 0, n
+        if not self._flush():
+            if self.conn.closed:
+                # dst was reset, which closed both sockets
+                return
+            # Wait for dst to drain before reading any more
+            loop.remove_reader(self.src.fileno())
+            loop.add_writer(self.dst.fileno(), self._writable)
+
+    def _writable(self):
+        if self._flush():
+            self.conn.loop.remove_writer(self.dst.fileno())
+            self.resume()
+
+    def _flush(self):
+        """
+        Write as much of the buffer as ``dst`` accepts. Returns whether it
+        was all written.
+        """
+        while self.start < self.end:
+            try:
+                self.start += self.dst.send(self.view[self.start:self.end])
+            except socket.error, e:
+                if _would_block(e):
+                    return False
+                self.conn.close()
+                return False
+
+        return True
+
+class ForwardTunnel(TunnelBase):
+    """
+    Forward connections to ``listen_address:listen_port`` to
+    ``target_host:target_port`` from inside ``calabard``.
+
+    The tunnel manager hands in-process tunnels its event loop as
+    :attr:`loop` before opening them.
+    """
+    TUNNEL_TYPE = 'forward'
+    IN_PROCESS = True
+    FORWARDER = Forwarder # Relays the traffic; see calabar.tunnels.udp
+    PORT_OPTION = 'listen_port'
+    __slots__ = ('forwarder', 'loop')
+
+    def __init__(self, listen_port, target_host, target_port,
+                 listen_address='127.0.0.1', max_connections=MAX_CONNECTIONS,
+                 idle_timeout=IDLE_TIMEOUT, tunnel_type=None, *args, **kwargs):
+        if tunnel_type and tunnel_type != self.TUNNEL_TYPE:
+            raise TunnelTypeDoesNotMatch(
+                'Tunnel type <%s> does not match expected <%s>' % (tunnel_type, self.TUNNEL_TYPE))
+
+        self.forwarder = self.FORWARDER((listen_address, listen_port),
+                                        (target_host, target_port),
+                                        max_connections, idle_timeout)
+        self.loop = None
+
+        super(ForwardTunnel, self).__init__([], None, *args, **kwargs)
+
+    def find_executable(self):
+        # Forwards run inside calabard itself
+        return sys.executable
+
+    def _open(self, cmd, executable):
+        self.forwarder.start(self.loop)
+        return None
+
+    def is_running(self, snapshot=None):
+        return self.forwarder.is_listening()
+
+    def close(self, wait=True, force=False):
+        """
+        Stop listening and close every connection. Nothing is left to wait
+        for, so the tunnel is stopped as soon as this returns.
+        """
+        self.forwarder.stop()
+        self.set_state(STOPPED)
+
+    @staticmethod
+    def parse_configuration(config, section_name):
+        """
+        Parse out the required tunnel information from the given
+        :mod:ConfigParser.ConfigParser instance, with this tunnel being
+        represented by the tunnel at ``section_name``.
+
+        Returns a dictionary with options corresponding to those taken by
+        :member:`__init__`
+        """
+        tun_conf_d = {}
+        tun_conf_d[TUN_TYPE_STR] = ForwardTunnel.TUNNEL_TYPE
+        address, port = parse_local(config.get(section_name, 'listen'))
+        tun_conf_d['listen_address'] = address
+        tun_conf_d['listen_port'] = port
+        host, port = parse_remote(config.get(section_name, 'target'))
+        tun_conf_d['target_host'] = host
+        tun_conf_d['target_port'] = port
+
+        # Optional parts
+        if config.has_option(section_name, 'max_connections'):
+            tun_conf_d['max_connections'] = config.getint(
+                section_name, 'max_connections')
+        if config.has_option(section_name, 'idle_timeout'):
+            tun_conf_d['idle_timeout'] = config.getfloat(
+                section_name, 'idle_timeout')
+
+        return tun_conf_d
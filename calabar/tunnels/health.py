@@ -0,0 +1,179 @@
+"""
+calabar.tunnels.health
+
+Health probes for tunnels.
+
+A tunnel process being alive doesn't mean traffic is flowing through it. Each
+tunnel can be given probes that check a target through the tunnel:
+
+``tcp:<host>:<port>``
+    A TCP connection to ``host:port`` must succeed.
+``reach:<host>:<port>``
+    ``host`` must answer a TCP connection attempt on ``port``, even if only to
+    refuse it. This checks reachability without needing ICMP or a listening
+    service.
+
+All of the probes in a :class:`ProbeRound` are non-blocking connects
+multiplexed on a single :class:`calabar.tunnels.loop.EventLoop`, so probing
+hundreds of tunnels costs one thread and takes at most ``timeout`` seconds.
+"""
+
+import errno
+import socket
+
+from calabar.tunnels.loop import EventLoop
+
+PROBE_INTERVAL = 5 # Seconds between probe rounds
+PROBE_TIMEOUT = 2 # Seconds before an unanswered probe fails
+PROBE_FAILURES = 2 # Consecutive failed rounds before a tunnel is recycled
+
+PROBE_KINDS = ['tcp', 'reach']
+
+class InvalidProbe(Exception):
+    """
+    A probe definition couldn't be parsed.
+    """
+    pass
+
+class Probe(object):
+    """
+    A single health check against ``host:port``.
+    """
+    def __init__(self, kind, host, port):
+        if kind not in PROBE_KINDS:
+            raise InvalidProbe("Unknown probe type <%s>" % kind)
+        self.kind = kind
+        self.host = host
+        self.port = port
+        self.key = (kind, host, port)
+
+    @classmethod
+    def parse(cls, probe_str):
+        """
+        Create a :class:`Probe` from a ``<kind>:<host>:<port>`` string.
+        """
+        try:
+            kind, host, port = probe_str.strip().split(':')
+            port = int(port)
+        except ValueError:
+            raise InvalidProbe(
+                "Probe <%s> isn't in the form <kind>:<host>:<port>" % probe_str)
+
+        return cls(kind, host, port)
+
+    def passed(self, err):
+        """
+        Did the probe pass given the ``errno`` its connection attempt ended
+        with?
+        """
+        if err == 0:
+            return True
+        if self.kind == 'reach' and err == errno.ECONNREFUSED:
+            return True
+        return False
+
+    def __str__(self):
+        return '%s:%s:%s' % self.key
+
+    def __repr__(self):
+        return '<Probe %s>' % self
+
+class ProbeRound(object):
+    """
+    Run a batch of probes concurrently on an event loop.
+
+    Probes with the same target are only run once. ``callback`` is called with
+    a dictionary mapping each probe's ``key`` to whether it passed once every
+    probe has finished or ``timeout`` seconds have passed.
+    """
+    def __init__(self, probes, callback, timeout=PROBE_TIMEOUT):
+        self.probes = {}
+        for probe in probes:
+            self.probes[probe.key] = probe
+        self.callback = callback
+        self.timeout = timeout
+        self.results = {}
+        self._socks = {}
+        self._loop = None
+        self._timer = None
+
+    def done(self):
+        return len(self.results) == len(self.probes)
+
+    def start(self, loop):
+        self._loop = loop
+        for key, probe in self.probes.items():
+            self._connect(probe)
+
+        if self.done():
+            self._finished()
+        else:
+            self._timer = loop.call_later(self.timeout, self._expire)
+
+    def _connect(self, probe):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        try:
+            err = sock.connect_ex((probe.host, probe.port))
+        except socket.error, e:
+            err = e.args[0]
+
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._socks[probe.key] = sock
+            self._loop.add_writer(sock.fileno(), self._connected, probe)
+        else:
+            sock.close()
+            self.results[probe.key] = probe.passed(err)
+
+    def _connected(self, probe):
+        sock = self._socks.pop(probe.key)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self._loop.remove_writer(sock.fileno())
+        sock.close()
+
+        self.results[probe.key] = probe.passed(err)
+        if self.done():
+            self._finished()
+
+    def _expire(self):
+        self._timer = None
+        for key, sock in self._socks.items():
+            self._loop.remove_writer(sock.fileno())
+            sock.close()
+            self.results[key] = False
+        self._socks = {}
+
+        self._finished()
+
+    def _finished(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self.callback(self.results)
+
+def run_probes(probes, timeout=PROBE_TIMEOUT):
+    """
+    Run ``probes`` concurrently, blocking until they've all finished, and
+    return the :attr:`ProbeRound.results`.
+    """
+    loop = EventLoop()
+    try:
+        probe_round = ProbeRound(probes, lambda results: None, timeout)
+        probe_round.start(loop)
+        while not probe_round.done():
+            loop.run_once()
+    finally:
+        loop.close()
+
+    return probe_round.results
+
+def is_healthy(tunnel, results):
+    """
+    A tunnel is healthy if any of its probes passed. A host behind the tunnel
+    going down shouldn't get the whole tunnel recycled, but a wedged tunnel
+    fails every probe.
+    """
+    for probe in tunnel.probes:
+        if results.get(probe.key):
+            return True
+    return False
@@ -0,0 +1,220 @@
+"""
+calabar.tunnels.ips
+
+IPv4 address lists for split tunnels.
+
+A tunnel's ``ips`` may contain single addresses (``10.0.0.1``), CIDR blocks
+(``10.0.0.0/24``) and ranges (``10.0.0.5-10.0.0.20`` or ``10.0.0.5-20``).
+Internally each entry is an inclusive interval of integer addresses. Merging
+the intervals and covering them with :func:`collapse` gives the fewest CIDR
+prefixes that route exactly the same addresses, so a tunnel listing thousands
+of neighbouring hosts installs a handful of routes rather than thousands.
+
+A :class:`RouteIndex` combines the address lists of every tunnel to find
+tunnels that claim the same addresses and to look up which tunnel routes a
+given address.
+"""
+
+import socket
+import struct
+from array import array
+from bisect import bisect_right
+
+MAX_ADDRESS = 2 ** 32 - 1
+# The smallest array type that holds an IPv4 address
+ADDRESS_TYPECODE = array('I').itemsize >= 4 and 'I' or 'L'
+
+class InvalidAddress(Exception):
+    """
+    An IP address, CIDR block or range couldn't be parsed.
+    """
+    pass
+
+def ip_to_int(ip):
+    """
+    Convert a dotted-quad IPv4 address to an integer.
+    """
+    ip = ip.strip()
+    if len(ip.split('.')) != 4:
+        # inet_aton also accepts shorthand like "10.1", which is never meant
+        raise InvalidAddress("<%s> isn't an IPv4 address" % ip)
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except socket.error:
+        raise InvalidAddress("<%s> isn't an IPv4 address" % ip)
+
+def int_to_ip(n):
+    """
+    Convert an integer to a dotted-quad IPv4 address.
+    """
+    return socket.inet_ntoa(struct.pack('!I', n))
+
+def masklen_to_mask(masklen):
+    """
+    Convert a prefix length to a dotted-quad netmask, eg. ``24`` to
+    ``255.255.255.0``.
+    """
+    return int_to_ip((MAX_ADDRESS << (32 - masklen)) & MAX_ADDRESS)
+
+def parse_range(spec):
+    """
+    Return the inclusive ``(first, last)`` integer addresses covered by an
+    address, CIDR block or range string.
+    """
+    spec = spec.strip()
+    if '/' in spec:
+        ip, masklen = spec.split('/', 1)
+        try:
+            masklen = int(masklen)
+        except ValueError:
+            masklen = -1
+        if not 0 <= masklen <= 32:
+            raise InvalidAddress("<%s> doesn't have a valid prefix length" % spec)
+        size = 2 ** (32 - masklen)
+        first = ip_to_int(ip) & ~(size - 1) & MAX_ADDRESS
+        return first, first + size - 1
+
+    if '-' in spec:
+        first, last = spec.split('-', 1)
+        first = ip_to_int(first)
+        if '.' in last:
+            last = ip_to_int(last)
+        else:
+            # Shorthand for the last octet, eg. 10.0.0.5-20
+            try:
+                octet = int(last)
+            except ValueError:
+                octet = -1
+            if not 0 <= octet <= 255:
+                raise InvalidAddress("<%s> isn't a valid range" % spec)
+            last = (first & ~0xff) | octet
+        if last < first:
+            raise InvalidAddress("<%s> ends before it starts" % spec)
+        return first, last
+
+    n = ip_to_int(spec)
+    return n, n
+
+def merge_intervals(intervals):
+    """
+    Sort inclusive ``(first, last)`` intervals and merge the ones that overlap
+    or touch.
+    """
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+
+    return merged
+
+def interval_to_prefixes(first, last):
+    """
+    Return the fewest ``(network, masklen)`` CIDR prefixes that exactly cover
+    the addresses from ``first`` to ``last`` inclusive.
+    """
+    prefixes = []
+    while first <= last:
+        # The largest block that is aligned at first and doesn't pass last
+        size = first & -first if first else 2 ** 32
+        while size > last - first + 1:
+            size >>= 1
+        masklen = 32 - (size.bit_length() - 1)
+        prefixes.append((first, masklen))
+        first += size
+
+    return prefixes
+
+def collapse(specs):
+    """
+    Return the fewest ``(network, masklen)`` CIDR prefixes covering every
+    address, CIDR block and range in ``specs``, in address order.
+    """
+    prefixes = []
+    for first, last in merge_intervals([parse_range(s) for s in specs]):
+        prefixes += interval_to_prefixes(first, last)
+
+    return prefixes
+
+class RouteIndex(object):
+    """
+    The addresses routed by every tunnel, as sorted, disjoint segments.
+
+    ``routes`` maps tunnel names to their lists of addresses, CIDR blocks and
+    ranges. Building the index sorts the boundaries of every tunnel's merged
+    intervals once, O(n log n) in the number of entries, and splits the
+    address space into segments that each have a fixed set of tunnels. The
+    segment bounds are kept in packed arrays so tens of thousands of entries
+    stay small, and :meth:`lookup` is a binary search.
+    """
+    def __init__(self, routes):
+        events = []
+        for name, specs in routes.items():
+            for first, last in merge_intervals([parse_range(s) for s in specs]):
+                events.append((first, 1, name))
+                events.append((last + 1, -1, name))
+        events.sort()
+
+        self._firsts = array(ADDRESS_TYPECODE)
+        self._lasts = array(ADDRESS_TYPECODE)
+        self._owners = []
+
+        active = set()
+        i = 0
+        while i < len(events):
+            pos = events[i][0]
+            while i < len(events) and events[i][0] == pos:
+                if events[i][1] > 0:
+                    active.add(events[i][2])
+                else:
+                    active.discard(events[i][2])
+                i += 1
+            if not active:
+                continue
+            # Every interval ends with an event, so an active set always has a
+            # following boundary
+            last = events[i][0] - 1
+            owners = tuple(sorted(active))
+            if self._owners and self._owners[-1] == owners and \
+               self._lasts[-1] + 1 == pos:
+                self._lasts[-1] = last
+            else:
+                self._firsts.append(pos)
+                self._lasts.append(last)
+                self._owners.append(owners)
+
+    def __len__(self):
+        return len(self._firsts)
+
+    def lookup(self, ip):
+        """
+        Return the names of the tunnels that route the address ``ip``. More
+        than one name means the tunnels conflict.
+        """
+        n = ip_to_int(ip)
+        i = bisect_right(self._firsts, n) - 1
+        if i >= 0 and n <= self._lasts[i]:
+            return list(self._owners[i])
+        return []
+
+    def conflicts(self):
+        """
+        Return a dictionary mapping each ``(name, other_name)`` pair of tunnels
+        that claim the same addresses to the inclusive ``(first, last)``
+        integer ranges they share.
+        """
+        conflicts = {}
+        for i, owners in enumerate(self._owners):
+            if len(owners) < 2:
+                continue
+            for a in range(len(owners)):
+                for b in range(a + 1, len(owners)):
+                    shared = conflicts.setdefault((owners[a], owners[b]), [])
+                    if shared and shared[-1][1] + 1 == self._firsts[i]:
+                        shared[-1] = (shared[-1][0], self._lasts[i])
+                    else:
+                        shared.append((self._firsts[i], self._lasts[i]))
+
+        return conflicts
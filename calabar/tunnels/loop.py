@@ -0,0 +1,236 @@
+"""
+calabar.tunnels.loop
+
+A small single-threaded event loop for driving tunnel supervision.
+
+The loop multiplexes file descriptors with ``epoll`` (falling back to
+``select`` where ``epoll`` isn't available) and keeps a heap of timers. Signals
+are turned into readable events with the self-pipe trick via
+:func:`signal.set_wakeup_fd`, so a child exiting wakes the loop immediately
+instead of waiting for the next polling interval, and an idle loop sleeps in
+the kernel rather than spinning.
+"""
+
+import errno
+import fcntl
+import heapq
+import math
+import os
+import select
+import signal
+import time
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def _is_eintr(e):
+    return getattr(e, 'errno', None) == errno.EINTR or \
+           (e.args and e.args[0] == errno.EINTR)
+
+class Timer(object):
+    """
+    A handle to a callback scheduled with :meth:`EventLoop.call_later`.
+    """
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+class EventLoop(object):
+    """
+    Dispatch readable/writable file descriptors and expired timers to
+    callbacks.
+
+    Only ONE loop per process should call :meth:`watch_signals` since there is
+    only a single signal wakeup fd per process.
+    """
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+        self._registered = set() # fds registered with epoll
+        self._timers = []
+        self._running = False
+        self._wakeup_r = None
+        self._wakeup_w = None
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+        else:
+            self._epoll = None
+
+    def add_reader(self, fd, callback, *args):
+        """
+        Call ``callback(*args)`` whenever ``fd`` is readable.
+        """
+        self._readers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        if self._readers.pop(fd, None):
+            self._update(fd)
+
+    def add_writer(self, fd, callback, *args):
+        """
+        Call ``callback(*args)`` whenever ``fd`` is writable.
+        """
+        self._writers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        if self._writers.pop(fd, None):
+            self._update(fd)
+
+    def _update(self, fd):
+        """
+        Bring the epoll registration for ``fd`` in line with its callbacks.
+        """
+        if not self._epoll:
+            return
+
+        mask = 0
+        if fd in self._readers:
+            mask |= select.EPOLLIN
+        if fd in self._writers:
+            mask |= select.EPOLLOUT
+
+        try:
+            if not mask:
+                if fd in self._registered:
+                    self._registered.discard(fd)
+                    self._epoll.unregister(fd)
+            elif fd in self._registered:
+                self._epoll.modify(fd, mask)
+            else:
+                self._epoll.register(fd, mask)
+                self._registered.add(fd)
+        except (IOError, OSError, ValueError):
+            # The fd was already closed out from under us
+            self._registered.discard(fd)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Call ``callback(*args)`` after ``delay`` seconds. Returns a
+        :class:`Timer` that can be cancelled.
+        """
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self._timers, timer)
+
+        return timer
+
+    def call_soon(self, callback, *args):
+        return self.call_later(0, callback, *args)
+
+    def watch_signals(self, callback, *args):
+        """
+        Call ``callback(*args)`` after any signal with a python handler is
+        delivered to the process. The signal's own handler will already have
+        run by the time ``callback`` is called.
+        """
+        if self._wakeup_r is None:
+            self._wakeup_r, self._wakeup_w = os.pipe()
+            set_nonblocking(self._wakeup_r)
+            set_nonblocking(self._wakeup_w)
+            signal.set_wakeup_fd(self._wakeup_w)
+
+        self.add_reader(self._wakeup_r, self._drain_wakeup, callback, args)
+
+    def _drain_wakeup(self, callback, args):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        callback(*args)
+
+    def run_once(self, timeout=None):
+        """
+        Wait for at most ``timeout`` seconds (or until the next timer is due)
+        for events and dispatch them.
+        """
+        while self._timers and self._timers[0].cancelled:
+            heapq.heappop(self._timers)
+        if self._timers:
+            until_timer = max(0, self._timers[0].when - time.time())
+            if timeout is None or until_timer < timeout:
+                timeout = until_timer
+
+        for fd, readable, writable in self._poll(timeout):
+            if readable and fd in self._readers:
+                callback, args = self._readers[fd]
+                callback(*args)
+            if writable and fd in self._writers:
+                callback, args = self._writers[fd]
+                callback(*args)
+
+        now = time.time()
+        while self._timers and self._timers[0].when <= now:
+            timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+    def run_forever(self):
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        self._running = False
+
+    def close(self):
+        if self._wakeup_r is not None:
+            signal.set_wakeup_fd(-1)
+            self.remove_reader(self._wakeup_r)
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            self._wakeup_r = self._wakeup_w = None
+        if self._epoll:
+            self._epoll.close()
+
+    def close_after_fork(self):
+        """
+        Close the loop in a forked child. Nothing is unregistered, since the
+        epoll instance is shared with the parent, which still uses it.
+        """
+        if self._wakeup_r is not None:
+            signal.set_wakeup_fd(-1)
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            self._wakeup_r = self._wakeup_w = None
+        if self._epoll:
+            self._epoll.close()
+            self._epoll = None
+        self._readers.clear()
+        self._writers.clear()
+        self._registered.clear()
+        self._timers = []
+
+    def _poll(self, timeout):
+        try:
+            if self._epoll:
+                if timeout is None:
+                    timeout = -1
+                else:
+                    # epoll truncates to milliseconds which would wake us just
+                    # before a timer is due
+                    timeout = math.ceil(timeout * 1000) / 1000.0
+                readable = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+                writable = select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP
+                return [(fd, event & readable, event & writable)
+                        for fd, event in self._epoll.poll(timeout)]
+            readable, writable, _ = select.select(
+                self._readers.keys(), self._writers.keys(), [], timeout)
+            return [(fd, True, False) for fd in readable] + \
+                   [(fd, False, True) for fd in writable]
+        except (select.error, IOError, OSError), e:
+            if _is_eintr(e):
+                # A signal arrived. Its wakeup byte will be picked up next time
+                return []
+            raise
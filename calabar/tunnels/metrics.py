@@ -0,0 +1,372 @@
+"""
+calabar.tunnels.metrics
+
+Supervisor metrics in the `Prometheus text format`_.
+
+:class:`Metrics` is updated by the tunnel manager as tunnels start and exit
+and as supervision passes run. Each tunnel's samples are rendered once when
+its state changes and cached, so a scrape with hundreds of tunnels mostly
+joins cached strings and never looks at the process table. A
+:class:`MetricsServer` serves them over HTTP from the manager's
+:class:`calabar.tunnels.loop.EventLoop` without ever blocking on a client.
+
+.. _`Prometheus text format`: https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+import errno
+import socket
+import sys
+import time
+from bisect import bisect_left
+
+from calabar.tunnels.procs import ProcessSnapshot
+
+METRICS_ADDRESS = '127.0.0.1'
+METRICS_PATH = '/metrics'
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Histogram bucket upper bounds, in seconds
+DETECT_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60)
+RESTART_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+SUPERVISE_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+MAX_REQUEST_SIZE = 8192 # Bytes of request headers we'll buffer from a client
+CLIENT_TIMEOUT = 10 # Seconds a client gets to send its request and read ours
+ACCEPT_PAUSE = 0.1 # Seconds to stop accepting after an error, eg. out of fds
+
+# (name, type, help) of the samples kept for every tunnel
+TUNNEL_FAMILIES = (
+    ('calabar_tunnel_up', 'gauge',
+     'Whether the tunnel process is running.'),
+    ('calabar_tunnel_starts_total', 'counter',
+     'Times the tunnel process was launched.'),
+    ('calabar_tunnel_restarts_total', 'counter',
+     'Times the tunnel process was launched again after it exited.'),
+    ('calabar_tunnel_last_start_timestamp_seconds', 'gauge',
+     'Unix time at which the tunnel process was last launched.'),
+)
+UPTIME_FAMILY = ('calabar_tunnel_uptime_seconds', 'gauge',
+                 'Seconds since the running tunnel process was launched.')
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _header(name, metric_type, help):
+    return '# HELP %s %s\n# TYPE %s %s\n' % (name, help, name, metric_type)
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class Histogram(object):
+    """
+    A Prometheus histogram with fixed bucket upper bounds.
+    """
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self):
+        lines = [_header(self.name, 'histogram', self.help)]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %s\n' % (self.name, bound, cumulative))
+        lines.append('%s_bucket{le="+Inf"} %s\n' % (self.name, self.count))
+        lines.append('%s_sum %s\n' % (self.name, _format(self.sum)))
+        lines.append('%s_count %s\n' % (self.name, self.count))
+
+        return ''.join(lines)
+
+class TunnelMetrics(object):
+    """
+    The metrics of a single tunnel.
+
+    ``exited_at`` is set while the tunnel is down after an exit so that the
+    next start can be timed.
+    """
+    __slots__ = ('name', 'up', 'starts', 'last_start', 'exited_at', '_samples')
+
+    def __init__(self, name):
+        self.name = name
+        self.up = False
+        self.starts = 0
+        self.last_start = None
+        self.exited_at = None
+        self._samples = None
+
+    def samples(self):
+        """
+        Return one sample line per entry in ``TUNNEL_FAMILIES``, rendering them
+        only if the tunnel changed since the last call.
+        """
+        if self._samples is None:
+            label = '{tunnel="%s"}' % _escape(self.name)
+            values = (int(self.up), self.starts, max(0, self.starts - 1),
+                      self.last_start or 0)
+            self._samples = [
+                '%s%s %s\n' % (family[0], label, _format(value))
+                for family, value in zip(TUNNEL_FAMILIES, values)]
+
+        return self._samples
+
+    def changed(self):
+        self._samples = None
+
+class Metrics(object):
+    """
+    Everything the tunnel manager reports about itself.
+    """
+    def __init__(self):
+        self.tunnels = {} # tunnel name -> TunnelMetrics
+        self._names = None # Sorted tunnel names, rebuilt when tunnels change
+        self.detect = Histogram(
+            'calabar_exit_detect_seconds',
+            'Seconds between a tunnel process exiting and the supervisor '
+            'noticing. Exits noticed by polling count the whole poll interval.',
+            DETECT_BUCKETS)
+        self.restart = Histogram(
+            'calabar_restart_seconds',
+            'Seconds between noticing a tunnel exit and launching it again.',
+            RESTART_BUCKETS)
+        self.supervise = Histogram(
+            'calabar_supervise_seconds',
+            'Seconds spent in each supervision pass.',
+            SUPERVISE_BUCKETS)
+
+    def track(self, name):
+        """
+        Start reporting the tunnel ``name`` (as down until it's started) and
+        return its :class:`TunnelMetrics`.
+        """
+        try:
+            return self.tunnels[name]
+        except KeyError:
+            tm = TunnelMetrics(name)
+            self.tunnels[name] = tm
+            self._names = None
+            return tm
+
+    def started(self, name, now=None):
+        """
+        Record that the tunnel ``name`` was launched.
+        """
+        if now is None:
+            now = time.time()
+        tm = self.track(name)
+        if tm.exited_at is not None:
+            self.restart.observe(max(0, now - tm.exited_at))
+        tm.up = True
+        tm.starts += 1
+        tm.last_start = now
+        tm.exited_at = None
+        tm.changed()
+
+    def exited(self, name, now=None, exited_at=None):
+        """
+        Record that the supervisor noticed the tunnel ``name`` exit at ``now``.
+        ``exited_at`` is when the exit happened, if known.
+
+        Calling this again before the tunnel is started is harmless.
+        """
+        tm = self.tunnels.get(name)
+        if tm is None or not tm.up:
+            return
+        if now is None:
+            now = time.time()
+        if exited_at is not None:
+            self.detect.observe(max(0, now - exited_at))
+        tm.up = False
+        tm.exited_at = now
+        tm.changed()
+
+    def removed(self, name):
+        """
+        Stop reporting the tunnel ``name``.
+        """
+        if self.tunnels.pop(name, None):
+            self._names = None
+
+    def render(self, now=None):
+        """
+        Return every metric in the Prometheus text format.
+        """
+        if now is None:
+            now = time.time()
+        if self._names is None:
+            self._names = sorted(self.tunnels)
+        tunnels = [self.tunnels[name] for name in self._names]
+        samples = [tm.samples() for tm in tunnels]
+
+        out = [_header('calabar_tunnels', 'gauge', 'Tunnels being managed.'),
+               'calabar_tunnels %s\n' % len(tunnels)]
+        for i, family in enumerate(TUNNEL_FAMILIES):
+            out.append(_header(*family))
+            out.extend([s[i] for s in samples])
+
+        out.append(_header(*UPTIME_FAMILY))
+        for tm in tunnels:
+            if tm.up:
+                out.append('%s{tunnel="%s"} %.3f\n' % (
+                    UPTIME_FAMILY[0], _escape(tm.name), now - tm.last_start))
+
+        out.append(self.detect.render())
+        out.append(self.restart.render())
+        out.append(self.supervise.render())
+
+        out.append(_header('calabar_process_reads_total', 'counter',
+                           'Process table lookups made while supervising.'))
+        out.append('calabar_process_reads_total %s\n' % ProcessSnapshot.reads)
+        out.append(_header('calabar_process_read_seconds_total', 'counter',
+                           'Seconds spent on process table lookups.'))
+        out.append('calabar_process_read_seconds_total %s\n' %
+                   _format(ProcessSnapshot.read_seconds))
+
+        return ''.join(out)
+
+class MetricsServer(object):
+    """
+    A minimal HTTP server answering ``GET /metrics`` with ``render()``.
+
+    Every socket is non-blocking and handled by callbacks on the event loop
+    passed to :meth:`start`, so a slow or stuck client never holds up tunnel
+    supervision.
+    """
+    def __init__(self, render, port, address=METRICS_ADDRESS):
+        self.render = render
+        self.port = port
+        self.address = address
+        self.sock = None
+        self._loop = None
+        self._clients = {} # fd -> _Client
+        self._paused = None # Timer resuming accepts after an error, if paused
+
+    def start(self, loop):
+        self._loop = loop
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.address, self.port))
+        self.sock.listen(16)
+        self.sock.setblocking(0)
+        # The actual port, if we were asked for any free one
+        self.port = self.sock.getsockname()[1]
+        loop.add_reader(self.sock.fileno(), self._accept)
+
+    def close(self):
+        for client in self._clients.values():
+            self._close_client(client)
+        if self._paused is not None:
+            self._paused.cancel()
+            self._paused = None
+        if self.sock:
+            self._loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR,
+                                 errno.ECONNABORTED):
+                    return
+                # Eg. EMFILE, which a scrape mustn't take the supervisor down
+                # with. The connection stays queued, so stop trying for a
+                # moment rather than spinning on it.
+                print >> sys.stderr, "METRICS ACCEPT FAILED: %s" % e
+                self._pause()
+                return
+            conn.setblocking(0)
+            client = _Client(conn)
+            client.timer = self._loop.call_later(
+                CLIENT_TIMEOUT, self._close_client, client)
+            self._clients[conn.fileno()] = client
+            self._loop.add_reader(conn.fileno(), self._read, client)
+
+    def _pause(self):
+        self._loop.remove_reader(self.sock.fileno())
+        self._paused = self._loop.call_later(ACCEPT_PAUSE, self._resume)
+
+    def _resume(self):
+        self._paused = None
+        if self.sock:
+            self._loop.add_reader(self.sock.fileno(), self._accept)
+
+    def _read(self, client):
+        try:
+            data = client.conn.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self._close_client(client)
+            return
+
+        client.request += data
+        if '\r\n\r\n' not in client.request and \
+           len(client.request) < MAX_REQUEST_SIZE:
+            return
+
+        self._loop.remove_reader(client.conn.fileno())
+        client.response = self._respond(client.request)
+        self._loop.add_writer(client.conn.fileno(), self._write, client)
+
+    def _respond(self, request):
+        try:
+            method, path = request.split('\r\n', 1)[0].split()[:2]
+        except ValueError:
+            return self._response('400 Bad Request', 'Bad request\n')
+        if method != 'GET':
+            return self._response('405 Method Not Allowed', 'GET only\n')
+        if path.split('?', 1)[0] != METRICS_PATH:
+            return self._response('404 Not Found', 'Try %s\n' % METRICS_PATH)
+
+        return self._response('200 OK', self.render())
+
+    def _response(self, status, body):
+        return ('HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %s\r\n'
+                'Connection: close\r\n\r\n%s' % (
+                    status, CONTENT_TYPE, len(body), body))
+
+    def _write(self, client):
+        try:
+            sent = client.conn.send(client.response)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            sent = len(client.response)
+        client.response = client.response[sent:]
+        if not client.response:
+            self._close_client(client)
+
+    def _close_client(self, client):
+        fd = client.conn.fileno()
+        if self._clients.pop(fd, None) is None:
+            return
+        client.timer.cancel()
+        self._loop.remove_reader(fd)
+        self._loop.remove_writer(fd)
+        client.conn.close()
+
+class _Client(object):
+    __slots__ = ('conn', 'request', 'response', 'timer')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.request = ''
+        self.response = ''
+        self.timer = None
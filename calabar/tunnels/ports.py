@@ -0,0 +1,270 @@
+"""
+calabar.tunnels.ports
+
+Allocation of the local ports that tunnels listen on.
+
+Tunnels configured to listen on port ``auto`` get a port from the configured
+``port_ranges`` instead, handed out by the :class:`PortAllocator` that the
+tunnel manager owns. Ports are assigned all at once when the configuration is
+loaded, before any tunnel starts, so two tunnels never race for the same port:
+explicitly configured ports are claimed first (two tunnels claiming the same
+one is a :class:`PortConflict`), then every ``auto`` tunnel gets a port that's
+neither claimed nor already bound by something else on the host.
+
+Assignments are saved to a file so that a tunnel keeps its port when
+``calabard`` restarts, as long as nothing else has taken it in the meantime.
+Since that file decides which ports ``calabard`` listens on, it's kept in the
+private :data:`calabar.tunnels.rundir.RUN_DIR` like the tunnel state file.
+Taken ports are tracked in one bitmap per protocol, 8KB each.
+"""
+from __future__ import with_statement
+
+import errno
+import json
+import os
+import socket
+import sys
+import tempfile
+
+from calabar.tunnels.rundir import RUN_DIR, is_private, private_dir
+
+PORT_STATE_FILE = os.path.join(RUN_DIR, 'ports.json')
+AUTO_PORT = 'auto' # Configured in place of a port to have one allocated
+PROTOCOLS = {'tcp': socket.SOCK_STREAM, 'udp': socket.SOCK_DGRAM}
+MAX_PORT = 65535
+
+class PortConflict(Exception):
+    """
+    Two tunnels are configured to listen on the same port.
+    """
+    pass
+
+class PortsExhausted(Exception):
+    """
+    Every port in the configured ranges is taken.
+    """
+    pass
+
+class InvalidPortRange(Exception):
+    pass
+
+def parse_port_ranges(value):
+    """
+    Parse a comma-separated list of ports and ``first-last`` ranges, eg.
+    ``20000-20999, 21500``, into a list of inclusive ``(first, last)``
+    tuples.
+    """
+    ranges = []
+    for spec in value.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        try:
+            first = int(first)
+            last = int(last) if sep else first
+        except ValueError:
+            raise InvalidPortRange("Invalid port range <%s>" % spec)
+        if not 0 < first <= last <= MAX_PORT:
+            raise InvalidPortRange("Invalid port range <%s>" % spec)
+        ranges.append((first, last))
+
+    return ranges
+
+def is_bound(port, protocol='tcp', address=''):
+    """
+    Is ``port`` already bound by some process on this host?
+    """
+    sock = socket.socket(socket.AF_INET, PROTOCOLS[protocol])
+    try:
+        # Ports in TIME_WAIT can still be listened on
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((address, port))
+        except socket.error, e:
+            if e.args[0] in (errno.EADDRINUSE, errno.EACCES):
+                return True
+            raise
+        return False
+    finally:
+        sock.close()
+
+class PortBitmap(object):
+    """
+    The set of taken ports as one bit per port.
+    """
+    def __init__(self):
+        self.bits = bytearray((MAX_PORT + 1) // 8)
+
+    def __contains__(self, port):
+        return bool(self.bits[port >> 3] & (1 << (port & 7)))
+
+    def add(self, port):
+        self.bits[port >> 3] |= 1 << (port & 7)
+
+    def discard(self, port):
+        self.bits[port >> 3] &= ~(1 << (port & 7)) & 0xff
+
+    def free_ports(self, first, last):
+        """
+        Yield the ports between ``first`` and ``last`` that aren't taken,
+        skipping fully taken bytes eight ports at a time.
+        """
+        port = first
+        while port <= last:
+            if not port & 7 and self.bits[port >> 3] == 0xff:
+                port += 8
+                continue
+            if port not in self:
+                yield port
+            port += 1
+
+class PortAllocator(object):
+    """
+    Assigns local ports to tunnels from ``ranges`` (a list of inclusive
+    ``(first, last)`` tuples), keeping the assignments in the file at
+    ``path``.
+
+    ``assignments`` maps each tunnel given an ``auto`` port to that port.
+    """
+    def __init__(self, ranges=(), path=PORT_STATE_FILE):
+        self.ranges = list(ranges)
+        self.path = path
+        self.assignments = self.load()
+        self.taken = {} # protocol -> PortBitmap
+        self._active = {} # tunnel name -> port, for the ports we hold
+
+    def assign(self, claims, check_host=is_bound):
+        """
+        Work out the port of every tunnel that listens on one.
+
+        ``claims`` maps tunnel names to ``(protocol, port)`` tuples, with a
+        ``port`` of ``None`` for tunnels that want one allocated. Returns a
+        dictionary of tunnel names to ports and a list of the explicitly
+        configured ports that are already bound on the host as
+        ``(name, protocol, port)`` tuples. Ports held by tunnels from the
+        previous call are assumed to be bound by those tunnels themselves.
+
+        Raises :class:`PortConflict` if two tunnels claim the same port or
+        :class:`PortsExhausted` if a range runs out, in which case nothing
+        changes.
+        """
+        taken = dict([(protocol, PortBitmap()) for protocol in PROTOCOLS])
+        owners = {}
+        ports = {}
+        in_use = []
+
+        def claim(name, protocol, port):
+            if port in taken[protocol]:
+                raise PortConflict("[%s] and [%s] both listen on %s port %s" % (
+                    owners[(protocol, port)], name, protocol, port))
+            taken[protocol].add(port)
+            owners[(protocol, port)] = name
+            ports[name] = port
+
+        def ours(name, port):
+            return self._active.get(name) == port
+
+        auto = []
+        for name, (protocol, port) in sorted(claims.items()):
+            if port is None:
+                auto.append((name, protocol))
+                continue
+            claim(name, protocol, port)
+            if not ours(name, port) and check_host(port, protocol):
+                in_use.append((name, protocol, port))
+
+        # Tunnels keep their previous port if they can, before any new
+        # ones are handed out
+        wanting = []
+        for name, protocol in auto:
+            port = self.assignments.get(name)
+            if port is not None and self._in_ranges(port) and \
+               port not in taken[protocol] and \
+               (ours(name, port) or not check_host(port, protocol)):
+                claim(name, protocol, port)
+            else:
+                wanting.append((name, protocol))
+
+        for name, protocol in wanting:
+            claim(name, protocol, self._free_port(taken[protocol], protocol,
+                                                  check_host))
+
+        self.taken = taken
+        self._active = ports
+        assignments = dict([(name, ports[name]) for name, protocol in auto])
+        if assignments != self.assignments:
+            self.assignments = assignments
+            self.save()
+
+        return ports, in_use
+
+    def _in_ranges(self, port):
+        for first, last in self.ranges:
+            if first <= port <= last:
+                return True
+        return False
+
+    def _free_port(self, taken, protocol, check_host):
+        if not self.ranges:
+            raise PortsExhausted(
+                "port_ranges must be set for tunnels to listen on port %s" % AUTO_PORT)
+        for first, last in self.ranges:
+            for port in taken.free_ports(first, last):
+                if not check_host(port, protocol):
+                    return port
+                # Remember it for the rest of this pass
+                taken.add(port)
+
+        raise PortsExhausted("No free %s ports left in port_ranges" % protocol)
+
+    def load(self):
+        """
+        Return the assignments saved at :attr:`path`.
+
+        A file that's a symlink, isn't ours or that others can write to is
+        reported and ignored, like
+        :meth:`calabar.tunnels.adoption.TunnelStateFile.load` does.
+        """
+        if not self.path:
+            return {}
+        try:
+            fd = os.open(self.path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError, e:
+            if e.errno == errno.ELOOP:
+                self._ignore("is a symlink")
+            # Otherwise it's missing: the tunnels just get new ports
+            return {}
+        try:
+            with os.fdopen(fd) as f:
+                if not is_private(os.fstat(f.fileno())):
+                    self._ignore("could have been written by another user")
+                    return {}
+                return dict([(str(name), int(port))
+                             for name, port in json.load(f).items()])
+        except (IOError, ValueError, AttributeError):
+            # Unreadable: the tunnels just get new ports
+            return {}
+
+    def _ignore(self, reason):
+        print >> sys.stderr, "PORT STATE FILE IGNORED: <%s> %s" % (self.path, reason)
+
+    def save(self):
+        """
+        Save the assignments, replacing the file atomically so that a crash
+        never leaves it half written.
+        """
+        if not self.path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            private_dir(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.calabar-ports-')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump(self.assignments, tmp, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
@@ -0,0 +1,173 @@
+"""
+calabar.tunnels.procs
+
+A cheap, pid-indexed view of the host process table.
+
+Building a full process table for every liveness check makes each supervision
+pass cost O(tunnels * host processes). A :class:`ProcessSnapshot` instead reads
+only the processes that are actually asked about and remembers the answer for
+the rest of the pass, so one snapshot should be created per supervision tick
+and shared by every tunnel checked during that tick.
+"""
+
+import os
+import time
+
+import psi.process
+
+PROC_ROOT = '/proc'
+
+PROC_NOT_RUNNING = [
+    psi.process.PROC_STATUS_DEAD,
+    psi.process.PROC_STATUS_ZOMBIE,
+    psi.process.PROC_STATUS_STOPPED
+]
+
+# The single letter states from ``/proc/<pid>/stat`` matching PROC_NOT_RUNNING
+PROC_STATES_NOT_RUNNING = ['X', 'x', 'Z', 'T']
+
+# Of those, the ones where the process has actually exited rather than being
+# stopped, and the matching single letter states
+PROC_EXITED = [
+    psi.process.PROC_STATUS_DEAD,
+    psi.process.PROC_STATUS_ZOMBIE,
+]
+PROC_STATES_EXITED = ['X', 'x', 'Z']
+
+class ProcessInfo(object):
+    """
+    The bits of a process that tunnel supervision cares about.
+
+    ``start_time`` is an opaque token that only needs to compare equal for the
+    same process and differ once a pid has been reused. A process that isn't
+    ``running`` may only be stopped, eg. by SIGSTOP, in which case it hasn't
+    ``exited``.
+    """
+    __slots__ = ('pid', 'running', 'start_time', 'exited')
+
+    def __init__(self, pid, running, start_time, exited=False):
+        self.pid = pid
+        self.running = running
+        self.start_time = start_time
+        self.exited = exited
+
+class ProcessSnapshot(object):
+    """
+    A lazily-populated, pid-indexed snapshot of the process table.
+
+    Each pid is read at most once per snapshot. Reads come straight from
+    ``/proc/<pid>/stat`` when ``/proc`` is available, otherwise a single
+    :class:`psi.process.ProcessTable` is built on first use and shared for the
+    life of the snapshot.
+
+    ``reads`` and ``read_seconds`` count the process lookups made by every
+    snapshot and the time they took, for the supervisor's metrics.
+    """
+    reads = 0
+    read_seconds = 0.0
+
+    def __init__(self, proc_root=PROC_ROOT):
+        self.proc_root = proc_root
+        self._procs = {}
+        self._use_procfs = os.path.isdir(os.path.join(proc_root, 'self'))
+        self._psi_table = None
+
+    def get(self, pid):
+        """
+        Return the :class:`ProcessInfo` for ``pid`` or ``None`` if no such
+        process exists.
+        """
+        try:
+            return self._procs[pid]
+        except KeyError:
+            pass
+
+        started = time.time()
+        if self._use_procfs:
+            info = self._read_procfs(pid)
+        else:
+            info = self._read_psi(pid)
+        self._procs[pid] = info
+        ProcessSnapshot.reads += 1
+        ProcessSnapshot.read_seconds += time.time() - started
+
+        return info
+
+    def is_running(self, pid, start_time=None):
+        """
+        Is ``pid`` alive and not a zombie/stopped process?
+
+        If ``start_time`` is given, the process must also have been started at
+        that time, which guards against a recycled pid being mistaken for the
+        process we originally launched.
+        """
+        info = self.get(pid)
+        if info is None or not info.running:
+            return False
+        if start_time is not None and info.start_time != start_time:
+            return False
+
+        return True
+
+    def has_exited(self, pid, start_time=None):
+        """
+        Is ``pid`` gone or a zombie? Unlike :meth:`is_running`, a stopped
+        process doesn't count.
+
+        If ``start_time`` is given, a different process that has since been
+        given the same pid means that ours has exited.
+        """
+        info = self.get(pid)
+        if info is None or info.exited:
+            return True
+        if start_time is not None and info.start_time != start_time:
+            return True
+
+        return False
+
+    def start_time(self, pid):
+        """
+        Return the start time token for ``pid`` or ``None`` if it doesn't exist.
+        """
+        info = self.get(pid)
+        if info is None:
+            return None
+        return info.start_time
+
+    def _read_procfs(self, pid):
+        try:
+            stat_f = open(os.path.join(self.proc_root, str(pid), 'stat'))
+            try:
+                stat = stat_f.read()
+            finally:
+                stat_f.close()
+        except (IOError, OSError):
+            return None
+
+        # The command name is wrapped in parens and may itself contain spaces
+        # or parens, so split on the last one.
+        fields = stat[stat.rfind(')') + 2:].split()
+        try:
+            state = fields[0]
+            start_time = int(fields[19])
+        except (IndexError, ValueError):
+            return None
+
+        return ProcessInfo(pid, state not in PROC_STATES_NOT_RUNNING, start_time,
+                           state in PROC_STATES_EXITED)
+
+    def _read_psi(self, pid):
+        if self._psi_table is None:
+            self._psi_table = psi.process.ProcessTable()
+        proc = self._psi_table.get(pid, None)
+        if proc is None:
+            return None
+
+        return ProcessInfo(pid, proc.status not in PROC_NOT_RUNNING,
+                           proc.start_time, proc.status in PROC_EXITED)
+
+def process_start_time(pid):
+    """
+    Return the start time token for ``pid`` using a throwaway snapshot.
+    """
+    return ProcessSnapshot().start_time(pid)
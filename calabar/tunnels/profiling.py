@@ -0,0 +1,257 @@
+"""
+calabar.tunnels.profiling
+
+On-demand profiling of a running supervisor.
+
+``calabard`` runs for months, so finding out where its time or memory goes has
+to work without a restart. Once :meth:`Profiler.watch_signals` is called:
+
+``SIGUSR1``
+    Profile the next ``ticks`` supervision passes with :mod:`cProfile` and
+    write the raw stats (loadable with :mod:`pstats`) along with a text
+    summary to ``directory``.
+``SIGUSR2``
+    Write a memory report: the process's RSS, the live objects of each type
+    and the change in both since the previous report.
+
+Both reports include the :data:`PHASE_TIMERS`, which keep the call count,
+total and worst time of the supervisor's phases (eg. ``continue_tunnels``,
+``is_really_running``, ``open`` and ``close``) for the life of the process.
+
+Reports have predictable names and are written as root, so they go to a
+private directory under :data:`calabar.tunnels.rundir.RUN_DIR` by default and
+are always created afresh, never through a file or symlink that's already
+there.
+"""
+from __future__ import with_statement
+
+import cProfile
+import gc
+import marshal
+import os
+import pstats
+import signal
+import sys
+import time
+
+from calabar.tunnels.rundir import RUN_DIR, UnsafePath, private_dir
+
+PROFILE_DIR = os.path.join(RUN_DIR, 'profiles')
+PROFILE_TICKS = 10 # Supervision passes captured by each profile
+PROFILE_STATS_LINES = 40 # Functions listed in a profile's text summary
+MEMORY_REPORT_TYPES = 40 # Object types listed in a memory report
+
+class PhaseTimers(object):
+    """
+    Call counts and times of named phases.
+    """
+    def __init__(self):
+        self.phases = {} # name -> [calls, total seconds, max seconds]
+
+    def add(self, name, seconds):
+        try:
+            phase = self.phases[name]
+        except KeyError:
+            phase = self.phases[name] = [0, 0.0, 0.0]
+        phase[0] += 1
+        phase[1] += seconds
+        if seconds > phase[2]:
+            phase[2] = seconds
+
+    def report(self):
+        """
+        Return a line per phase, the phases taking the most time first.
+        """
+        lines = ["%-24s %10s %12s %12s %12s" % (
+            'phase', 'calls', 'total (s)', 'mean (ms)', 'max (ms)')]
+        phases = sorted(self.phases.items(), key=lambda p: p[1][1], reverse=True)
+        for name, (calls, total, worst) in phases:
+            lines.append("%-24s %10d %12.3f %12.3f %12.3f" % (
+                name, calls, total, total / calls * 1000, worst * 1000))
+
+        return lines
+
+PHASE_TIMERS = PhaseTimers()
+
+def _rss_kb():
+    """
+    Return the resident set size of this process in kB, or ``None`` if it
+    can't be read.
+    """
+    try:
+        status = open('/proc/self/status')
+        try:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+        finally:
+            status.close()
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+class MemorySnapshot(object):
+    """
+    The number of live objects of each type and the RSS at one point in time.
+
+    Only objects tracked by the garbage collector (containers and instances,
+    but not eg. strings) are counted, which is where leaks in a long-running
+    supervisor show up.
+    """
+    def __init__(self):
+        gc.collect()
+        self.taken_at = time.time()
+        self.rss_kb = _rss_kb()
+        self.counts = {}
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def diff(self, previous):
+        """
+        Return ``(type name, count, change)`` tuples for every type, with the
+        largest changes since the ``previous`` snapshot first.
+        """
+        names = set(self.counts)
+        if previous:
+            names.update(previous.counts)
+        rows = []
+        for name in names:
+            count = self.counts.get(name, 0)
+            before = previous and previous.counts.get(name, 0) or 0
+            rows.append((name, count, count - before))
+        rows.sort(key=lambda r: (abs(r[2]), r[1]), reverse=True)
+
+        return rows
+
+class Profiler(object):
+    """
+    Captures profiles and memory reports when asked to by a signal (or by
+    calling :meth:`request_profile` and :meth:`request_memory`).
+
+    Requests only set a flag; the work happens in :meth:`tick`, which the
+    tunnel manager calls once per supervision pass.
+    """
+    def __init__(self, directory=PROFILE_DIR, ticks=PROFILE_TICKS):
+        self.directory = directory
+        self.ticks = ticks
+        self.last_memory = None
+        self._profile = None
+        self._ticks_left = 0
+        self._profile_requested = False
+        self._memory_requested = False
+
+    def watch_signals(self):
+        signal.signal(signal.SIGUSR1, self._handle_profile_signal)
+        signal.signal(signal.SIGUSR2, self._handle_memory_signal)
+
+    def _handle_profile_signal(self, signum, frame):
+        self.request_profile()
+
+    def _handle_memory_signal(self, signum, frame):
+        self.request_memory()
+
+    def request_profile(self):
+        self._profile_requested = True
+
+    def request_memory(self):
+        self._memory_requested = True
+
+    def is_profiling(self):
+        return self._profile is not None
+
+    def tick(self):
+        """
+        Handle pending requests and end a profile once it has covered
+        ``ticks`` passes. Returns the paths of any reports written.
+        """
+        written = []
+        if self._memory_requested:
+            self._memory_requested = False
+            try:
+                written.append(self.dump_memory())
+            except (OSError, IOError, UnsafePath), e:
+                print >> sys.stderr, "MEMORY REPORT NOT WRITTEN: %s" % e
+
+        if self._profile is not None:
+            self._ticks_left -= 1
+            if self._ticks_left <= 0:
+                try:
+                    written += self._finish_profile()
+                except (OSError, IOError, UnsafePath), e:
+                    print >> sys.stderr, "PROFILE NOT WRITTEN: %s" % e
+        elif self._profile_requested:
+            self._profile_requested = False
+            print "PROFILING THE NEXT %s PASSES" % self.ticks
+            self._ticks_left = self.ticks
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+        return written
+
+    def _finish_profile(self):
+        profile, self._profile = self._profile, None
+        profile.disable()
+
+        base = self._report_path('profile')
+        stats_path = base + '.prof'
+        with self._create(stats_path) as f:
+            # What Profile.dump_stats() writes, without opening it by name
+            profile.create_stats()
+            marshal.dump(profile.stats, f)
+        summary_path = base + '.txt'
+        with self._create(summary_path) as summary:
+            summary.write("Profile of %s supervision passes\n\n" % self.ticks)
+            stats = pstats.Stats(profile, stream=summary)
+            stats.sort_stats('cumulative').print_stats(PROFILE_STATS_LINES)
+            summary.write('\n'.join(PHASE_TIMERS.report()) + '\n')
+        print "PROFILE WRITTEN TO %s" % summary_path
+
+        return [stats_path, summary_path]
+
+    def dump_memory(self):
+        """
+        Take a :class:`MemorySnapshot`, write it and its difference from the
+        previous one to a report and return the report's path.
+        """
+        snapshot = MemorySnapshot()
+        previous, self.last_memory = self.last_memory, snapshot
+
+        lines = []
+        if snapshot.rss_kb is not None:
+            line = "RSS: %s kB" % snapshot.rss_kb
+            if previous and previous.rss_kb is not None:
+                line += " (%+d kB in %.0fs)" % (
+                    snapshot.rss_kb - previous.rss_kb,
+                    snapshot.taken_at - previous.taken_at)
+            lines.append(line)
+        lines.append('')
+        lines.append("%-32s %10s %10s" % ('type', 'count', 'change'))
+        for name, count, change in snapshot.diff(previous)[:MEMORY_REPORT_TYPES]:
+            lines.append("%-32s %10d %+10d" % (name, count, change))
+        lines.append('')
+        lines += PHASE_TIMERS.report()
+
+        path = self._report_path('memory') + '.txt'
+        with self._create(path) as report:
+            report.write('\n'.join(lines) + '\n')
+        print "MEMORY REPORT WRITTEN TO %s" % path
+
+        return path
+
+    def _create(self, path):
+        """
+        Create the report at ``path`` for writing, readable only by us.
+        Fails if anything, including a symlink, is already there.
+        """
+        if not os.path.isdir(self.directory):
+            private_dir(self.directory)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+                     0600)
+        return os.fdopen(fd, 'w')
+
+    def _report_path(self, kind):
+        now = time.time()
+        return os.path.join(self.directory, 'calabar-%s-%s-%s.%03d' % (
+            kind, os.getpid(), time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+            int(now * 1000) % 1000))
@@ -0,0 +1,67 @@
+"""
+calabar.tunnels.rundir
+
+The private directory that ``calabard`` keeps its runtime files in.
+
+``calabard`` runs as root and trusts the files it keeps while running: the
+readiness markers that vpnc's split-tunnel script creates, for instance. In a
+world-writable directory like ``/tmp``, any local user could create those
+files first, or leave a symlink where ``calabard`` is about to write. They're
+kept in :data:`RUN_DIR` instead, which :func:`private_dir` creates so that only
+its owner can use it, and refuses to use if anyone else could have written to
+it.
+"""
+
+import errno
+import os
+import stat
+
+RUN_DIR = '/var/run/calabar/'
+GROUP_OTHER_WRITE = stat.S_IWGRP | stat.S_IWOTH
+
+class UnsafePath(Exception):
+    """
+    A runtime file or directory could have been written by another user.
+    """
+    pass
+
+def is_private(st):
+    """
+    Is the file with the :func:`os.stat` result ``st`` owned by us and
+    writable by nobody else?
+    """
+    return st.st_uid == os.geteuid() and not st.st_mode & GROUP_OTHER_WRITE
+
+def private_dir(path=RUN_DIR):
+    """
+    Create the directory ``path``, readable only by us, if it doesn't exist
+    and return it.
+
+    Raises :class:`UnsafePath` if ``path`` is a symlink or something other
+    than a directory, or isn't :func:`is_private`.
+    """
+    path = os.path.normpath(path)
+    try:
+        os.makedirs(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or not is_private(st):
+        raise UnsafePath(
+            "<%s> must be a directory that only user %s can write to" % (
+                path, os.geteuid()))
+
+    return path
+
+def is_private_file(path):
+    """
+    Is ``path`` a regular file (not a symlink) that :func:`is_private` allows?
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+
+    return stat.S_ISREG(st.st_mode) and is_private(st)
@@ -0,0 +1,126 @@
+"""
+calabar.tunnels.scripts
+
+Storage for generated tunnel scripts (eg. the vpnc split-tunnel script).
+
+Scripts are content-addressed: a script's file name is a hash of its full
+contents, so tunnels with identical scripts share one file and a script that
+already exists never needs rewriting. New scripts are written to a temporary
+file in the same directory and renamed into place, so a tunnel process starting
+at the same moment sees either the complete script or no script at all, never
+a partially written one.
+
+vpnc runs its script as root, so scripts are only trusted (and reused) if we
+own them and nobody else can write to them. By default they're kept in the
+private :data:`calabar.tunnels.rundir.RUN_DIR`.
+"""
+from __future__ import with_statement
+
+import errno
+import os
+import stat
+import tempfile
+import time
+from hashlib import md5
+
+from calabar.tunnels.rundir import RUN_DIR, is_private_file, private_dir
+
+SCRIPT_DIR = RUN_DIR
+SCRIPT_PREFIX = 'calabar-script-'
+SCRIPT_SUFFIX = '.sh'
+TEMP_PREFIX = '.calabar-script-'
+STALE_TEMP_AGE = 60 # Seconds before an abandoned temporary file is removed
+
+class ScriptStore(object):
+    """
+    A directory of executable scripts named by their contents.
+    """
+    def __init__(self, directory=SCRIPT_DIR):
+        self.directory = directory
+
+    def path_for(self, contents):
+        """
+        Return the path that a script with the given ``contents`` is stored at.
+        """
+        name = md5(contents.encode('utf-8')).hexdigest()
+        return os.path.join(
+            self.directory, '%s%s%s' % (SCRIPT_PREFIX, name, SCRIPT_SUFFIX))
+
+    def store(self, contents):
+        """
+        Make sure a script with the given ``contents`` exists and return its
+        path. Nothing is written if an identical script is already stored.
+        """
+        fpath = self.path_for(contents)
+        if self._is_stored(fpath, contents):
+            return fpath
+
+        private_dir(self.directory)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                tmp.write(contents)
+            os.chmod(tmp_path, stat.S_IXUSR | stat.S_IWUSR | stat.S_IRUSR)
+            os.rename(tmp_path, fpath)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return fpath
+
+    def _is_stored(self, fpath, contents):
+        try:
+            with open(fpath) as script:
+                stored = script.read()
+        except IOError:
+            return False
+
+        # Anything someone else could have planted or could still change gets
+        # replaced with our own copy
+        return stored == contents and is_private_file(fpath) and \
+            os.access(fpath, os.X_OK)
+
+    def cleanup(self, live_paths):
+        """
+        Remove the stored scripts that aren't in ``live_paths``, along with any
+        temporary files abandoned part way through a write.
+
+        Returns the paths that were removed.
+        """
+        live_paths = set([os.path.abspath(fpath) for fpath in live_paths])
+        now = time.time()
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Nothing has been stored yet
+            return []
+
+        removed = []
+        for name in names:
+            fpath = os.path.abspath(os.path.join(self.directory, name))
+            if name.startswith(SCRIPT_PREFIX) and name.endswith(SCRIPT_SUFFIX):
+                if fpath in live_paths:
+                    continue
+            elif name.startswith(TEMP_PREFIX):
+                try:
+                    if now - os.path.getmtime(fpath) < STALE_TEMP_AGE:
+                        # Probably still being written
+                        continue
+                except OSError:
+                    continue
+            else:
+                continue
+
+            try:
+                os.remove(fpath)
+            except OSError:
+                continue
+            removed.append(fpath)
+
+        return removed
+
+SCRIPT_STORE = ScriptStore()
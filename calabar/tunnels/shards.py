@@ -0,0 +1,531 @@
+"""
+calabar.tunnels.shards
+
+Supervision split across several worker processes.
+
+A :class:`calabar.tunnels.TunnelManager` supervises all of its tunnels from
+one process, and so from one core. For configs with thousands of tunnels,
+:class:`ShardSupervisor` forks ``workers`` processes instead. Each worker
+runs a :class:`ShardManager` over its own part of the configured tunnels and
+reaps its own tunnel processes. A tunnel's worker is picked by a hash of its
+name, so a tunnel stays on the same worker across reloads.
+
+The parent process stays thin. It reads the config and assigns ports for
+every tunnel at once, so that tunnels on different workers can't be given the
+same port. It then hands each worker its part of the tunnels and passes
+reloads along. Workers report how many of their tunnels are in each state,
+and the parent logs the totals as a single summary.
+
+A worker that dies is restarted with backoff, after its process group is
+terminated. That includes any tunnel processes the worker left behind, so
+they aren't started twice.
+
+Messages between the parent and its workers are pickles sent over pipes, each
+prefixed with its length.
+"""
+
+import errno
+import os
+import select
+import signal
+import struct
+import sys
+import time
+import traceback
+import cPickle as pickle
+from ConfigParser import SafeConfigParser
+from hashlib import md5
+
+from calabar.tunnels import TunnelManager, TUN_TYPE_STR, get_tunnels, tunnel_class
+from calabar.tunnels.backoff import Backoff
+from calabar.tunnels.events import exit_fields
+from calabar.tunnels.evented import AsyncTunnelManager
+from calabar.tunnels.loop import EventLoop, set_nonblocking
+from calabar.tunnels.shutdown import KILL_TIMEOUT, POLL_INTERVAL
+
+WORKER_STOP_GRACE = 5 # Seconds a stopping worker gets beyond its tunnels' shutdown
+
+_HEADER = struct.Struct('!I') # Length of the pickled message that follows
+
+def shard_for(name, shards):
+    """
+    Return which of ``shards`` workers supervises the tunnel called ``name``.
+    """
+    return int(md5(name).hexdigest()[:8], 16) % shards
+
+def partition(tun_confs_d, shards):
+    """
+    Split the ``tun_confs_d`` tunnel configurations (as returned by
+    :func:`calabar.tunnels.get_tunnels`) into a list with one dictionary per
+    worker.
+    """
+    parts = [{} for i in range(shards)]
+    for name, tun_conf_d in tun_confs_d.items():
+        parts[shard_for(name, shards)][name] = tun_conf_d
+
+    return parts
+
+def encode_message(message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(data)) + data
+
+def write_message(fd, message):
+    """
+    Write ``message`` to the pipe ``fd``, blocking until all of it is written.
+    """
+    data = encode_message(message)
+    written = 0
+    while written < len(data):
+        try:
+            written += os.write(fd, buffer(data, written))
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+
+class MessageReader(object):
+    """
+    Collects the messages written to the non-blocking pipe ``fd`` by
+    :func:`write_message`, however they're split up by reads.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self._buf = ''
+
+    def read(self):
+        """
+        Read whatever is waiting. Returns a list of the complete messages
+        received and whether the other end has closed the pipe.
+        """
+        chunks = [self._buf]
+        closed = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                closed = True
+                break
+            chunks.append(data)
+        buf = ''.join(chunks)
+
+        messages = []
+        offset = 0
+        while len(buf) - offset >= _HEADER.size:
+            size, = _HEADER.unpack_from(buf, offset)
+            end = offset + _HEADER.size + size
+            if len(buf) < end:
+                break
+            messages.append(pickle.loads(buf[offset + _HEADER.size:end]))
+            offset = end
+        self._buf = buf[offset:]
+
+        return messages, closed
+
+class ShardManager(AsyncTunnelManager):
+    """
+    An :class:`calabar.tunnels.evented.AsyncTunnelManager` supervising
+    worker ``shard``'s part of the tunnels.
+
+    Reloads arrive from the parent over the ``commands_fd`` pipe rather than
+    as SIGHUP, and summaries are reported to the parent over ``status_fd``
+    instead of being logged. If the parent goes away, the worker closes its
+    tunnels and exits, since nothing would restart it.
+
+    Workers don't adopt tunnel processes (see :meth:`adopt_tunnels`), since
+    the parent terminates a dead worker's processes before replacing it.
+    """
+    def __init__(self, shard, commands_fd, status_fd, loop=None):
+        AsyncTunnelManager.__init__(self, loop)
+        self.shard = shard
+        self.status_fd = status_fd
+        self.commands = MessageReader(commands_fd)
+        set_nonblocking(commands_fd)
+        set_nonblocking(status_fd)
+        self.loop.add_reader(commands_fd, self._read_commands)
+        # The parent reloads the config and tells us what changed
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    def log_summary(self):
+        return self.report_status()
+
+    def adopt_tunnels(self):
+        return []
+
+    def save_state(self):
+        pass
+
+    def report_status(self):
+        """
+        Send the number of tunnels in each state to the parent. Returns the
+        counts.
+        """
+        counts = self.state_index.counts()
+        counts['tunnels'] = len(self.tunnels)
+        data = encode_message(('status', self.shard, counts))
+        # Small enough to be written atomically or not at all
+        assert len(data) <= select.PIPE_BUF
+        try:
+            os.write(self.status_fd, data)
+        except OSError, e:
+            # If the parent is behind, the next report will do
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise
+
+        return counts
+
+    def _read_commands(self):
+        messages, closed = self.commands.read()
+        for kind, config, tun_confs_d in messages:
+            try:
+                self.update_tunnels(config, tun_confs_d)
+            except Exception, e:
+                print >> sys.stderr, "CONFIG RELOAD FAILED: %s" % e
+            self.report_status()
+
+        if closed:
+            self._handle_terminate(signal.SIGTERM, None)
+
+class _Worker(object):
+    """
+    A running worker process and the parent's ends of its pipes.
+    """
+    def __init__(self, pid, commands_fd, status_fd):
+        self.pid = pid
+        self.commands_fd = commands_fd
+        self.status = MessageReader(status_fd)
+        self.started = time.time()
+
+class ShardSupervisor(object):
+    """
+    Supervise the tunnels configured in ``configfile`` with ``workers``
+    worker processes, restarting any worker that dies.
+
+    Like :class:`calabar.tunnels.TunnelManager`, only ONE of these can exist
+    at a time since it claims SIGCHLD, SIGTERM and SIGHUP.
+    """
+    def __init__(self, configfile, workers, loop=None):
+        if loop is None:
+            loop = EventLoop()
+        self.configfile = configfile
+        self.workers = workers
+        self.loop = loop
+        # Supervises nothing itself, but loads the manager options, assigns
+        # ports and logs for the parent
+        self.manager = TunnelManager()
+        self.events = self.manager.events
+        self.config = None
+        self.parts = [{} for i in range(workers)]
+        self.procs = {} # shard -> _Worker
+        self.counts = {} # shard -> latest state counts reported by the worker
+        self.backoffs = [Backoff() for i in range(workers)]
+        self._child_exited = False
+        self._reload_requested = False
+        self._terminate_requested = False
+        self._running = False
+        self._register_signals()
+
+    def load(self):
+        """
+        Read the config file and split its tunnels between the workers.
+        """
+        config = SafeConfigParser()
+        config.read(self.configfile)
+        self.manager._load_options(config)
+        tun_confs_d = get_tunnels(config)
+        self.manager.assign_ports(tun_confs_d)
+        # Workers only see their own routes, so conflicts between workers
+        # are reported here
+        self.manager.index_routes(tun_confs_d)
+        if self.config is None:
+            # Likewise, workers only know their own tunnels' scripts. Like
+            # update_tunnels, a reload leaves scripts alone since removed
+            # tunnels may still be running.
+            self.manager.cleanup_scripts([
+                tunnel_class(tun_conf_d[TUN_TYPE_STR])(name=name, **tun_conf_d)
+                for name, tun_conf_d in tun_confs_d.items()])
+
+        self.config = config
+        self.parts = partition(tun_confs_d, self.workers)
+
+    def start(self):
+        """
+        Load the config and start every worker.
+        """
+        self.load()
+        self._running = True
+        for shard in range(self.workers):
+            self._spawn(shard)
+        self.loop.watch_signals(self._handle_signal_wakeup)
+        self.loop.call_later(self.manager.summary_interval, self._summary_timer)
+
+    def run(self):
+        """
+        Start the workers and keep them running until SIGTERM.
+        """
+        self.start()
+        while self._running:
+            self.loop.run_once()
+            self.events.flush()
+
+    def status(self):
+        """
+        Return a list of lines describing each worker and its tunnels.
+        """
+        lines = []
+        for shard in range(self.workers):
+            worker = self.procs.get(shard)
+            if worker is None:
+                lines.append("[worker %s] not running" % shard)
+                continue
+            counts = self.counts.get(shard, {})
+            lines.append("[worker %s]:%s running with %s tunnels, %s ready" % (
+                shard, worker.pid, counts.get('tunnels', 0), counts.get('ready', 0)))
+
+        return lines
+
+    def _spawn(self, shard):
+        commands_r, commands_w = os.pipe()
+        status_r, status_w = os.pipe()
+        # Don't leave anything buffered for the child to print again
+        self.events.flush()
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(commands_w)
+            os.close(status_r)
+            self._run_worker(shard, commands_r, status_w)
+
+        try:
+            # The child does this too, but it may not get that far before it
+            # dies, and its group is how its tunnel processes are cleaned up
+            os.setpgid(pid, pid)
+        except OSError, e:
+            # It already exited, or already set its own group
+            if e.errno not in (errno.ESRCH, errno.EACCES):
+                raise
+        os.close(commands_r)
+        os.close(status_w)
+        set_nonblocking(status_r)
+        worker = _Worker(pid, commands_w, status_r)
+        self.procs[shard] = worker
+        self.loop.add_reader(status_r, self._read_status, shard, worker)
+        self.backoffs[shard].started()
+        self.events.emit('worker_started', None, shard=shard, pid=pid,
+                         tunnels=len(self.parts[shard]))
+
+    def _run_worker(self, shard, commands_r, status_w):
+        """
+        Supervise ``shard``'s tunnels in the forked child. Never returns.
+        """
+        code = 1
+        try:
+            # Our own group, so that what we leave behind can be cleaned up
+            os.setpgid(0, 0)
+            for worker in self.procs.values():
+                os.close(worker.commands_fd)
+                os.close(worker.status.fd)
+            self.loop.close_after_fork()
+
+            tm = ShardManager(shard, commands_r, status_w)
+            tm.profiler.watch_signals()
+            tm.load_tunnels(self.config, self.parts[shard])
+            if tm.metrics_port is not None:
+                # Every worker serves its own tunnels' metrics
+                tm.metrics_port += shard
+                tm.serve_metrics(tm.loop)
+            tm.start_tunnels()
+            tm.report_status()
+            tm.run()
+            code = 0
+        except SystemExit, e:
+            code = e.code or 0
+        except:
+            traceback.print_exc()
+        sys.stdout.flush()
+        os._exit(code)
+
+    def _read_status(self, shard, worker):
+        messages, closed = worker.status.read()
+        for kind, from_shard, counts in messages:
+            self.counts[shard] = counts
+        if closed:
+            # Its exit is handled once it's reaped
+            self.loop.remove_reader(worker.status.fd)
+
+    def _summary_timer(self):
+        totals = {}
+        for counts in self.counts.values():
+            for state, count in counts.items():
+                totals[state] = totals.get(state, 0) + count
+        totals['workers'] = len(self.procs)
+        self.events.summary(**totals)
+        self.loop.call_later(self.manager.summary_interval, self._summary_timer)
+
+    def _register_signals(self):
+        signal.signal(signal.SIGCHLD, self._handle_child_exit)
+        signal.signal(signal.SIGTERM, self._handle_terminate)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        # Profiling happens in the workers, where the supervision is
+        signal.signal(signal.SIGUSR1, self._forward_signal)
+        signal.signal(signal.SIGUSR2, self._forward_signal)
+
+    def _handle_child_exit(self, signum, frame):
+        self._child_exited = True
+
+    def _handle_terminate(self, signum, frame):
+        self._terminate_requested = True
+
+    def _handle_reload(self, signum, frame):
+        self._reload_requested = True
+
+    def _forward_signal(self, signum, frame):
+        for worker in self.procs.values():
+            try:
+                os.kill(worker.pid, signum)
+            except OSError:
+                pass
+
+    def _handle_signal_wakeup(self):
+        if self._child_exited:
+            self.reap_workers()
+        if self._terminate_requested:
+            self.stop()
+        if self._reload_requested:
+            self.reload()
+
+    def reap_workers(self):
+        """
+        Reap every worker that has exited and schedule its restart.
+        """
+        self._child_exited = False
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if not pid:
+                break
+
+            for shard, worker in self.procs.items():
+                if worker.pid == pid:
+                    self._worker_exited(shard, worker, status)
+
+    def _worker_exited(self, shard, worker, status):
+        del self.procs[shard]
+        self.counts.pop(shard, None)
+        self._close_pipes(worker)
+        self._kill_group(worker, signal.SIGTERM)
+        self.events.emit('worker_exited', None, shard=shard, pid=worker.pid,
+                         **exit_fields(status))
+
+        if self._running:
+            delay = self.backoffs[shard].failed()
+            self.events.emit('worker_restarting', None, shard=shard,
+                             delay='%.1f' % delay)
+            self.loop.call_later(delay, self._respawn, shard)
+
+    def _kill_group(self, worker, sig):
+        """
+        Send ``sig`` to ``worker``'s process group, to take any tunnel
+        processes it left behind with it.
+        """
+        try:
+            os.killpg(worker.pid, sig)
+        except OSError:
+            pass
+
+    def _respawn(self, shard):
+        if self._running and shard not in self.procs:
+            self._spawn(shard)
+
+    def _close_pipes(self, worker):
+        self.loop.remove_reader(worker.status.fd)
+        os.close(worker.status.fd)
+        os.close(worker.commands_fd)
+
+    def reload(self):
+        """
+        Re-read the config file and send each worker its new part of the
+        tunnels. A config that can't be loaded is reported and leaves the
+        workers alone.
+        """
+        self._reload_requested = False
+        try:
+            self.load()
+        except Exception, e:
+            print >> sys.stderr, "CONFIG RELOAD FAILED: %s" % e
+            return
+
+        for shard, worker in self.procs.items():
+            try:
+                write_message(worker.commands_fd,
+                              ('reload', self.config, self.parts[shard]))
+            except OSError, e:
+                # It's exiting, and will be restarted with the new config
+                if e.errno != errno.EPIPE:
+                    raise
+
+    def stop(self):
+        """
+        Have every worker close its tunnels and exit, and wait for them.
+
+        Workers shut their tunnels down within ``shutdown_timeout`` seconds
+        (see :mod:`calabar.tunnels.shutdown`). A worker that takes much
+        longer than that is killed along with its tunnel processes.
+        """
+        self._terminate_requested = False
+        self._running = False
+        for worker in self.procs.values():
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        deadline = time.time() + self.manager.shutdown_timeout + \
+                   KILL_TIMEOUT + WORKER_STOP_GRACE
+        remaining = dict(self.procs)
+        while remaining:
+            for shard, worker in remaining.items():
+                if self._reap_worker(worker, os.WNOHANG):
+                    del remaining[shard]
+                    # Nothing's left unless it died before it finished
+                    self._kill_group(worker, signal.SIGTERM)
+                    self.events.emit('worker_stopped', None, shard=shard,
+                                     pid=worker.pid)
+            if not remaining or time.time() >= deadline:
+                break
+            time.sleep(POLL_INTERVAL)
+
+        for shard, worker in remaining.items():
+            self._kill_group(worker, signal.SIGKILL)
+            self._reap_worker(worker, 0)
+            self.events.emit('worker_killed', None, shard=shard, pid=worker.pid)
+
+        for worker in self.procs.values():
+            self._close_pipes(worker)
+        self.procs.clear()
+        self.events.flush()
+
+    def _reap_worker(self, worker, options):
+        """
+        Reap ``worker`` if it has exited (or, without ``os.WNOHANG`` in
+        ``options``, once it has). Returns whether it's gone.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(worker.pid, options)
+                return pid != 0
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                # Already reaped
+                return True
@@ -0,0 +1,156 @@
+"""
+calabar.tunnels.shutdown
+
+Stop every tunnel within a bounded time.
+
+Waiting for each tunnel to close before closing the next lets one stuck
+process hold up all of the others, while not waiting at all leaves processes
+that ignore SIGTERM running, routes and all, after ``calabard`` has gone. A
+:class:`Shutdown` instead closes every tunnel at once and then waits for all
+of their processes together against a single deadline. Whatever is still
+running when it passes is sent SIGKILL, so stopping 500 tunnels takes no
+longer than stopping 5: at most ``timeout`` plus a moment for the kills to
+land.
+"""
+
+import errno
+import os
+import signal
+import time
+
+from calabar.tunnels.procs import ProcessSnapshot
+from calabar.tunnels.states import STOPPING
+
+SHUTDOWN_TIMEOUT = 10 # Seconds tunnels get to exit before they're sent SIGKILL
+KILL_TIMEOUT = 2 # Seconds to wait for killed processes to be gone
+POLL_INTERVAL = 0.02 # Seconds between checks for exited processes
+
+class ShutdownReport(object):
+    """
+    The outcome of a :class:`Shutdown` with the given ``timeout``.
+
+    ``stopped`` maps the names of the tunnels that exited to the seconds they
+    took, ``killed`` lists the tunnels that had to be sent SIGKILL and
+    ``survived`` those whose process was still there even after that.
+    ``total`` is how long the whole shutdown took.
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.stopped = {}
+        self.killed = []
+        self.survived = []
+        self.total = None
+
+    def __str__(self):
+        lines = []
+        for name in self.killed:
+            lines.append("[%s] KILLED after %.1fs" % (name, self.timeout))
+        for name in self.survived:
+            lines.append("[%s] STILL RUNNING after SIGKILL" % name)
+        lines.append("%d/%d tunnels stopped in %.3fs, %d killed" % (
+            len(self.stopped), len(self.stopped) + len(self.survived),
+            self.total or 0, len(self.killed)))
+
+        return '\n'.join(lines)
+
+class Shutdown(object):
+    """
+    Close ``tunnels``, sending SIGKILL to any whose process hasn't exited
+    ``timeout`` seconds later.
+
+    Exited children are reaped with a single :func:`os.waitpid` loop per check
+    rather than one call per tunnel. Processes that aren't our children, like
+    adopted ones (see :mod:`calabar.tunnels.adoption`), are looked up in the
+    process table.
+    """
+    def __init__(self, tunnels, timeout=SHUTDOWN_TIMEOUT):
+        self.tunnels = list(tunnels)
+        self.timeout = timeout
+        self.report = ShutdownReport(timeout)
+        self._started_at = None
+        self._pending = {} # pid -> tunnels waiting for that process to exit
+
+    def run(self):
+        """
+        Shut the tunnels down and return the :class:`ShutdownReport`.
+        """
+        self._started_at = time.time()
+        snapshot = ProcessSnapshot()
+        for t in self.tunnels:
+            pid = t.proc.pid if t.proc is not None else None
+            # close() only signals running processes, which a stopped (eg.
+            # SIGSTOPped) one doesn't count as, but it still has to go
+            suspended = pid is not None and not t.is_running(snapshot) and \
+                not snapshot.has_exited(pid, t.proc_start_time)
+            t.close(wait=False)
+            if suspended:
+                self._terminate_suspended(pid)
+            if pid is not None and (t.state == STOPPING or suspended):
+                self._pending.setdefault(pid, []).append(t)
+            else:
+                # It wasn't running, or had nothing of its own to wait for
+                self.report.stopped[t.name] = 0
+
+        self._wait(self._started_at + self.timeout)
+        if self._pending:
+            for pid, tunnels in sorted(self._pending.items()):
+                self.report.killed += [t.name for t in tunnels]
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            self._wait(time.time() + KILL_TIMEOUT)
+            for tunnels in self._pending.values():
+                self.report.survived += [t.name for t in tunnels]
+
+        self.report.total = time.time() - self._started_at
+        return self.report
+
+    def _terminate_suspended(self, pid):
+        # SIGTERM is only acted on once the process is continued
+        for sig in (signal.SIGTERM, signal.SIGCONT):
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    def _wait(self, deadline):
+        while self._pending:
+            self._check()
+            if not self._pending or time.time() >= deadline:
+                return
+            time.sleep(min(POLL_INTERVAL, max(0, deadline - time.time())))
+
+    def _check(self):
+        while True:
+            try:
+                pid, exit_status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                break
+            if pid == 0:
+                break
+            self._exited(pid, exit_status)
+
+        # Adopted processes aren't our children, and ours are already gone
+        # without a trace if SIGCHLD is ignored. A stopped process hasn't
+        # exited, and is killed like any other once the deadline passes.
+        snapshot = ProcessSnapshot()
+        for pid, tunnels in self._pending.items():
+            if snapshot.has_exited(pid, tunnels[0].proc_start_time):
+                if tunnels[0].proc is not None:
+                    # Reaps it, if it exited since the loop above
+                    tunnels[0].proc.poll()
+                self._exited(pid, None)
+
+    def _exited(self, pid, exit_status):
+        tunnels = self._pending.pop(pid, None)
+        if not tunnels:
+            return
+        elapsed = time.time() - self._started_at
+        for t in tunnels:
+            t.handle_closed(exit_status)
+            self.report.stopped[t.name] = elapsed
@@ -0,0 +1,297 @@
+"""
+calabar.tunnels.ssh
+
+SSH port forwards multiplexed over shared connections.
+
+Every :class:`SshTunnel` to the same ``user@host`` shares a single
+:class:`SshMaster`: one authenticated ``ssh`` connection started with
+``ControlMaster`` and listening on a ``ControlPath`` socket. Forwards are
+added to and removed from the running connection with ``ssh -O forward`` and
+``ssh -O cancel``, so a new forward costs neither a handshake nor a process of
+its own. The connection is closed once its last forward is.
+
+All of the forwards to a host share the master's process, so if the connection
+drops they all exit together and are restarted together on a new one.
+
+Anyone who can reach a control socket can add forwards to its connection, and
+the sockets have predictable names, so they're kept in the private
+:data:`calabar.tunnels.rundir.RUN_DIR` rather than somewhere shared like
+``/tmp``.
+"""
+
+import os
+import stat
+import subprocess
+from hashlib import md5
+
+from calabar.tunnels import TUN_TYPE_STR
+from calabar.tunnels.base import TunnelBase, TunnelTypeDoesNotMatch
+from calabar.tunnels.ports import AUTO_PORT
+from calabar.tunnels.procs import ProcessSnapshot, process_start_time
+from calabar.tunnels.rundir import RUN_DIR, is_private, private_dir
+from calabar.tunnels.states import STOPPED
+
+CONTROL_DIR = RUN_DIR
+CONTROL_PREFIX = 'calabar-ssh-'
+SERVER_ALIVE_INTERVAL = 15 # Seconds between keepalives on idle connections
+LOCAL_ADDRESS = '127.0.0.1' # Where forwards listen unless told otherwise
+REMOTE_HOST = 'localhost' # Forwards reach their port on the SSH server itself
+
+class InvalidForward(Exception):
+    """
+    A tunnel's ``from`` or ``to`` couldn't be parsed.
+    """
+    pass
+
+def _parse_port(port, value):
+    try:
+        port = int(port)
+    except ValueError:
+        raise InvalidForward("Invalid port in <%s>" % value)
+    if not 0 < port < 65536:
+        raise InvalidForward("Invalid port in <%s>" % value)
+    return port
+
+def parse_remote(value):
+    """
+    Parse a ``[user@]host:port`` string into a ``(destination, port)`` tuple.
+    """
+    destination, sep, port = value.strip().rpartition(':')
+    if not sep or not destination:
+        raise InvalidForward("Expected [user@]host:port, not <%s>" % value)
+
+    return destination, _parse_port(port, value)
+
+def parse_local(value):
+    """
+    Parse an ``[address:]port`` string into an ``(address, port)`` tuple. A
+    port of ``auto`` is returned as ``None``, to be allocated by the tunnel
+    manager (see :mod:`calabar.tunnels.ports`).
+    """
+    address, sep, port = value.strip().rpartition(':')
+    if port == AUTO_PORT:
+        return address or LOCAL_ADDRESS, None
+
+    return address or LOCAL_ADDRESS, _parse_port(port, value)
+
+def is_private_socket(path):
+    """
+    Is ``path`` a socket (not a symlink to one) that
+    :func:`calabar.tunnels.rundir.is_private` allows?
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+
+    return stat.S_ISSOCK(st.st_mode) and is_private(st)
+
+class SshMaster(object):
+    """
+    A multiplexed ``ssh`` connection to ``destination``.
+
+    ``users`` holds the tunnels currently forwarding over the connection.
+    """
+    def __init__(self, executable, destination, control_path):
+        self.executable = executable
+        self.destination = destination
+        self.control_path = control_path
+        self.proc = None
+        self.proc_start_time = None
+        self.users = set()
+
+    def command(self):
+        return [SshTunnel.PROC_NAME, '-M', '-N', '-S', self.control_path,
+                '-o', 'BatchMode=yes',
+                '-o', 'ServerAliveInterval=%s' % SERVER_ALIVE_INTERVAL,
+                self.destination]
+
+    def is_running(self, snapshot=None):
+        # Don't poll() the process: reaping it is the tunnel manager's job
+        if self.proc is None or self.proc.returncode is not None:
+            return False
+        if snapshot is None:
+            snapshot = ProcessSnapshot()
+        return snapshot.is_running(self.proc.pid, self.proc_start_time)
+
+    def is_connected(self, snapshot=None):
+        """
+        Has the connection been established, so that forwards can be added?
+        Only a control socket that we own counts.
+        """
+        return self.is_running(snapshot) and is_private_socket(self.control_path)
+
+    def start(self):
+        """
+        Start the connection unless it's already running and return its
+        process.
+        """
+        if self.is_running():
+            return self.proc
+
+        private_dir(os.path.dirname(self.control_path))
+        if os.path.lexists(self.control_path):
+            # Left behind by a connection that died
+            os.remove(self.control_path)
+        self.users.clear()
+        self.proc = subprocess.Popen(self.command(), executable=self.executable)
+        self.proc_start_time = process_start_time(self.proc.pid)
+
+        return self.proc
+
+    def control(self, command, forward=None):
+        """
+        Send ``command`` (eg. ``forward`` or ``cancel``) for the ``forward``
+        spec to the running connection. Returns whether it succeeded.
+        """
+        cmd = [self.executable, '-S', self.control_path, '-O', command]
+        if forward:
+            cmd += ['-L', forward]
+        cmd.append(self.destination)
+
+        devnull = open(os.devnull, 'w')
+        try:
+            return subprocess.call(cmd, stdout=devnull, stderr=devnull) == 0
+        finally:
+            devnull.close()
+
+class MasterPool(object):
+    """
+    The :class:`SshMaster` for each destination, with its control socket in
+    ``directory``.
+    """
+    def __init__(self, directory=CONTROL_DIR):
+        self.directory = directory
+        self.masters = {} # (executable, destination) -> SshMaster
+
+    def get(self, executable, destination):
+        key = (executable, destination)
+        try:
+            return self.masters[key]
+        except KeyError:
+            # Socket paths are short-lived and limited to ~100 characters
+            name = md5('%s %s' % key).hexdigest()[:16]
+            master = SshMaster(executable, destination, os.path.join(
+                self.directory, CONTROL_PREFIX + name))
+            self.masters[key] = master
+            return master
+
+SSH_MASTERS = MasterPool()
+
+class SshTunnel(TunnelBase):
+    """
+    An SSH local port forward.
+
+    Connections to ``local_address:local_port`` are forwarded to
+    ``remote_port`` on the SSH server ``destination`` (``[user@]host``). The
+    server must accept key authentication since there's nobody to type a
+    password.
+    """
+    TUNNEL_TYPE = 'ssh'
+    PROC_NAME = 'calabar_ssh'
+    EXEC = '/usr/bin/ssh'
+    PORT_OPTION = 'local_port'
+    ADOPTABLE = False # The forward belongs to the old calabard's SshMaster
+    __slots__ = ('destination', 'remote_port', 'local_address', 'local_port',
+                 'master', 'forwarded')
+
+    def __init__(self, destination, remote_port, local_port,
+                 local_address=LOCAL_ADDRESS, executable=None,
+                 tunnel_type=None, *args, **kwargs):
+        if tunnel_type and tunnel_type != SshTunnel.TUNNEL_TYPE:
+            raise TunnelTypeDoesNotMatch(
+                'Tunnel type <%s> does not match expected <%s>' % (tunnel_type, SshTunnel.TUNNEL_TYPE))
+        if not executable:
+            executable = SshTunnel.EXEC
+
+        self.destination = destination
+        self.remote_port = remote_port
+        self.local_address = local_address
+        self.local_port = local_port
+        self.master = SSH_MASTERS.get(executable, destination)
+        self.forwarded = False
+
+        super(SshTunnel, self).__init__(
+            self.master.command(), executable, *args, **kwargs)
+
+    def get_forward(self):
+        """
+        Return the forward in the format taken by ``ssh -L``.
+        """
+        return '%s:%s:%s:%s' % (self.local_address, self.local_port,
+                                REMOTE_HOST, self.remote_port)
+
+    def _open(self, cmd, executable):
+        """
+        Join the connection to our destination, starting it if needed.
+        """
+        proc = self.master.start()
+        self.master.users.add(self)
+        self.forwarded = False
+        self._request_forward()
+
+        return proc
+
+    def _request_forward(self, snapshot=None):
+        if not self.forwarded and self.master.is_connected(snapshot):
+            self.forwarded = self.master.control('forward', self.get_forward())
+        return self.forwarded
+
+    def is_ready(self, snapshot=None):
+        """
+        The tunnel is ready once its forward has been added to the connection,
+        which can only happen after the connection is established.
+        """
+        return self.is_running(snapshot) and self._request_forward(snapshot)
+
+    def close(self, wait=True, force=False):
+        """
+        Cancel the forward, and close the connection if no other tunnel is
+        using it.
+        """
+        self.master.users.discard(self)
+        if self.forwarded:
+            if self.master.is_connected():
+                self.master.control('cancel', self.get_forward())
+            self.forwarded = False
+
+        if self.master.users and self.proc is not None and \
+           self.proc is self.master.proc:
+            # Other forwards still need the connection
+            self.set_state(STOPPED)
+            self.proc = None
+            self.proc_start_time = None
+            return
+
+        super(SshTunnel, self).close(wait=wait, force=force)
+
+    def handle_closed(self, exit_status):
+        self.master.users.discard(self)
+        self.forwarded = False
+        super(SshTunnel, self).handle_closed(exit_status)
+
+    @staticmethod
+    def parse_configuration(config, section_name):
+        """
+        Parse out the required tunnel information from the given
+        :mod:ConfigParser.ConfigParser instance, with this tunnel being
+        represented by the tunnel at ``section_name``.
+
+        Returns a dictionary with options corresponding to those taken by
+        :member:`__init__`
+        """
+        tun_conf_d = {}
+        tun_conf_d[TUN_TYPE_STR] = SshTunnel.TUNNEL_TYPE
+        destination, remote_port = parse_remote(config.get(section_name, 'from'))
+        tun_conf_d['destination'] = destination
+        tun_conf_d['remote_port'] = remote_port
+        local_address, local_port = parse_local(config.get(section_name, 'to'))
+        tun_conf_d['local_address'] = local_address
+        tun_conf_d['local_port'] = local_port
+
+        # Get the binary/executable for ssh
+        tun_conf_d['executable'] = None
+        if config.has_option(SshTunnel.TUNNEL_TYPE, 'bin'):
+            tun_conf_d['executable'] = config.get(SshTunnel.TUNNEL_TYPE, 'bin')
+
+        return tun_conf_d
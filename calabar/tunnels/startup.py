@@ -0,0 +1,142 @@
+"""
+calabar.tunnels.startup
+
+Bring up many tunnels at once.
+
+Opening tunnels one after another in config order means the last tunnel is
+only usable after every tunnel before it has connected. A
+:class:`StartupPipeline` keeps up to ``concurrency`` tunnels connecting at the
+same time and starts the next one as soon as any of them is ready (see
+:meth:`calabar.tunnels.base.TunnelBase.is_ready`), fails or times out, so a
+cold start takes about as long as the slowest tunnels rather than the sum of
+all of them.
+"""
+
+import time
+from collections import deque
+
+from calabar.tunnels.procs import ProcessSnapshot
+from calabar.tunnels.states import READY, STARTING
+
+STARTUP_CONCURRENCY = 10 # Tunnels allowed to be connecting at the same time
+READY_TIMEOUT = 30 # Seconds a tunnel gets to become ready
+READY_POLL_INTERVAL = 0.05 # Seconds between readiness checks
+
+class StartupReport(object):
+    """
+    The outcome of a :class:`StartupPipeline` run.
+
+    ``ready`` maps tunnel names to their time-to-ready in seconds, while
+    ``failed`` and ``timed_out`` list the names of tunnels that couldn't be
+    launched (or exited while connecting) and those that didn't become ready
+    within the timeout. ``total`` is the time until every tunnel was settled.
+    """
+    def __init__(self):
+        self.ready = {}
+        self.failed = []
+        self.timed_out = []
+        self.total = None
+
+    def __str__(self):
+        lines = []
+        for name, elapsed in sorted(self.ready.items(), key=lambda i: i[1]):
+            lines.append("[%s] ready in %.3fs" % (name, elapsed))
+        for name in self.timed_out:
+            lines.append("[%s] NOT READY (timed out)" % name)
+        for name in self.failed:
+            lines.append("[%s] FAILED TO START" % name)
+        lines.append("%d/%d tunnels ready in %.3fs" % (
+            len(self.ready),
+            len(self.ready) + len(self.failed) + len(self.timed_out),
+            self.total or 0))
+
+        return '\n'.join(lines)
+
+class StartupPipeline(object):
+    """
+    Open ``tunnels`` with at most ``concurrency`` of them connecting at once.
+
+    ``open_tunnel`` is called with each tunnel to launch it and should return
+    ``True`` if the tunnel's process was started.
+
+    Use :meth:`run` to block until every tunnel has settled, or call
+    :meth:`step` repeatedly (eg. from an event loop timer) until it returns
+    ``True``.
+    """
+    def __init__(self, tunnels, open_tunnel, concurrency=STARTUP_CONCURRENCY,
+                 timeout=READY_TIMEOUT):
+        self.open_tunnel = open_tunnel
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.report = StartupReport()
+        self._pending = deque(tunnels)
+        self._connecting = {} # tunnel -> time it was launched
+        self._started_at = None
+
+    def done(self):
+        return not self._pending and not self._connecting
+
+    def step(self):
+        """
+        Launch as many pending tunnels as the concurrency limit allows and
+        check on the ones that are connecting.
+
+        Returns ``True`` once every tunnel is ready, failed or timed out.
+        """
+        if self._started_at is None:
+            self._started_at = time.time()
+
+        while True:
+            self._launch()
+            settled = self._check()
+            if not settled or not self._pending:
+                break
+
+        if self.done() and self.report.total is None:
+            self.report.total = time.time() - self._started_at
+
+        return self.done()
+
+    def run(self, poll_interval=READY_POLL_INTERVAL):
+        """
+        Block until every tunnel has settled and return the
+        :class:`StartupReport`.
+        """
+        while not self.step():
+            time.sleep(poll_interval)
+
+        return self.report
+
+    def _launch(self):
+        while self._pending and len(self._connecting) < self.concurrency:
+            t = self._pending.popleft()
+            launched = time.time()
+            if self.open_tunnel(t):
+                self._connecting[t] = launched
+            else:
+                self.report.failed.append(t.name)
+
+    def _check(self):
+        """
+        Check every connecting tunnel and return how many of them settled.
+        """
+        now = time.time()
+        snapshot = ProcessSnapshot()
+        settled = 0
+        for t, launched in self._connecting.items():
+            if t.is_ready(snapshot):
+                if t.state == STARTING:
+                    t.set_state(READY, now)
+                # Not ``now``, which may be from before the tunnel was ready
+                self.report.ready[t.name] = time.time() - launched
+            elif not t.is_running(snapshot):
+                self.report.failed.append(t.name)
+            elif now - launched > self.timeout:
+                self.report.timed_out.append(t.name)
+            else:
+                continue
+
+            del self._connecting[t]
+            settled += 1
+
+        return settled
@@ -0,0 +1,162 @@
+"""
+calabar.tunnels.states
+
+The lifecycle of a tunnel as an explicit state machine.
+
+Every tunnel is in exactly one of these states:
+
+``stopped``
+    No process is running and no restart is scheduled yet.
+``starting``
+    The process was launched but the tunnel isn't usable yet (eg. ``vpnc`` is
+    still connecting).
+``ready``
+    The tunnel is up and passing its health probes.
+``degraded``
+    The process is running but the tunnel is failing its health probes.
+``backing_off``
+    The tunnel failed and is waiting out its backoff before being restarted.
+``stopping``
+    The process was asked to exit and hasn't yet.
+
+Only the moves listed in :data:`TRANSITIONS` are allowed; anything else raises
+:exc:`InvalidTransition`. A :class:`StateIndex` keeps the set of tunnels in
+each state up to date as they move, so finding eg. the tunnels that need a
+restart only looks at those tunnels.
+"""
+
+STOPPED = 'stopped'
+STARTING = 'starting'
+READY = 'ready'
+DEGRADED = 'degraded'
+BACKING_OFF = 'backing_off'
+STOPPING = 'stopping'
+
+STATES = (STOPPED, STARTING, READY, DEGRADED, BACKING_OFF, STOPPING)
+
+# State -> the states a tunnel may move to from it
+TRANSITIONS = {
+    STOPPED: (STARTING, BACKING_OFF),
+    STARTING: (READY, STOPPING, STOPPED),
+    READY: (DEGRADED, STOPPING, STOPPED),
+    DEGRADED: (READY, STOPPING, STOPPED),
+    BACKING_OFF: (STARTING, STOPPED),
+    STOPPING: (STOPPED,),
+}
+
+# States in which the tunnel should have a live process
+ALIVE_STATES = (STARTING, READY, DEGRADED, STOPPING)
+
+class InvalidTransition(Exception):
+    """
+    A tunnel was asked to move to a state it can't reach from its current one.
+    """
+    pass
+
+def check_transition(old, new):
+    """
+    Raise :exc:`InvalidTransition` unless a tunnel may move from ``old`` to
+    ``new``.
+    """
+    if new not in TRANSITIONS.get(old, ()):
+        raise InvalidTransition("Can't move from <%s> to <%s>" % (old, new))
+
+class StateIndex(object):
+    """
+    The set of tunnels in each state.
+
+    Tunnels that are added report their state changes back to the index, so
+    it never needs to scan every tunnel.
+    """
+    def __init__(self):
+        self._by_state = dict([(state, set()) for state in STATES])
+
+    def add(self, t):
+        if t.state_index is not None and t.state_index is not self:
+            t.state_index.discard(t)
+        t.state_index = self
+        self._by_state[t.state].add(t)
+
+    def discard(self, t):
+        if t.state_index is self:
+            t.state_index = None
+        self._by_state[t.state].discard(t)
+
+    def moved(self, t, old, new):
+        self._by_state[old].discard(t)
+        self._by_state[new].add(t)
+
+    def tunnels(self, *states):
+        """
+        Return the tunnels in any of ``states``.
+        """
+        if len(states) == 1:
+            return list(self._by_state[states[0]])
+
+        found = []
+        for state in states:
+            found.extend(self._by_state[state])
+        return found
+
+    def counts(self):
+        """
+        Return a dictionary of the number of tunnels in each state.
+        """
+        return dict([(state, len(tunnels))
+                     for state, tunnels in self._by_state.items()])
+
+class TunnelList(list):
+    """
+    A list of tunnels that adds the tunnels put into it to a
+    :class:`StateIndex` and discards those taken out.
+
+    Only single items are tracked; assigning or deleting slices isn't
+    supported.
+    """
+    def __init__(self, state_index, tunnels=()):
+        list.__init__(self, tunnels)
+        self.state_index = state_index
+        for t in self:
+            state_index.add(t)
+
+    def append(self, t):
+        list.append(self, t)
+        self.state_index.add(t)
+
+    def extend(self, tunnels):
+        for t in tunnels:
+            self.append(t)
+
+    def insert(self, i, t):
+        list.insert(self, i, t)
+        self.state_index.add(t)
+
+    def remove(self, t):
+        list.remove(self, t)
+        self.state_index.discard(t)
+
+    def pop(self, i=-1):
+        t = list.pop(self, i)
+        self.state_index.discard(t)
+        return t
+
+    def __setitem__(self, i, t):
+        if isinstance(i, slice):
+            raise TypeError("Assign tunnels one at a time")
+        old = self[i]
+        list.__setitem__(self, i, t)
+        self.state_index.discard(old)
+        self.state_index.add(t)
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            raise TypeError("Remove tunnels one at a time")
+        t = self[i]
+        list.__delitem__(self, i)
+        self.state_index.discard(t)
+
+    def __setslice__(self, i, j, tunnels):
+        raise TypeError("Assign tunnels one at a time")
+
+    def __delslice__(self, i, j):
+        raise TypeError("Remove tunnels one at a time")
@@ -0,0 +1,221 @@
+"""
+calabar.tunnels.udp
+
+UDP port forwarding inside ``calabard`` itself, eg. for DNS or RADIUS.
+
+UDP has no connections, so a :class:`UdpForwarder` keeps a session for each
+client address it hears from. Every session has its own socket connected to
+the target, which is how replies find their way back to the right client.
+Sessions that see no datagrams in either direction for ``idle_timeout``
+seconds are expired.
+
+Each wakeup drains up to ``batch`` datagrams from a socket rather than one, so
+a burst costs one trip through the event loop instead of one per datagram,
+while still leaving the other tunnels their turn. Everything is relayed
+through one buffer per forward. Datagrams that can't be sent straight away are
+dropped, as the network would.
+"""
+
+import socket
+import time
+
+from calabar.tunnels import TUN_TYPE_STR
+from calabar.tunnels.forward import ForwardTunnel, resolve, _would_block
+
+MAX_SESSIONS = 1024 # Clients a forward keeps sessions for at once
+SESSION_TIMEOUT = 60 # Seconds without traffic before a session expires
+BATCH_SIZE = 64 # Datagrams handled per socket per wakeup
+MAX_DATAGRAM = 65535
+
+class UdpForwarder(object):
+    """
+    Relay datagrams received on ``listen`` (an ``(address, port)`` tuple) to
+    ``target`` (a ``(host, port)`` tuple) and the replies back to whichever
+    client sent them.
+
+    Like :class:`calabar.tunnels.forward.Forwarder`, it counts ``bytes_in``
+    and ``bytes_out``, the sessions ``accepted``, and the datagrams
+    ``refused`` (from new clients over ``max_sessions``, or whose session
+    couldn't be set up, eg. for lack of file descriptors) or ``dropped``
+    (couldn't be received or sent).
+    """
+    def __init__(self, listen, target, max_sessions=MAX_SESSIONS,
+                 idle_timeout=SESSION_TIMEOUT, batch=BATCH_SIZE):
+        self.listen = listen
+        self.target = target
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.batch = batch
+        self.loop = None
+        self.sock = None
+        self.sessions = {} # client address -> _Session
+        self.buf = bytearray(MAX_DATAGRAM)
+        self.view = memoryview(self.buf)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.accepted = 0
+        self.refused = 0
+        self.dropped = 0
+        self._target_addr = None
+
+    def start(self, loop):
+        """
+        Start receiving datagrams on ``loop``.
+
+        Raises :exc:`socket.error` if ``listen`` can't be bound or ``target``
+        doesn't resolve, which the tunnel manager treats as a failed launch.
+        """
+        self._target_addr = resolve(self.target, socket.SOCK_DGRAM)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(self.listen)
+            sock.setblocking(0)
+        except socket.error:
+            sock.close()
+            raise
+        self.loop = loop
+        self.sock = sock
+        self.listen = sock.getsockname()
+        loop.add_reader(sock.fileno(), self._readable)
+
+    def stop(self):
+        """
+        Stop receiving datagrams and forget every session.
+        """
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+        for session in self.sessions.values():
+            session.close()
+
+    def is_listening(self):
+        return self.sock is not None
+
+    def _readable(self):
+        now = time.time()
+        for x in xrange(self.batch):
+            try:
+                n, client = self.sock.recvfrom_into(self.buf)
+            except socket.error, e:
+                if _would_block(e):
+                    return
+                self.dropped += 1
+                continue
+
+            session = self.sessions.get(client)
+            if session is None:
+                if len(self.sessions) >= self.max_sessions:
+                    self.refused += 1
+                    continue
+                try:
+                    session = _Session(self, client)
+                except socket.error:
+                    self.refused += 1
+                    continue
+                self.accepted += 1
+
+            session.last_active = now
+            try:
+                session.sock.send(self.view[:n])
+            except socket.error:
+                self.dropped += 1
+                continue
+            self.bytes_in += n
+
+class _Session(object):
+    """
+    A client of a :class:`UdpForwarder` and its socket to the target.
+    """
+    __slots__ = ('forwarder', 'client', 'sock', 'last_active', 'timer')
+
+    def __init__(self, forwarder, client):
+        self.forwarder = forwarder
+        self.client = client
+        self.last_active = time.time()
+
+        family, addr = forwarder._target_addr
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            self.sock.setblocking(0)
+            self.sock.connect(addr)
+        except socket.error:
+            self.sock.close()
+            raise
+        forwarder.sessions[client] = self
+        forwarder.loop.add_reader(self.sock.fileno(), self._readable)
+        self.timer = forwarder.loop.call_later(forwarder.idle_timeout,
+                                               self._check_idle)
+
+    def _readable(self):
+        fwd = self.forwarder
+        for x in xrange(fwd.batch):
+            try:
+                n = self.sock.recv_into(fwd.buf)
+            except socket.error, e:
+                if _would_block(e):
+                    break
+                # eg. ECONNREFUSED when nothing listens on the target port
+                fwd.dropped += 1
+                continue
+
+            try:
+                fwd.sock.sendto(fwd.view[:n], self.client)
+            except socket.error:
+                fwd.dropped += 1
+                continue
+            fwd.bytes_out += n
+        self.last_active = time.time()
+
+    def _check_idle(self):
+        idle = time.time() - self.last_active
+        if idle >= self.forwarder.idle_timeout:
+            self.close()
+        else:
+            self.timer = self.forwarder.loop.call_later(
+                self.forwarder.idle_timeout - idle, self._check_idle)
+
+    def close(self):
+        self.timer.cancel()
+        self.forwarder.sessions.pop(self.client, None)
+        self.forwarder.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+class UdpForwardTunnel(ForwardTunnel):
+    """
+    Forward datagrams sent to ``listen_address:listen_port`` to
+    ``target_host:target_port`` from inside ``calabard``.
+    """
+    TUNNEL_TYPE = 'udp_forward'
+    FORWARDER = UdpForwarder
+    PORT_PROTOCOL = 'udp'
+    __slots__ = ()
+
+    def __init__(self, listen_port, target_host, target_port,
+                 listen_address='127.0.0.1', max_sessions=MAX_SESSIONS,
+                 idle_timeout=SESSION_TIMEOUT, tunnel_type=None, *args, **kwargs):
+        super(UdpForwardTunnel, self).__init__(
+            listen_port, target_host, target_port, listen_address,
+            max_sessions, idle_timeout, tunnel_type, *args, **kwargs)
+
+    @staticmethod
+    def parse_configuration(config, section_name):
+        """
+        Parse out the required tunnel information from the given
+        :mod:ConfigParser.ConfigParser instance, with this tunnel being
+        represented by the tunnel at ``section_name``.
+
+        Returns a dictionary with options corresponding to those taken by
+        :member:`__init__`
+        """
+        tun_conf_d = ForwardTunnel.parse_configuration(config, section_name)
+        tun_conf_d[TUN_TYPE_STR] = UdpForwardTunnel.TUNNEL_TYPE
+
+        # Sessions stand in for connections
+        tun_conf_d.pop('max_connections', None)
+        if config.has_option(section_name, 'max_sessions'):
+            tun_conf_d['max_sessions'] = config.getint(
+                section_name, 'max_sessions')
+
+        return tun_conf_d
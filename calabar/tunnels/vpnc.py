@@ -2,11 +2,26 @@ from __future__ import with_statement
 
 import csv
 import os
-import stat
-from hashlib import md5
 
-from calabar.tunnels import TUN_TYPE_STR
+from calabar.tunnels import TUN_TYPE_STR, TUNNEL_PREFIX
 from calabar.tunnels.base import TunnelBase, TunnelTypeDoesNotMatch
+from calabar.tunnels.ips import collapse, int_to_ip, masklen_to_mask, parse_range
+from calabar.tunnels.rundir import RUN_DIR, private_dir
+from calabar.tunnels.scripts import SCRIPT_STORE
+
+class InvalidTunnelName(Exception):
+    """
+    A vpnc tunnel's name can't be used in the name of its readiness marker.
+    """
+    pass
+
+def check_name(name):
+    """
+    Raise :class:`InvalidTunnelName` unless ``name`` is safe to put in a file
+    name.
+    """
+    if not name or '/' in name or name in ('.', '..'):
+        raise InvalidTunnelName("Invalid vpnc tunnel name <%s>" % name)
 
 class VpncTunnel(TunnelBase):
     """
@@ -23,6 +38,8 @@ class VpncTunnel(TunnelBase):
     TUNNEL_TYPE = 'vpnc'
     PROC_NAME = 'calabar_vpnc'
     EXEC = '/usr/sbin/vpnc'
+    READY_DIR = RUN_DIR # See calabar.tunnels.rundir
+    __slots__ = ('conf_file', '_tun_script', '_tun_script_f')
 
     def __init__(self, conf_file, executable=None, ips=None, tunnel_type=None,
                  *args, **kwargs):
@@ -41,6 +58,7 @@ class VpncTunnel(TunnelBase):
                 'Tunnel type <%s> does not match expected <%s>' % (tunnel_type, TunnelBase.TUNNEL_TYPE))
 
         super(VpncTunnel, self).__init__(cmd, executable, *args, **kwargs)
+        check_name(self.name)
 
     def _build_cmd(self, conf_file, ips):
         """
@@ -62,6 +80,38 @@ class VpncTunnel(TunnelBase):
 
         return cmd
 
+    def get_ready_fp(self):
+        """
+        Get the path to the file that the split-tunnel script creates once
+        vpnc has connected and configured the tunnel.
+        """
+        return os.path.join(VpncTunnel.READY_DIR, 'calabar-%s.ready' % self.name)
+
+    def open(self):
+        """
+        Open the tunnel, clearing out any readiness marker left by a previous
+        connection.
+        """
+        private_dir(VpncTunnel.READY_DIR)
+        ready_fp = self.get_ready_fp()
+        if os.path.exists(ready_fp):
+            os.remove(ready_fp)
+
+        return super(VpncTunnel, self).open()
+
+    def _open_env(self):
+        env = dict(os.environ)
+        env[READY_ENV] = self.get_ready_fp()
+
+        return env
+
+    def is_ready(self, snapshot=None):
+        """
+        The tunnel is ready once vpnc has connected, which the split-tunnel
+        script signals by creating the file at :meth:`get_ready_fp`.
+        """
+        return self.is_running(snapshot) and os.path.exists(self.get_ready_fp())
+
     def get_split_tunnel_script_fp(self, ips=None):
         """
         Get the path to the split-tunneling configuration script.
@@ -76,20 +126,19 @@ class VpncTunnel(TunnelBase):
 
         return self._tun_script_f
 
-    def _gen_script_fname(self, ips):
-        ip_hash = md5("".join(ips).encode('utf-8')).hexdigest()[:12]
-        fpath = os.path.join('/tmp/', ip_hash)
-
-        return fpath
+    def get_script_files(self):
+        if self._tun_script_f:
+            return [self._tun_script_f]
+        return []
 
     def _set_split_tunnel_script_file(self, ips):
+        """
+        Store the split-tunnel script in the
+        :data:`calabar.tunnels.scripts.SCRIPT_STORE`, which shares one file
+        between every tunnel routing the same IPs.
+        """
         contents = self._build_split_tunnel_script(ips)
-
-        fpath = self._gen_script_fname(ips)
-        with open(fpath, 'w') as tun_script:
-            self._tun_script_f = fpath
-            tun_script.write(contents)
-        os.chmod(self._tun_script_f, stat.S_IXUSR | stat.S_IWUSR | stat.S_IRUSR)
+        self._tun_script_f = SCRIPT_STORE.store(contents)
 
         return self._tun_script_f
 
@@ -98,15 +147,20 @@ class VpncTunnel(TunnelBase):
         Build the vpnc script for split-tunneling to only the specific ip
         addresses and return the contents.
 
-        ``ips`` is an array of IP addresses that will be the target of
-        split-tunneling
+        ``ips`` is an array of IP addresses, CIDR blocks and ranges that will
+        be the target of split-tunneling. They're collapsed into the fewest
+        routes that cover the same addresses.
         """
         if self._tun_script:
             return self._tun_script
 
         additional_ips = []
-        for ip in ips:
-            additional_ips.append(ADD_IP_TPL % {'ip':ip})
+        for network, masklen in collapse(ips):
+            additional_ips.append(ADD_IP_TPL % {
+                'ip': int_to_ip(network),
+                'mask': masklen_to_mask(masklen),
+                'masklen': masklen,
+            })
 
         self._tun_script = SPLIT_TUN_TPL % {'tun_ips': '\n'.join(additional_ips)}
 
@@ -122,6 +176,9 @@ class VpncTunnel(TunnelBase):
         Returns a dictionary with options corresponding to those taken by
         :member:`__init__`
         """
+        # Catch names that can't be used before anything is started
+        check_name(section_name[len(TUNNEL_PREFIX):])
+
         tun_conf_d = {} # Tunnel configuration directory
         tun_conf_d[TUN_TYPE_STR] = VpncTunnel.TUNNEL_TYPE
         tun_conf_d['conf_file'] = config.get(section_name, 'conf_file')
@@ -131,6 +188,9 @@ class VpncTunnel(TunnelBase):
         if config.has_option(section_name, 'ips'):
             ip_str = config.get(section_name, 'ips')
             tun_conf_d['ips'] = [itm.strip() for itm in csv.reader([ip_str]).next()]
+            # Catch typos when the config is loaded rather than on connect
+            for ip in tun_conf_d['ips']:
+                parse_range(ip)
 
         # Get the binary/executable for VPNC
         tun_conf_d['executable'] = None
@@ -139,15 +199,16 @@ class VpncTunnel(TunnelBase):
 
         return tun_conf_d
 
-ADD_IP_TPL = "add_ip %(ip)s # auto-generated by calabar"
+READY_ENV = 'CALABAR_READY_FILE' # Tells the split-tunnel script where to signal readiness
+ADD_IP_TPL = "add_ip %(ip)s %(mask)s %(masklen)s # auto-generated by calabar"
 SPLIT_TUN_TPL = """#!/bin/sh
 
-# Add one IP to the list of split tunnels
+# Add one network (address, netmask, prefix length) to the list of split tunnels
 add_ip ()
 {
         export CISCO_SPLIT_INC_${CISCO_SPLIT_INC}_ADDR=$1
-        export CISCO_SPLIT_INC_${CISCO_SPLIT_INC}_MASK=255.255.255.255
-        export CISCO_SPLIT_INC_${CISCO_SPLIT_INC}_MASKLEN=32
+        export CISCO_SPLIT_INC_${CISCO_SPLIT_INC}_MASK=$2
+        export CISCO_SPLIT_INC_${CISCO_SPLIT_INC}_MASKLEN=$3
         export CISCO_SPLIT_INC=$(($CISCO_SPLIT_INC + 1))
 }
 
@@ -161,6 +222,17 @@ unset INTERNAL_IP4_DNS
 # List of IPs beyond VPN tunnel
 %(tun_ips)s
 
+# Let calabar know when the tunnel is up. The default script may exit, so
+# signal from a trap once it's done configuring the connection.
+case "$reason" in
+        connect)
+                [ -n "$CALABAR_READY_FILE" ] && trap 'touch "$CALABAR_READY_FILE"' EXIT
+                ;;
+        disconnect)
+                [ -n "$CALABAR_READY_FILE" ] && rm -f "$CALABAR_READY_FILE"
+                ;;
+esac
+
 # Execute default script
 . /etc/vpnc/vpnc-script
 
@@ -0,0 +1,237 @@
+#! /usr/bin/env python
+"""
+Measure how the tunnel managers scale with the number of tunnels.
+
+Each run supervises N tunnels of the bundled ``cal_run_forever`` helper and
+records:
+
+* ``startup_seconds``: wall time for ``start_tunnels`` to settle every tunnel
+* ``pass_cpu_seconds``/``pass_wall_seconds``: mean CPU and wall time of a full
+  supervision pass (``continue_tunnels``, or the async manager's safety-net
+  pass)
+* ``exit_detect_seconds``: from killing a tunnel to the manager noticing
+* ``restart_seconds``: from killing a tunnel to its replacement launching
+* ``rss_*_kb``: the manager's resident memory before and after the run
+
+Results are written as JSON so that runs against different versions can be
+compared::
+
+    scripts/run_benchmarks.py --sizes 10,100,1000 --output before.json
+"""
+
+import optparse
+import os
+import signal
+import sys
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.join(scripts_dir, '..')
+sys.path.insert(0, repo_dir)
+# Use the bundled helper rather than requiring it to be installed
+os.environ['PATH'] = os.pathsep.join(
+    [os.path.join(repo_dir, 'bin'), os.environ['PATH']])
+
+import calabar
+from calabar.tunnels import TunnelManager
+from calabar.tunnels.base import TunnelBase
+from calabar.tunnels.evented import AsyncTunnelManager
+from calabar.tunnels.profiling import _rss_kb
+
+EXECUTABLE = 'cal_run_forever'
+MANAGERS = ['poll', 'async']
+POLL_INTERVAL = 0.01 # Seconds between passes while waiting on the poll manager
+RESTART_TIMEOUT = 30 # Seconds to wait for killed tunnels to be restarted
+
+OPTION_LIST = (
+    optparse.make_option('-s', '--sizes', action="store", dest="sizes",
+                         default='10,100',
+                         help="Comma-separated numbers of tunnels to run"),
+    optparse.make_option('-m', '--managers', action="store", dest="managers",
+                         default=','.join(MANAGERS),
+                         help="Comma-separated managers to benchmark "
+                         "(poll, async)"),
+    optparse.make_option('-p', '--passes', action="store", type="int",
+                         dest="passes", default=20,
+                         help="Supervision passes to time for each run"),
+    optparse.make_option('-k', '--kills', action="store", type="int",
+                         dest="kills", default=10,
+                         help="Tunnels to kill when timing restarts"),
+    optparse.make_option('-o', '--output', action="store", dest="output",
+                         default=None,
+                         help="Write the JSON results here instead of stdout"),
+)
+
+def _summary(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        'mean': sum(values) / len(values),
+        'median': values[len(values) // 2],
+        'max': values[-1],
+    }
+
+def _cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
+
+def _quietly(func, *args):
+    """
+    Call ``func`` without the events and reports the managers print ending up
+    in the results.
+    """
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        return func(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def _make_manager(kind, size):
+    if kind == 'poll':
+        tm = TunnelManager()
+    else:
+        tm = AsyncTunnelManager()
+    tm.startup_concurrency = size
+    tm.tunnels = [TunnelBase([EXECUTABLE], EXECUTABLE, name='bench%s' % i)
+                  for i in range(size)]
+    for t in tm.tunnels:
+        tm.metrics.track(t.name)
+
+    return tm
+
+def _start(tm, kind):
+    started = time.time()
+    if kind == 'poll':
+        tm.start_tunnels()
+    else:
+        tm.start_tunnels()
+        while tm.startup_report is None:
+            tm.loop.run_once(timeout=0.05)
+
+    return time.time() - started
+
+def _time_passes(tm, kind, passes):
+    if kind == 'poll':
+        run_pass = tm.continue_tunnels
+    else:
+        run_pass = tm._supervise_pass
+
+    cpu, wall = _cpu_seconds(), time.time()
+    for x in range(passes):
+        run_pass()
+    cpu, wall = _cpu_seconds() - cpu, time.time() - wall
+
+    return cpu / passes, wall / passes
+
+def _time_restarts(tm, kind, kills):
+    """
+    Kill ``kills`` tunnels at once and return the exit detection and restart
+    latencies of each.
+    """
+    detected_at = {}
+    exited = tm.metrics.exited
+    def record_exit(name, *args, **kwargs):
+        detected_at.setdefault(name, time.time())
+        exited(name, *args, **kwargs)
+    tm.metrics.exited = record_exit
+
+    victims = tm.tunnels[:kills]
+    killed_at = {}
+    for t in victims:
+        killed_at[t.name] = time.time()
+        os.kill(t.proc.pid, signal.SIGKILL)
+
+    deadline = time.time() + RESTART_TIMEOUT
+    while time.time() < deadline:
+        if kind == 'poll':
+            tm.continue_tunnels()
+            time.sleep(POLL_INTERVAL)
+        else:
+            tm.loop.run_once(timeout=POLL_INTERVAL)
+        if all([tm.metrics.tunnels[t.name].starts > 1 for t in victims]):
+            break
+    tm.metrics.exited = exited
+
+    detect, restart = [], []
+    for t in victims:
+        if t.name in detected_at:
+            detect.append(detected_at[t.name] - killed_at[t.name])
+        metrics = tm.metrics.tunnels[t.name]
+        if metrics.starts > 1:
+            restart.append(metrics.last_start - killed_at[t.name])
+
+    return detect, restart
+
+def _stop(tm, kind):
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    for t in tm.tunnels:
+        if t.is_running():
+            t.close(wait=False, force=True)
+    for t in tm.tunnels:
+        if t.proc is not None:
+            try:
+                t.proc.wait()
+            except OSError:
+                pass
+    if kind == 'async':
+        tm.loop.close()
+
+def run_benchmark(kind, size, passes, kills):
+    rss_start = _rss_kb()
+    tm = _make_manager(kind, size)
+    try:
+        startup = _quietly(_start, tm, kind)
+        pass_cpu, pass_wall = _quietly(_time_passes, tm, kind, passes)
+        detect, restart = _quietly(_time_restarts, tm, kind, min(kills, size))
+        rss_end = _rss_kb()
+    finally:
+        _stop(tm, kind)
+
+    return {
+        'manager': kind,
+        'tunnels': size,
+        'startup_seconds': startup,
+        'pass_cpu_seconds': pass_cpu,
+        'pass_wall_seconds': pass_wall,
+        'exit_detect_seconds': _summary(detect),
+        'restart_seconds': _summary(restart),
+        'restarted': len(restart),
+        'rss_start_kb': rss_start,
+        'rss_end_kb': rss_end,
+        'rss_growth_kb': rss_start and rss_end and rss_end - rss_start,
+    }
+
+def main(arguments):
+    parser = optparse.OptionParser(option_list=OPTION_LIST)
+    options, values = parser.parse_args(arguments)
+
+    results = []
+    for size in [int(s) for s in options.sizes.split(',')]:
+        for kind in options.managers.split(','):
+            print >> sys.stderr, "Benchmarking %s manager with %s tunnels..." % (
+                kind, size)
+            results.append(run_benchmark(kind, size, options.passes,
+                                         options.kills))
+
+    report = json.dumps({
+        'calabar_version': calabar.__version__,
+        'python': sys.version.split()[0],
+        'timestamp': time.time(),
+        'results': results,
+    }, indent=2, sort_keys=True)
+    if options.output:
+        out = open(options.output, 'w')
+        out.write(report + '\n')
+        out.close()
+    else:
+        print report
+
+if __name__ == '__main__':
+    main(sys.argv[1:])